@@ -72,6 +72,7 @@ namespace LitAR
             {
                 numOfViews = 5,
                 expTimeWindow = 300,
+                captureInterval = 300,
                 nearFieldSize = 2 * 100,
                 AmbientAvgColorBrightness = _ambientInfo.averageBrightness!.Value,
                 AmbientAvgColorTemperature = _ambientInfo.averageColorTemperature!.Value,
@@ -81,7 +82,8 @@ namespace LitAR
                 colorDenseSamplingSize = new Vector2Int(
                     (int) (depthImage.dimensions.x * 4),
                     (int) (depthImage.dimensions.y * 4)),
-                colorSparseSamplingSize = new Vector2Int(32, 24)
+                colorSparseSamplingSize = new Vector2Int(32, 24),
+                qualityTier = 2
             };
             
             // Medium
@@ -89,6 +91,7 @@ namespace LitAR
             // {
             //     numOfViews = 4,
             //     expTimeWindow = 300,
+            //     captureInterval = 300,
             //     nearFieldSize = 2 * 100,
             //     AmbientAvgColorBrightness = _ambientInfo.averageBrightness!.Value,
             //     AmbientAvgColorTemperature = _ambientInfo.averageColorTemperature!.Value,
@@ -98,7 +101,8 @@ namespace LitAR
             //     colorDenseSamplingSize = new Vector2Int(
             //         (int) (depthImage.dimensions.x * 2),
             //         (int) (depthImage.dimensions.y * 2)),
-            //     colorSparseSamplingSize = new Vector2Int(32, 24)
+            //     colorSparseSamplingSize = new Vector2Int(32, 24),
+            //     qualityTier = 1
             // };
             
             // Low quality setting
@@ -106,6 +110,7 @@ namespace LitAR
             // {
             //     numOfViews = 3,
             //     expTimeWindow = 300,
+            //     captureInterval = 300,
             //     nearFieldSize = 2 * 100,
             //     AmbientAvgColorBrightness = _ambientInfo.averageBrightness!.Value,
             //     AmbientAvgColorTemperature = _ambientInfo.averageColorTemperature!.Value,
@@ -115,7 +120,8 @@ namespace LitAR
             //     colorDenseSamplingSize = new Vector2Int(
             //         (int) (depthImage.dimensions.x * 1),
             //         (int) (depthImage.dimensions.y * 1)),
-            //     colorSparseSamplingSize = new Vector2Int(32, 24)
+            //     colorSparseSamplingSize = new Vector2Int(32, 24),
+            //     qualityTier = 0
             // };
 
             _tmpController = new AutoCaptureController(initData)
@@ -197,6 +203,13 @@ namespace LitAR
                 case 0b_0000_0001:
                     OnSessionInitializationFinished(dataBody);
                     break;
+                case 0b_0000_0010:
+                    OnScreenConsole.main!.Log("Session unknown to the server, cannot resume it");
+                    break;
+                case 0b_0000_0011:
+                    OnScreenConsole.main!.Log(
+                        $"Session held by the worker on port {BitConverter.ToInt32(data, 1)}");
+                    break;
                 case 0b_0001_0000:
                     OnNewEnvironmentMapReceived?.Invoke(this, dataBody.ToArray());
 
@@ -208,6 +221,13 @@ namespace LitAR
                         controller.Enabled = EnableAutoCapture;
                     }
                     break;
+                case 0b_0010_0000:
+                    OnScreenConsole.main!.Log($"Server busy, {dataBody[0]} keyframes pending");
+                    break;
+                case 0b_0010_0001:
+                    var viewIndex = BitConverter.ToInt32(dataBody.Slice(1, sizeof(int)));
+                    OnScreenConsole.main!.Log($"Server dropped a stale keyframe of view {viewIndex}");
+                    break;
             }
         }
 
@@ -163,7 +163,7 @@ namespace LitAR.LightingReconstruction
             var now = DateTime.Now;
 
             var delta = (now - _timer).TotalMilliseconds;
-            var res = delta > _config.expTimeWindow;
+            var res = delta > _config.captureInterval;
 
             if (res) _timer = now;
 
@@ -9,7 +9,8 @@ namespace LitAR.LightingReconstruction
         private const byte PackageIdentifier = 0b0000_0000;
 
         public int numOfViews;
-        public int expTimeWindow; // in milliseconds
+        public int expTimeWindow; // in seconds, captures older than this expire, 0 disables
+        public int captureInterval; // in milliseconds, not sent to the service
         public int nearFieldSize; // in millimeters
 
         public float AmbientAvgColorBrightness;
@@ -21,6 +22,8 @@ namespace LitAR.LightingReconstruction
         public Vector2Int colorDenseSamplingSize;
         public Vector2Int colorSparseSamplingSize;
 
+        public int qualityTier; // 0: low, 1: medium, 2: high
+
         public byte[] EncodeToBytes()
         {
             const int headerLength = 1;
@@ -28,12 +31,14 @@ namespace LitAR.LightingReconstruction
             const int ambientInfoLength = 2 * sizeof(float);
             const int matrixKLength = 4 * sizeof(float);
             const int imgSizesLength = 6 * sizeof(int);
+            const int qualityTierLength = 1 * sizeof(int);
 
             var pkgBytes = new byte[headerLength
                                     + configLength
                                     + ambientInfoLength
                                     + matrixKLength
-                                    + imgSizesLength];
+                                    + imgSizesLength
+                                    + qualityTierLength];
 
             pkgBytes[0] = PackageIdentifier;
             var offset = headerLength;
@@ -76,6 +81,13 @@ namespace LitAR.LightingReconstruction
                 colorSparseSamplingSize.x,
                 colorSparseSamplingSize.y
             }, 0, pkgBytes, offset, imgSizesLength);
+            offset += imgSizesLength;
+
+
+            Buffer.BlockCopy(new[]
+            {
+                qualityTier
+            }, 0, pkgBytes, offset, qualityTierLength);
 
             return pkgBytes;
         }
@@ -1,22 +1,48 @@
-# To use a different quality setting, you need to comment out the current setting,
-# and then uncomment the desired setting.
+# System configurations
+PORT = 8753
+PIPELINE_WORKERS = 4  # threads running the reconstruction pipeline
+KEYFRAME_QUEUE_SIZE = 4  # pending keyframes per session before dropping
 
-# System configurationsPORT = 8753
+# Batch the near field point generation of keyframes across sessions
+BATCH_KEYFRAMES = False
+BATCH_WINDOW = 0.002  # seconds to gather keyframes of other sessions
+BATCH_MAX_SIZE = 16  # keyframes per batch
 
-# Quality Setting: Low
-MLP_SEQUENCE = [256, 128, 32]
-PANORAMA_WIDTH = 512
-PANORAMA_HEIGHT = 256
+# Session management
+SESSION_MEMORY_BUDGET = 4 * 1024 ** 3  # bytes of session buffers per process, 0 means unlimited
+SESSION_IDLE_TIMEOUT = 600  # seconds a disconnected session is kept for
+SESSION_SNAPSHOT_INTERVAL = 30  # keyframes between snapshots, 0 only snapshots on disconnect
 
-# Quality Setting: Medium
-# MLP_SEQUENCE = [384, 192]
-# PANORAMA_WIDTH = 768
-# PANORAMA_HEIGHT = 384
+# Tiled environment map responses
+ENV_MAP_TILE_SIZE = 64
+ENV_MAP_FULL_INTERVAL = 30  # send a full environment map every n updates
 
-# Quality Setting: High
-# MLP_SEQUENCE = [512, 256, 128]
-# PANORAMA_WIDTH = 1024
-# PANORAMA_HEIGHT = 512
+# Quality settings
+# Each session requests one of the tiers below when it is initialized,
+# sessions that don't request a tier use the default one.
+QUALITY_LOW = 0
+QUALITY_MEDIUM = 1
+QUALITY_HIGH = 2
+
+QUALITY_TIERS = {
+    QUALITY_LOW: {
+        'mlp_sequence': [256, 128, 32],
+        'panorama_width': 512,
+        'panorama_height': 256
+    },
+    QUALITY_MEDIUM: {
+        'mlp_sequence': [384, 192],
+        'panorama_width': 768,
+        'panorama_height': 384
+    },
+    QUALITY_HIGH: {
+        'mlp_sequence': [512, 256, 128],
+        'panorama_width': 1024,
+        'panorama_height': 512
+    }
+}
+
+DEFAULT_QUALITY_TIER = QUALITY_LOW
 
 # Far field setting
 N_ANCHORS = 1280
@@ -28,3 +54,14 @@ CUBEMAP_SIZE = 512
 NEAR_FIELD_SIZE = 20
 NEAR_FIELD_SIZE_HALF = NEAR_FIELD_SIZE / 2
 NEAR_FIELD_CLIP_DST = 1000
+
+# Fuse near field views into a voxel hash, 0 disables fusion
+NEAR_FIELD_VOXEL_SIZE = 0  # e.g. 0.01 for 1 centimeter voxels
+NEAR_FIELD_MAX_POINTS = 2000000  # fused points kept per session
+NEAR_FIELD_INITIAL_POINTS = 65536  # fused points allocated up front, doubled on demand
+
+# Compute backend setting
+# 'auto' uses CUDA when a device is available and falls back to the CPU,
+# 'cuda' and 'cpu' force the corresponding backend.
+COMPUTE_BACKEND = 'auto'
+CPU_NUM_THREADS = 0  # 0 means using all available cores
@@ -5,7 +5,9 @@ import importlib
 import multiprocessing
 
 entries = {
-    'serve': {'module': 'service', 'func': 'start_service'}
+    'serve': {'module': 'service', 'func': 'start_service'},
+    'replay': {'module': 'service.replay', 'func': 'replay'},
+    'loadtest': {'module': 'service.loadtest', 'func': 'loadtest'}
 }
 
 
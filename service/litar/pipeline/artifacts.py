@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import os
+import numpy as np
+from typing import Callable
+
+ARTIFACT_DIR = './tmp/artifacts'
+
+
+def artifact_path(name: str, key: dict) -> str:
+    """Compose the file path of an artifact from its name and key values."""
+    tags = '_'.join([f'{k}-{v}' for k, v in key.items()])
+    return os.path.join(ARTIFACT_DIR, f'{name}_{tags}.npy')
+
+
+def load_or_build(name: str, key: dict, builder: Callable[[], np.ndarray]) -> np.ndarray:
+    """Load a read-only memory-mapped artifact, building it on first use.
+
+    The artifact is written to a temporary file and moved in place, so
+    concurrent processes never see a partially written file. Processes
+    mapping the same artifact share its pages through the page cache.
+    """
+    path = artifact_path(name, key)
+
+    if not os.path.exists(path):
+        data = np.ascontiguousarray(builder())
+
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,106 @@
+import threading
+import numpy as np
+import numba as nb
+from numba import cuda
+from contextlib import contextmanager
+
+from configs import COMPUTE_BACKEND
+from configs import CPU_NUM_THREADS
+
+BACKEND_CUDA = 'cuda'
+BACKEND_CPU = 'cpu'
+
+# The workqueue threading layer can't be used by several threads at once
+_workqueue_lock = threading.Lock()
+
+
+def resolve_backend(name: str = None) -> str:
+    """Resolve a backend name into either `cuda` or `cpu`.
+
+    `auto` picks CUDA when a device is present, otherwise the CPU. The
+    `COMPUTE_BACKEND` configuration is used when no name is given.
+    """
+    name = COMPUTE_BACKEND if name is None else name
+
+    if name == 'auto':
+        name = BACKEND_CUDA if cuda.is_available() else BACKEND_CPU
+
+    if name == BACKEND_CUDA and not cuda.is_available():
+        raise RuntimeError('CUDA backend requested but no device is available')
+
+    if name not in (BACKEND_CUDA, BACKEND_CPU):
+        raise ValueError(f'Unknown compute backend: {name}')
+
+    return name
+
+
+@contextmanager
+def cpu_launch():
+    """Prepare the calling thread for launching CPU kernels.
+
+    Numba keeps the thread count per calling thread, so `CPU_NUM_THREADS`
+    is applied on whichever thread is about to launch the kernels. Launches
+    are serialized when numba falls back to the workqueue threading layer,
+    which doesn't support concurrent callers.
+    """
+    if CPU_NUM_THREADS > 0:
+        nb.set_num_threads(min(CPU_NUM_THREADS, nb.config.NUMBA_NUM_THREADS))
+
+    try:
+        threadsafe = nb.threading_layer() != 'workqueue'
+    except ValueError:
+        threadsafe = False  # no parallel kernel has run yet
+
+    if threadsafe:
+        yield
+    else:
+        with _workqueue_lock:
+            yield
+
+
+def alloc_array(backend: str, shape, dtype) -> np.ndarray:
+    """Allocate a zeroed buffer that the backend kernels can work on.
+
+    CUDA uses managed memory so the buffer is accessible from both sides.
+    """
+    if backend == BACKEND_CUDA:
+        arr = cuda.managed_array(shape, dtype=dtype)
+        arr.fill(0)
+        return arr
+
+    return np.zeros(shape, dtype=dtype)
+
+
+def as_input_array(backend: str, arr: np.ndarray) -> np.ndarray:
+    """Expose a read-only host array to the backend kernels.
+
+    The CPU kernels read the array in place, e.g. straight from a memory
+    map, while CUDA needs a copy in managed memory.
+    """
+    if backend == BACKEND_CUDA:
+        out = cuda.managed_array(arr.shape, dtype=arr.dtype)
+        out[::] = arr
+        return out
+
+    return arr
+
+
+def as_kernel_input(backend: str, arr: np.ndarray, buf: np.ndarray) -> np.ndarray:
+    """Let the backend kernels read `arr`, copying it into `buf` if needed.
+
+    The CPU kernels read host arrays in place, e.g. views into a received
+    package, while CUDA needs them in managed memory.
+    """
+    if backend == BACKEND_CUDA:
+        if cuda.is_cuda_array(arr):
+            return arr
+
+        buf[::] = arr
+        return buf
+
+    return np.ascontiguousarray(arr)
+
+
+def synchronize(backend: str) -> None:
+    if backend == BACKEND_CUDA:
+        cuda.current_context().synchronize()
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import numba as nb
@@ -6,26 +6,47 @@ from numba import cuda
 from numba.cuda.cudadrv.devicearray import ManagedNDArray
 
 from configs import N_ANCHORS
-from configs import MLP_SEQUENCE
-from configs import NEAR_FIELD_CLIP_DST
-from configs import N_ANCHOR_NEIGHBORS
 
 from litar.types import Vector2Int
+from litar.pipeline.backend import BACKEND_CUDA
+from litar.pipeline.backend import alloc_array
+from litar.pipeline.backend import resolve_backend
+from litar.pipeline.backend import cpu_launch
 
 from .kernel import cuda_update_anchors
 from .kernel import dpcp_cuda
 from .kernel import draw_far_field
+from .kernel import draw_far_field_pixels
 from .kernel import merge_dpcp_cuda
-from .static_data import canvas_size, canvas, anchor_xyz, anchor_acc
+from .kernel import cpu_dpcp
+from .kernel import cpu_draw_far_field
+from .kernel import cpu_draw_far_field_pixels
+from .kernel import collect_anchor_pixels
+from .kernel import cpu_merge_dpcp
+from .static_data import PanoramaStaticData, get_static_data
+
+# Redraw the whole far field when more than this ratio of pixels is dirty
+FAR_FIELD_FULL_REDRAW_RATIO = 0.5
+
+MLP_EPOCH_MAX = np.iinfo(np.uint32).max
+
+
+def far_field_pixels_capacity(canvas_size: Vector2Int) -> int:
+    """Most pixels a partial far field redraw lists, larger redraws are full."""
+    return int(int(canvas_size.x) * int(canvas_size.y) * FAR_FIELD_FULL_REDRAW_RATIO)
 
 
 class ManagedPanoramaRenderer:
+    backend: str
     canvas_size: Vector2Int
-    prj_sequence = MLP_SEQUENCE  # panorama image heights
+    prj_sequence: List[int]  # panorama image heights
+    static_data: PanoramaStaticData
 
     arg_in_const: ManagedNDArray
     arg_inout_mlp_i: ManagedNDArray
     arg_inout_mlp_d: ManagedNDArray
+    arg_inout_mlp_e: ManagedNDArray  # epoch of each texel, older epochs are empty
+    mlp_epoch: int
 
     arg_inout_anchor_rgb: ManagedNDArray
     arg_inout_anchor_depth: ManagedNDArray
@@ -33,13 +54,24 @@ class ManagedPanoramaRenderer:
     arg_in_anchor_acc_grid: ManagedNDArray
     arg_in_anchor_xyz: ManagedNDArray
     arg_in_anchor_acc: ManagedNDArray
+    arg_in_canvas: ManagedNDArray  # canvas pixel normals
 
+    arg_inout_far_field: ManagedNDArray  # far field layer, kept between frames
     arg_out_canvas: ManagedNDArray
 
-    def __init__(self, init_ambient_color) -> None:
+    __tmp_iuv: np.ndarray  # CPU projection scratch buffer
+    __dirty_anchors: np.ndarray  # anchors repainted since the last redraw
+    __ambient_color: np.ndarray  # color of anchors without observations
+    __far_field_drawn: bool
+
+    def __init__(self, init_ambient_color, canvas_size: Vector2Int,
+                 prj_sequence: List[int], backend: str = None) -> None:
+        self.backend = resolve_backend(backend)
         self.canvas_size = canvas_size
+        self.prj_sequence = prj_sequence
+        self.static_data = get_static_data(canvas_size)
 
-        self.arg_in_const = cuda.managed_array((10), dtype=np.float32)
+        self.arg_in_const = alloc_array(self.backend, (10), np.float32)
         self.arg_in_const[0] = self.canvas_size.x
         self.arg_in_const[1] = self.canvas_size.y
         self.arg_in_const[2] = 0  # offset
@@ -54,40 +86,94 @@ class ManagedPanoramaRenderer:
             self.arg_in_const[6 + i] = self.prj_sequence[i]
 
         mlp_len = sum([h * h * 2 for h in self.prj_sequence])
-        self.arg_inout_mlp_i = cuda.managed_array((mlp_len), dtype=np.uint32)
-        self.arg_inout_mlp_d = cuda.managed_array((mlp_len), dtype=np.float32)
+        self.arg_inout_mlp_i = alloc_array(self.backend, (mlp_len), np.uint32)
+        self.arg_inout_mlp_d = alloc_array(self.backend, (mlp_len), np.float32)
+        self.arg_inout_mlp_e = alloc_array(self.backend, (mlp_len), np.uint32)
+        self.mlp_epoch = 1  # the zeroed buffers start out stale
 
         # anchor arguments
+        self.__ambient_color = np.asarray(init_ambient_color, dtype=np.uint8)
         t = init_ambient_color[np.newaxis, :]
         t = t.repeat(N_ANCHORS, axis=0)
-        self.arg_inout_anchor_rgb = cuda.managed_array(
-            (N_ANCHORS, 3), dtype=np.uint8)
+        self.arg_inout_anchor_rgb = alloc_array(
+            self.backend, (N_ANCHORS, 3), np.uint8)
         self.arg_inout_anchor_rgb[::] = t
 
-        self.arg_inout_anchor_depth = cuda.managed_array(
-            (N_ANCHORS), dtype=np.float32)
+        self.arg_inout_anchor_depth = alloc_array(
+            self.backend, (N_ANCHORS), np.float32)
         self.arg_inout_anchor_depth.fill(10000)
 
-        self.arg_in_anchor_xyz = cuda.managed_array(
-            (N_ANCHORS, 3), dtype=np.float32)
-        self.arg_in_anchor_xyz[::] = anchor_xyz
-
-        self.arg_in_anchor_acc_grid = cuda.managed_array(
-            (self.canvas_size.y, self.canvas_size.x), dtype=np.int)
-
-        self.arg_in_anchor_acc = cuda.managed_array(
-            (canvas_size.y, canvas_size.x, N_ANCHOR_NEIGHBORS),
-            dtype=np.uint16)
-        self.arg_in_anchor_acc[::] = anchor_acc
-
-        # Result canvas
-        self.arg_out_canvas = cuda.managed_array(
-            (canvas_size.y, canvas_size.x, 3),
-            dtype=np.float32)
+        self.arg_in_anchor_xyz = alloc_array(
+            self.backend, (N_ANCHORS, 3), np.float32)
+        self.arg_in_anchor_xyz[::] = self.static_data.anchor_xyz
+
+        # Shared between all sessions of the same canvas size
+        self.arg_in_anchor_acc_grid = self.static_data.input_array(
+            'acc_grid', self.backend)
+        self.arg_in_anchor_acc = self.static_data.input_array(
+            'anchor_acc', self.backend)
+        self.arg_in_canvas = self.static_data.input_array(
+            'canvas', self.backend)
+
+        # Far field layer and result canvas
+        self.arg_inout_far_field = alloc_array(
+            self.backend, (canvas_size.y, canvas_size.x, 3), np.float32)
+        self.arg_out_canvas = alloc_array(
+            self.backend, (canvas_size.y, canvas_size.x, 3), np.float32)
+
+        # Pixels of partial far field redraws, at most the full redraw ratio
+        n_pixels = canvas_size.x * canvas_size.y
+        self.arg_in_far_field_pixels = alloc_array(
+            self.backend, (far_field_pixels_capacity(canvas_size)), np.int32)
+        self.__far_field_mask = np.zeros(n_pixels, dtype=bool)
+
+        self.__tmp_iuv = np.empty(0, dtype=np.int64)
+        self.__dirty_anchors = np.zeros(N_ANCHORS, dtype=bool)
+        self.__far_field_drawn = False
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by this renderer, static data shared between sessions excluded."""
+        buffers = [
+            self.arg_in_const,
+            self.arg_inout_mlp_i, self.arg_inout_mlp_d, self.arg_inout_mlp_e,
+            self.arg_inout_anchor_rgb, self.arg_inout_anchor_depth,
+            self.arg_in_anchor_xyz,
+            self.arg_inout_far_field, self.arg_out_canvas,
+            self.arg_in_far_field_pixels, self.__far_field_mask,
+            self.__tmp_iuv, self.__dirty_anchors]
+
+        return sum([b.nbytes for b in buffers])
+
+    @staticmethod
+    def estimate_nbytes(canvas_size: Vector2Int, prj_sequence: List[int]) -> int:
+        """Bytes a new renderer allocates, before its scratch buffers grow."""
+        mlp_len = sum([int(h) * int(h) * 2 for h in prj_sequence])
+        n_pixels = int(canvas_size.x) * int(canvas_size.y)
+        return 4 * 10 + mlp_len * 3 * 4 + \
+            N_ANCHORS * (3 + 4 + 3 * 4 + 1) + \
+            n_pixels * 3 * 4 * 2 + \
+            far_field_pixels_capacity(canvas_size) * 4 + n_pixels
+
+    def update(self, in_pcd_xyz: ManagedNDArray, in_pcd_rgb: ManagedNDArray,
+               ranges: List[Tuple[int, int]] = None) -> None:
+        """Project points into the projection buffers and merge the canvas.
+
+        Only the points in `ranges`, a list of `(i_begin, i_end)` index
+        ranges, are projected on top of the current buffers. All points are
+        projected when no ranges are given, and an empty list only merges.
+        """
+        if ranges is None:
+            ranges = [(0, in_pcd_xyz.shape[0])]
+
+        # Empty ranges, e.g. fused views without new voxels, would be empty grids
+        ranges = [(i_begin, i_end) for i_begin, i_end in ranges if i_end > i_begin]
+
+        if self.backend != BACKEND_CUDA:
+            self.update_cpu(in_pcd_xyz, in_pcd_rgb, ranges)
+            return
 
-    def update(self, in_pcd_xyz: ManagedNDArray, in_pcd_rgb: ManagedNDArray) -> np.ndarray:
         n_thread = 1024
-        n_block = (in_pcd_xyz.shape[0] + (n_thread - 1)) // n_thread
 
         for i, h in enumerate(self.prj_sequence):
             # Run projection kernel on each level
@@ -98,11 +184,18 @@ class ManagedPanoramaRenderer:
             self.arg_in_const[3] = h * 2  # current projection width
             self.arg_in_const[4] = h  # current projection height
 
-            dpcp_cuda[n_block, n_thread](
-                self.arg_inout_mlp_i,
-                self.arg_inout_mlp_d,
-                self.arg_in_const,
-                in_pcd_xyz)
+            for i_begin, i_end in ranges:
+                n_block = (i_end - i_begin + (n_thread - 1)) // n_thread
+
+                dpcp_cuda[n_block, n_thread](
+                    self.arg_inout_mlp_i,
+                    self.arg_inout_mlp_d,
+                    self.arg_inout_mlp_e,
+                    self.arg_in_const,
+                    self.mlp_epoch,
+                    in_pcd_xyz,
+                    i_begin,
+                    i_end)
 
             cuda.current_context().synchronize()
 
@@ -112,12 +205,52 @@ class ManagedPanoramaRenderer:
         merge_dpcp_cuda[n_block, n_thread](
             self.arg_out_canvas,
             self.arg_in_const,
+            self.mlp_epoch,
             self.arg_inout_mlp_i,
             self.arg_inout_mlp_d,
+            self.arg_inout_mlp_e,
+            self.arg_inout_far_field,
             in_pcd_rgb)
 
         cuda.current_context().synchronize()
 
+    def update_cpu(self, in_pcd_xyz: np.ndarray, in_pcd_rgb: np.ndarray,
+                   ranges: List[Tuple[int, int]]) -> None:
+        """Multi-threaded CPU counterpart of the CUDA kernels in `update`."""
+        n_max = max([i_end - i_begin for i_begin, i_end in ranges], default=0)
+        if self.__tmp_iuv.shape[0] < n_max:
+            self.__tmp_iuv = np.empty(n_max, dtype=np.int64)
+
+        with cpu_launch():
+            for i, h in enumerate(self.prj_sequence):
+                offset = sum([v * v * 2 for v in self.prj_sequence[:i]])
+
+                self.arg_in_const[2] = offset  # offset
+                self.arg_in_const[3] = h * 2  # current projection width
+                self.arg_in_const[4] = h  # current projection height
+
+                for i_begin, i_end in ranges:
+                    cpu_dpcp(
+                        self.arg_inout_mlp_i,
+                        self.arg_inout_mlp_d,
+                        self.arg_inout_mlp_e,
+                        self.arg_in_const,
+                        self.mlp_epoch,
+                        in_pcd_xyz,
+                        i_begin,
+                        i_end,
+                        self.__tmp_iuv)
+
+            cpu_merge_dpcp(
+                self.arg_out_canvas,
+                self.arg_in_const,
+                self.mlp_epoch,
+                self.arg_inout_mlp_i,
+                self.arg_inout_mlp_d,
+                self.arg_inout_mlp_e,
+                self.arg_inout_far_field,
+                in_pcd_rgb)
+
     def update_anchors(self, in_sp_xyz, in_sp_rgb):
         print('---------------->', in_sp_xyz.shape[0])
 
@@ -134,20 +267,120 @@ class ManagedPanoramaRenderer:
 
         cuda.current_context().synchronize()
 
-    def clean_up(self) -> None:
-        # Clean up index and depth buffers
-        self.arg_inout_mlp_i[::] = 0
-        self.arg_inout_mlp_d[::] = NEAR_FIELD_CLIP_DST
+    def paint_anchors(self, mask: np.ndarray, rgb: np.ndarray) -> None:
+        """Paint the masked anchors, only anchors changing color are marked dirty."""
+        anchor_rgb = np.asarray(self.arg_inout_anchor_rgb)
+        rgb = np.asarray(rgb, dtype=np.uint8)
+
+        changed = np.zeros_like(mask)
+        changed[mask] = np.any(anchor_rgb[mask] != rgb, axis=-1)
+
+        self.arg_inout_anchor_rgb[mask, :] = rgb
+        self.__dirty_anchors |= changed
+
+    def reset_anchors(self, anchors: np.ndarray) -> None:
+        """Reset anchors to the ambient color, e.g. once their color expired."""
+        mask = np.zeros(N_ANCHORS, dtype=bool)
+        mask[anchors] = True
+
+        self.paint_anchors(
+            mask, np.broadcast_to(self.__ambient_color, (mask.sum(), 3)))
+
+    def redraw_far_field(self) -> None:
+        """Bring the far field layer up to date with the anchor colors.
+
+        Only the pixels whose anchor neighborhood references a dirty anchor
+        are redrawn, unless most of the canvas is affected.
+        """
+        pixels = self.arg_in_far_field_pixels
+        n_dirty = None
+
+        if self.__far_field_drawn:
+            dirty = np.flatnonzero(self.__dirty_anchors)
+            if len(dirty) == 0:
+                return
+
+            mask = self.__far_field_mask
+            mask.fill(False)
+            n_dirty = collect_anchor_pixels(
+                mask,
+                self.static_data.anchor_pixel_ptr,
+                self.static_data.anchor_pixel_idx,
+                dirty)
+
+            if n_dirty == 0:
+                # Anchors outside the neighborhood of any pixel
+                self.__dirty_anchors[::] = False
+                return
+
+            if n_dirty <= pixels.shape[0]:
+                pixels[:n_dirty] = np.flatnonzero(mask)
+            else:
+                n_dirty = None
+
+        self.__dirty_anchors[::] = False
+        self.__far_field_drawn = True
+
+        if self.backend != BACKEND_CUDA:
+            with cpu_launch():
+                if n_dirty is None:
+                    cpu_draw_far_field(
+                        self.arg_inout_far_field,
+                        self.arg_in_canvas,
+                        self.arg_in_anchor_acc,
+                        self.arg_in_anchor_xyz,
+                        self.arg_inout_anchor_rgb)
+                else:
+                    cpu_draw_far_field_pixels(
+                        self.arg_inout_far_field,
+                        self.arg_in_canvas,
+                        pixels,
+                        n_dirty,
+                        self.arg_in_anchor_acc,
+                        self.arg_in_anchor_xyz,
+                        self.arg_inout_anchor_rgb)
+            return
+
+        if n_dirty is None:
+            n_thread = (32, 32)
+            n_block = (self.canvas_size.x // 32, self.canvas_size.y // 32)
+            draw_far_field[n_block, n_thread](
+                self.arg_inout_far_field,
+                self.arg_in_canvas,
+                self.arg_in_anchor_acc,
+                self.arg_in_anchor_xyz,
+                self.arg_inout_anchor_rgb)
+        else:
+            n_thread = 1024
+            n_block = (n_dirty + (n_thread - 1)) // n_thread
+            draw_far_field_pixels[n_block, n_thread](
+                self.arg_inout_far_field,
+                self.arg_in_canvas,
+                pixels,
+                n_dirty,
+                self.arg_in_anchor_acc,
+                self.arg_in_anchor_xyz,
+                self.arg_inout_anchor_rgb)
 
-        # clean up canvas
-        self.arg_out_canvas[::] = canvas
+        cuda.current_context().synchronize()
 
-        n_thread = (32, 32)
-        n_block = (self.canvas_size.x // 32, self.canvas_size.y // 32)
-        draw_far_field[n_block, n_thread](
-            self.arg_out_canvas,
-            self.arg_in_anchor_acc,
-            self.arg_in_anchor_xyz,
-            self.arg_inout_anchor_rgb)
+    def invalidate_projection(self) -> None:
+        """Empty the projection buffers by moving to the next epoch.
 
-        cuda.current_context().synchronize()
+        The buffers are not cleared, texels stamped with an older epoch
+        are simply treated as empty by the kernels.
+        """
+        self.mlp_epoch += 1
+        if self.mlp_epoch > MLP_EPOCH_MAX:
+            # Wrapped around, the stamps have to be cleared once
+            self.arg_inout_mlp_e[::] = 0
+            self.mlp_epoch = 1
+
+    def clean_up(self) -> None:
+        """Start over from empty projection buffers and an up to date far field.
+
+        The canvas is fully rewritten by the merge in `update`, from either
+        the near or the far field.
+        """
+        self.invalidate_projection()
+        self.redraw_far_field()
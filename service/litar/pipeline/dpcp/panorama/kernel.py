@@ -35,10 +35,10 @@ def cuda_update_anchors(out_anchor_rgb, out_anchor_depth,
 
 
 @cuda.jit
-def dpcp_cuda(out_mlp_i, out_mlp_d, in_const, in_pcd_xyz):
-    i = cuda.grid(1)
+def dpcp_cuda(out_mlp_i, out_mlp_d, out_mlp_e, in_const, in_epoch, in_pcd_xyz, i_begin, i_end):
+    i = i_begin + cuda.grid(1)
 
-    if i >= in_pcd_xyz.shape[0]:
+    if i >= i_end:
         return
 
     offset = int(in_const[2])
@@ -58,25 +58,32 @@ def dpcp_cuda(out_mlp_i, out_mlp_d, in_const, in_pcd_xyz):
     r = r if y < dd and y > -dd else NEAR_FIELD_CLIP_DST
     r = r if z < dd and z > -dd else NEAR_FIELD_CLIP_DST
 
+    # Skip degenerated points, e.g. unfilled view slots at the origin
+    if r <= 0:
+        return
+
     v = math.acos(y / r)
     u = math.atan2(x, z)
     r = r
 
-    v = int(v / math.pi * prj_h)
-    u = int((u + math.pi) / (math.pi * 2) * prj_w)
+    v = min(int(v / math.pi * prj_h), prj_h - 1)
+    u = min(int((u + math.pi) / (math.pi * 2) * prj_w), prj_w - 1)
 
     iuv = offset + v * prj_w + u
     # pi = out_mlp_i[iuv]
-    pd = out_mlp_d[iuv]
+    # Texels stamped with an older epoch are empty
+    pd = out_mlp_d[iuv] if out_mlp_e[iuv] == in_epoch else NEAR_FIELD_CLIP_DST
 
     if r < NEAR_FIELD_CLIP_DST:
         if r > pd or pd >= NEAR_FIELD_CLIP_DST:
             out_mlp_i[iuv] = i
             out_mlp_d[iuv] = r
+            out_mlp_e[iuv] = in_epoch
 
 
 @cuda.jit
-def merge_dpcp_cuda(out_canvas, in_const, in_mlp_i, in_mlp_d, in_pcd_rgb):
+def merge_dpcp_cuda(out_canvas, in_const, in_epoch, in_mlp_i, in_mlp_d, in_mlp_e,
+                    in_far_field, in_pcd_rgb):
     u, v = cuda.grid(2)
 
     c_size_y = int(in_const[1])
@@ -96,23 +103,26 @@ def merge_dpcp_cuda(out_canvas, in_const, in_mlp_i, in_mlp_d, in_pcd_rgb):
         p_iuv = int(offset + v // s * prj_w + u // s)
         p_d = in_mlp_d[p_iuv]
 
-        if p_d < dm:
+        if p_d < dm and in_mlp_e[p_iuv] == in_epoch:
             im = p_iuv
             dm = p_d
 
+    # Every pixel is written, either from the near or the far field
     if dm < NEAR_FIELD_CLIP_DST:
         ii = in_mlp_i[im]
 
         out_canvas[v, u, 0] = in_pcd_rgb[ii, 0]
         out_canvas[v, u, 1] = in_pcd_rgb[ii, 1]
         out_canvas[v, u, 2] = in_pcd_rgb[ii, 2]
+    else:
+        out_canvas[v, u, 0] = in_far_field[v, u, 0]
+        out_canvas[v, u, 1] = in_far_field[v, u, 1]
+        out_canvas[v, u, 2] = in_far_field[v, u, 2]
 
 
-@cuda.jit()
-def draw_far_field(out_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb):
-    u, v = cuda.grid(2)
-
-    n = out_canvas_norms[v, u]
+@cuda.jit(device=True)
+def shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb, v, u):
+    n = in_canvas_norms[v, u]
     w, r, g, b = 0, 0, 0, 0
 
     for i in range(in_anchor_acc.shape[2]):
@@ -128,6 +138,194 @@ def draw_far_field(out_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb
         g += in_anchor_rgb[i_anchor, 1] * c
         b += in_anchor_rgb[i_anchor, 2] * c
 
-    out_canvas_norms[v, u, 0] = r / w
-    out_canvas_norms[v, u, 1] = g / w
-    out_canvas_norms[v, u, 2] = b / w
+    out_far_field[v, u, 0] = r / w
+    out_far_field[v, u, 1] = g / w
+    out_far_field[v, u, 2] = b / w
+
+
+@cuda.jit()
+def draw_far_field(out_far_field, in_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb):
+    u, v = cuda.grid(2)
+
+    shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc,
+                    in_anchor_xyz, in_anchor_rgb, v, u)
+
+
+@cuda.jit()
+def draw_far_field_pixels(out_far_field, in_canvas_norms, in_pixels, in_n_pixels,
+                          in_anchor_acc, in_anchor_xyz, in_anchor_rgb):
+    """Redraw only the first `in_n_pixels` listed pixels, given as flat canvas indices."""
+    i = cuda.grid(1)
+
+    if i >= in_n_pixels:
+        return
+
+    v = in_pixels[i] // out_far_field.shape[1]
+    u = in_pixels[i] % out_far_field.shape[1]
+
+    shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc,
+                    in_anchor_xyz, in_anchor_rgb, v, u)
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_dpcp(out_mlp_i, out_mlp_d, out_mlp_e, in_const, in_epoch, in_pcd_xyz, i_begin, i_end, tmp_iuv):
+    """CPU counterpart of `dpcp_cuda`, over the points in [i_begin, i_end).
+
+    The projection runs in parallel, while the depth test is applied
+    serially in point order to avoid the write races of the CUDA kernel.
+    """
+    offset = int(in_const[2])
+    prj_w = int(in_const[3])
+    prj_h = int(in_const[4])
+
+    n = i_end - i_begin
+    dd = NEAR_FIELD_SIZE_HALF
+
+    for j in nb.prange(n):
+        i = i_begin + j
+        x = in_pcd_xyz[i, 0]
+        y = in_pcd_xyz[i, 1]
+        z = in_pcd_xyz[i, 2]
+
+        # Filter near field distances
+        r = math.hypot(math.hypot(x, y), z)
+
+        r = r if x < dd and x > -dd else NEAR_FIELD_CLIP_DST
+        r = r if y < dd and y > -dd else NEAR_FIELD_CLIP_DST
+        r = r if z < dd and z > -dd else NEAR_FIELD_CLIP_DST
+
+        if r <= 0 or r >= NEAR_FIELD_CLIP_DST:
+            tmp_iuv[j] = -1
+            continue
+
+        v = math.acos(y / r)
+        u = math.atan2(x, z)
+
+        v = min(int(v / math.pi * prj_h), prj_h - 1)
+        u = min(int((u + math.pi) / (math.pi * 2) * prj_w), prj_w - 1)
+
+        tmp_iuv[j] = offset + v * prj_w + u
+
+    for j in range(n):
+        iuv = tmp_iuv[j]
+        if iuv < 0:
+            continue
+
+        i = i_begin + j
+
+        x = in_pcd_xyz[i, 0]
+        y = in_pcd_xyz[i, 1]
+        z = in_pcd_xyz[i, 2]
+        r = math.hypot(math.hypot(x, y), z)
+
+        pd = out_mlp_d[iuv] if out_mlp_e[iuv] == in_epoch else NEAR_FIELD_CLIP_DST
+        if r > pd or pd >= NEAR_FIELD_CLIP_DST:
+            out_mlp_i[iuv] = i
+            out_mlp_d[iuv] = r
+            out_mlp_e[iuv] = in_epoch
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_merge_dpcp(out_canvas, in_const, in_epoch, in_mlp_i, in_mlp_d, in_mlp_e,
+                   in_far_field, in_pcd_rgb):
+    c_size_y = int(in_const[1])
+    n_prj = int(in_const[5])
+
+    for v in nb.prange(out_canvas.shape[0]):
+        for u in range(out_canvas.shape[1]):
+            im, dm = 0, NEAR_FIELD_CLIP_DST
+
+            offset = 0
+            for i in range(n_prj):
+                prj_h = int(in_const[6 + i])
+                prj_w = int(prj_h * 2)
+
+                s = c_size_y // prj_h
+
+                p_iuv = int(offset + v // s * prj_w + u // s)
+                p_d = in_mlp_d[p_iuv]
+
+                if p_d < dm and in_mlp_e[p_iuv] == in_epoch:
+                    im = p_iuv
+                    dm = p_d
+
+                offset += prj_h * prj_w
+
+            # Every pixel is written, either from the near or the far field
+            if dm < NEAR_FIELD_CLIP_DST:
+                ii = in_mlp_i[im]
+
+                out_canvas[v, u, 0] = in_pcd_rgb[ii, 0]
+                out_canvas[v, u, 1] = in_pcd_rgb[ii, 1]
+                out_canvas[v, u, 2] = in_pcd_rgb[ii, 2]
+            else:
+                out_canvas[v, u, 0] = in_far_field[v, u, 0]
+                out_canvas[v, u, 1] = in_far_field[v, u, 1]
+                out_canvas[v, u, 2] = in_far_field[v, u, 2]
+
+
+@nb.njit(inline='always', nogil=True, cache=True, error_model='numpy')
+def cpu_shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb, v, u):
+    n0 = in_canvas_norms[v, u, 0]
+    n1 = in_canvas_norms[v, u, 1]
+    n2 = in_canvas_norms[v, u, 2]
+    w, r, g, b = 0.0, 0.0, 0.0, 0.0
+
+    for i in range(in_anchor_acc.shape[2]):
+        i_anchor = in_anchor_acc[v, u, i]
+
+        # dot canvas pixel norm with anchor vector to get cos value
+        c = n0 * in_anchor_xyz[i_anchor, 0] + \
+            n1 * in_anchor_xyz[i_anchor, 1] + \
+            n2 * in_anchor_xyz[i_anchor, 2]
+        c = max(c, 0) ** 128
+
+        w += c
+        r += in_anchor_rgb[i_anchor, 0] * c
+        g += in_anchor_rgb[i_anchor, 1] * c
+        b += in_anchor_rgb[i_anchor, 2] * c
+
+    out_far_field[v, u, 0] = r / w
+    out_far_field[v, u, 1] = g / w
+    out_far_field[v, u, 2] = b / w
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_draw_far_field(out_far_field, in_canvas_norms, in_anchor_acc, in_anchor_xyz, in_anchor_rgb):
+    for v in nb.prange(out_far_field.shape[0]):
+        for u in range(out_far_field.shape[1]):
+            cpu_shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc,
+                                in_anchor_xyz, in_anchor_rgb, v, u)
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_draw_far_field_pixels(out_far_field, in_canvas_norms, in_pixels, in_n_pixels,
+                              in_anchor_acc, in_anchor_xyz, in_anchor_rgb):
+    """Redraw only the first `in_n_pixels` listed pixels, given as flat canvas indices."""
+    c_size_x = out_far_field.shape[1]
+
+    for i in nb.prange(in_n_pixels):
+        v = in_pixels[i] // c_size_x
+        u = in_pixels[i] % c_size_x
+
+        cpu_shade_far_field(out_far_field, in_canvas_norms, in_anchor_acc,
+                            in_anchor_xyz, in_anchor_rgb, v, u)
+
+
+@nb.njit(nogil=True, cache=True)
+def collect_anchor_pixels(out_mask, in_pixel_ptr, in_pixel_idx, in_anchors):
+    """Mark the pixels whose far field neighborhood references the anchors.
+
+    `in_pixel_ptr` and `in_pixel_idx` form the inverse anchor to pixel
+    index, the pixels of anchor `a` are `in_pixel_idx[ptr[a]:ptr[a + 1]]`.
+    Returns the number of marked pixels.
+    """
+    n = 0
+    for a in in_anchors:
+        for j in range(in_pixel_ptr[a], in_pixel_ptr[a + 1]):
+            p = in_pixel_idx[j]
+            if not out_mask[p]:
+                out_mask[p] = True
+                n += 1
+
+    return n
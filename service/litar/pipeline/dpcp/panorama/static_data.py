@@ -2,14 +2,24 @@ from __future__ import annotations
 
 import os
 import math
+import threading
 import numpy as np
+from typing import Dict, Tuple
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 import pyreality as pr
 from configs import N_ANCHORS, N_ANCHOR_NEIGHBORS
-from configs import PANORAMA_WIDTH, PANORAMA_HEIGHT
 
 from litar.types import Vector2Int
+from litar.pipeline.artifacts import load_or_build
+from litar.pipeline.backend import as_input_array
 
-# TODO: implement a decorator to wrap these functions
+# Bump this when the generated data changes, so stale artifacts are rebuilt
+STATIC_DATA_VERSION = 1
+
+# Neighbor search settings
+ACC_CHUNK_SIZE = 4096  # directions per chunk
+ACC_N_WORKERS = os.cpu_count() or 1
 
 
 def canvas_equirectangular_panorama(height):
@@ -32,33 +42,117 @@ def canvas_equirectangular_panorama(height):
     return uv_xyz.reshape((height, height * 2, 3))
 
 
+def top_k_anchors(dirs: np.ndarray, anchor_xyz: np.ndarray, k: int,
+                  chunk_size=ACC_CHUNK_SIZE, n_workers=ACC_N_WORKERS) -> np.ndarray:
+    """Find the indices of the k anchors closest to each direction.
+
+    Directions are processed in chunks of `chunk_size` rows, so the peak
+    memory is bounded by `chunk_size * n_anchors` dot products. The chunks
+    are spread over `n_workers` threads, numpy releases the GIL in both
+    the matrix product and the partitioning.
+    """
+    out = np.zeros((dirs.shape[0], k), dtype=np.uint16)
+    anchor_xyz_t = np.ascontiguousarray(anchor_xyz.T)
+
+    def run_chunk(l):
+        r = min(l + chunk_size, dirs.shape[0])
+        t = dirs[l:r] @ anchor_xyz_t
+
+        if k == 1:
+            out[l:r, 0] = np.argmax(t, axis=-1)
+        else:
+            out[l:r] = np.argpartition(t, -k, axis=-1)[:, -k:]
+
+    chunks = range(0, dirs.shape[0], chunk_size)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(run_chunk, chunks))
+    else:
+        for l in chunks:
+            run_chunk(l)
+
+    return out
+
+
 def generate_anchor_acc(p_size: Vector2Int):
     canvas = canvas_equirectangular_panorama(p_size.y)
     anchor_xyz = pr.fibonacci_sphere(N_ANCHORS)
 
-    # if os.path.exists(f'./tmp/anchor_acc_{N_ANCHORS}.npy'):
-    #     print('Loading far field acceleration data...')
-    #     return canvas, anchor_xyz, np.load(f'./tmp/anchor_acc_{N_ANCHORS}.npy')
-
     print('Generating far field acceleration data...')
     n_samples = N_ANCHOR_NEIGHBORS
-    anchor_acc = np.zeros((p_size.y, p_size.x, n_samples), dtype=np.uint16)
+    anchor_acc = top_k_anchors(canvas.reshape((-1, 3)), anchor_xyz, n_samples)
+    anchor_acc = anchor_acc.reshape((p_size.y, p_size.x, n_samples))
+
+    return canvas, anchor_xyz, anchor_acc
 
-    for v in range(p_size.y):
-        for u in range(p_size.x):
-            anchor_acc[v, u] = np.argpartition(
-                canvas[v, u] @ anchor_xyz.T, -n_samples, axis=-1)[-n_samples:]
 
-    # np.save(f'./tmp/anchor_acc_{N_ANCHORS}.npy', anchor_acc)
+def load_anchor_acc(p_size: Vector2Int):
+    """Load canvas normals, anchors and anchor neighbors from the artifact store."""
+    key = {
+        'n': N_ANCHORS,
+        'k': N_ANCHOR_NEIGHBORS,
+        'w': p_size.x,
+        'h': p_size.y,
+        'v': STATIC_DATA_VERSION
+    }
+
+    canvas = load_or_build(
+        'canvas', key,
+        lambda: canvas_equirectangular_panorama(p_size.y).astype(np.float32))
+    anchor_xyz = load_or_build(
+        'anchor_xyz', key,
+        lambda: pr.fibonacci_sphere(N_ANCHORS))
+    anchor_acc = load_or_build(
+        'anchor_acc', key,
+        lambda: generate_anchor_acc(p_size)[2])
 
     return canvas, anchor_xyz, anchor_acc
 
 
-def make_acc_grid(n_anchors, v_acc_grid):
-    if os.path.exists(f'./tmp/acc_grid_{n_anchors}.npy'):
-        print('Loading acceleration grid...')
-        return np.load(f'./tmp/acc_grid_{n_anchors}.npy')
+def generate_anchor_pixels(anchor_acc: np.ndarray):
+    """Invert `anchor_acc` into a CSR index from anchors to canvas pixels.
+
+    The pixels referencing anchor `a` are `idx[ptr[a]:ptr[a + 1]]`, given
+    as flat canvas indices in ascending order.
+    """
+    k = anchor_acc.shape[-1]
+    flat = np.asarray(anchor_acc).reshape(-1)
+
+    order = np.argsort(flat, kind='stable')
+    idx = (order // k).astype(np.int32)
+
+    ptr = np.zeros(N_ANCHORS + 1, dtype=np.int64)
+    np.cumsum(np.bincount(flat, minlength=N_ANCHORS), out=ptr[1:])
+
+    return ptr, idx
+
+
+def load_anchor_pixels(p_size: Vector2Int, anchor_acc: np.ndarray):
+    """Load the inverse anchor to pixel index from the artifact store."""
+    key = {
+        'n': N_ANCHORS,
+        'k': N_ANCHOR_NEIGHBORS,
+        'w': p_size.x,
+        'h': p_size.y,
+        'v': STATIC_DATA_VERSION
+    }
 
+    inverse = []  # built at most once for both artifacts
+
+    def build(i):
+        if not inverse:
+            inverse.extend(generate_anchor_pixels(anchor_acc))
+        return inverse[i]
+
+    pixel_ptr = load_or_build('anchor_pixel_ptr', key, lambda: build(0))
+    pixel_idx = load_or_build('anchor_pixel_idx', key, lambda: build(1))
+
+    return pixel_ptr, pixel_idx
+
+
+def generate_acc_grid(n_anchors, v_acc_grid):
+    print('Generating acceleration grid...')
     anchors = pr.fibonacci_sphere(n_anchors)
 
     v = np.arange(v_acc_grid)
@@ -75,17 +169,60 @@ def make_acc_grid(n_anchors, v_acc_grid):
     uvr_cart = pr.spherical_to_cartesian(uvr_flat)
 
     # Build cache grid
-    uvr_neighbors = np.array([np.argmax(anchors @ uvr_cart[i])
-                             for i in range(uvr_cart.shape[0])])
-    acc_grid = uvr_neighbors.reshape(v_acc_grid, v_acc_grid * 2)
-
-    np.save(f'./tmp/acc_grid_{n_anchors}.npy', acc_grid)
+    uvr_neighbors = top_k_anchors(uvr_cart, anchors, 1)
+    acc_grid = uvr_neighbors.reshape(v_acc_grid, v_acc_grid * 2).astype(int)
 
     return acc_grid
 
 
-acc_grid = make_acc_grid(N_ANCHORS, PANORAMA_HEIGHT)
+def make_acc_grid(n_anchors, v_acc_grid):
+    key = {'n': n_anchors, 'h': v_acc_grid, 'v': STATIC_DATA_VERSION}
+
+    return load_or_build(
+        'acc_grid', key,
+        lambda: generate_acc_grid(n_anchors, v_acc_grid))
+
+
+@dataclass
+class PanoramaStaticData:
+    """Read-only data shared by all renderers of the same panorama size."""
+    canvas_size: Vector2Int
+    canvas: np.ndarray
+    anchor_xyz: np.ndarray
+    anchor_acc: np.ndarray
+    acc_grid: np.ndarray
+    anchor_pixel_ptr: np.ndarray  # inverse of anchor_acc, see generate_anchor_pixels
+    anchor_pixel_idx: np.ndarray
+
+    __inputs: Dict[Tuple[str, str], np.ndarray] = field(
+        default_factory=dict, init=False, repr=False)
+
+    def input_array(self, name: str, backend: str) -> np.ndarray:
+        """Get a static array prepared for the backend kernels, shared by all sessions."""
+        with _lock:
+            if (name, backend) not in self.__inputs:
+                self.__inputs[(name, backend)] = as_input_array(
+                    backend, getattr(self, name))
+
+            return self.__inputs[(name, backend)]
+
+
+_lock = threading.RLock()
+_static_data: Dict[Tuple[int, int], PanoramaStaticData] = {}
+
+
+def get_static_data(canvas_size: Vector2Int) -> PanoramaStaticData:
+    """Lazily load the static data of a panorama size, once per process."""
+    key = (canvas_size.x, canvas_size.y)
+
+    with _lock:
+        if key not in _static_data:
+            canvas, anchor_xyz, anchor_acc = load_anchor_acc(canvas_size)
+            acc_grid = make_acc_grid(N_ANCHORS, canvas_size.y)
+            pixel_ptr, pixel_idx = load_anchor_pixels(canvas_size, anchor_acc)
 
+            _static_data[key] = PanoramaStaticData(
+                canvas_size, canvas, anchor_xyz, anchor_acc, acc_grid,
+                pixel_ptr, pixel_idx)
 
-canvas_size = Vector2Int(PANORAMA_WIDTH, PANORAMA_HEIGHT)
-canvas, anchor_xyz, anchor_acc = generate_anchor_acc(canvas_size)
+        return _static_data[key]
@@ -0,0 +1,49 @@
+"""Compact lighting representations computed from the far field anchors."""
+from __future__ import annotations
+
+import numpy as np
+import pyreality as pr
+
+
+def anchor_spherical_harmonics(anchor_xyz: np.ndarray, anchor_rgb: np.ndarray) -> np.ndarray:
+    """Project anchor colors onto second order spherical harmonics.
+
+    Anchors are evenly spread over the sphere, so they are used directly as
+    Monte Carlo samples. Returns float32 coefficients of shape (3, 9), one
+    row per RGB channel in [0, 1] scale.
+    """
+    points = pr.PointCloud(
+        np.asarray(anchor_xyz, dtype=np.float32),
+        np.asarray(anchor_rgb, dtype=np.float32) / 255)
+    sh = pr.SphericalHarmonics.from_sphere_points(points, degrees=2)
+
+    return sh.coefficients.astype(np.float32)
+
+
+def anchor_dominant_light(anchor_xyz: np.ndarray, anchor_rgb: np.ndarray,
+                          sh_coefficients: np.ndarray = None, cone_cos=0.9):
+    """Extract a dominant directional light and an ambient color.
+
+    The direction follows the luminance of the first order spherical
+    harmonics band, the light color is the average of the anchors inside
+    a cone around it, and the ambient color is the average of all anchors.
+    Returns float32 (direction (3), color (3), ambient (3)), colors in [0, 1].
+    """
+    anchor_xyz = np.asarray(anchor_xyz, dtype=np.float32)
+    anchor_rgb = np.asarray(anchor_rgb, dtype=np.float32) / 255
+
+    if sh_coefficients is None:
+        sh_coefficients = anchor_spherical_harmonics(anchor_xyz, anchor_rgb * 255)
+
+    lum = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32) @ sh_coefficients
+
+    # SH basis order: 1 -> y, 2 -> z, 3 -> x
+    direction = np.array([lum[3], lum[1], lum[2]], dtype=np.float32)
+    norm = np.linalg.norm(direction)
+    direction = direction / norm if norm > 0 else np.array([0, 1, 0], dtype=np.float32)
+
+    m = anchor_xyz @ direction > cone_cos
+    color = anchor_rgb[m].mean(axis=0) if np.any(m) else anchor_rgb.mean(axis=0)
+    ambient = anchor_rgb.mean(axis=0)
+
+    return direction, color.astype(np.float32), ambient.astype(np.float32)
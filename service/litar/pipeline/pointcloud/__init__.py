@@ -1 +1,3 @@
 from .generation import ManagedPointCloudGenerator
+from .fusion import FusedPointStore
+from .batch import PointCloudBatch
@@ -0,0 +1,106 @@
+import numpy as np
+from numba import cuda
+from numba.cuda.cudadrv.devicearray import ManagedNDArray
+from typing import List, Tuple
+
+from litar.types import Vector2Int
+from litar.pipeline.backend import BACKEND_CUDA
+from litar.pipeline.backend import alloc_array
+from litar.pipeline.backend import resolve_backend
+from litar.pipeline.backend import cpu_launch
+from litar.pipeline.pointcloud.generation import ManagedPointCloudGenerator
+from litar.pipeline.pointcloud.kernels import cuda_gen_pcd_batch
+from litar.pipeline.pointcloud.kernels import cpu_gen_pcd_batch
+
+# (generator, view slot, trs, depth, y, cbcr), as the arguments of `ManagedPointCloudGenerator.exec`
+BatchFrame = Tuple[ManagedPointCloudGenerator, int, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class PointCloudBatch:
+    """Generate the points of near field keyframes of several generators at once.
+
+    The generators share the image sizes of the batch. Their inputs are
+    stacked into the batch buffers, and each frame is written straight into
+    the slot of its own generator, at its offset. A batch is one launch and
+    one synchronization, instead of one of each per frame.
+
+    The kernel takes the generator outputs as tuples padded to `max_size`, so
+    it is only compiled once per batch size.
+    """
+    arg_in_const: ManagedNDArray
+    arg_in_offset: ManagedNDArray  # first point of each frame in its generator
+    arg_in_cam_mat: ManagedNDArray  # camera matrix and trs of each frame
+
+    arg_in_depth: ManagedNDArray
+    arg_in_y: ManagedNDArray
+    arg_in_cbcr: ManagedNDArray
+
+    max_size: int
+    backend: str
+
+    __n_points: int
+
+    def __init__(self, dn_size: Vector2Int, c_size: Vector2Int, max_size: int,
+                 backend: str = None) -> None:
+        self.backend = resolve_backend(backend)
+        self.max_size = max_size
+
+        self.arg_in_const = alloc_array(self.backend, (10), np.float32)
+        self.arg_in_const[0] = c_size.x
+        self.arg_in_const[1] = c_size.y
+        self.arg_in_const[2] = 0  # Offsets are per frame
+        self.arg_in_const[3] = c_size.x / dn_size.x
+
+        self.arg_in_offset = alloc_array(self.backend, (max_size), np.int64)
+        self.arg_in_cam_mat = alloc_array(self.backend, (max_size, 4 + 12), np.float32)
+
+        self.arg_in_depth = alloc_array(
+            self.backend, (max_size, dn_size.x * dn_size.y), np.float32)
+
+        self.arg_in_y = alloc_array(
+            self.backend, (max_size, c_size.y, c_size.x), np.uint8)
+        self.arg_in_cbcr = alloc_array(
+            self.backend, (max_size, c_size.y // 2, c_size.x // 2, 2), np.uint8)
+
+        self.__n_points = c_size.x * c_size.y
+
+    def exec(self, frames: List[BatchFrame]):
+        """Generate the point clouds of up to `max_size` frames."""
+        n_batch = len(frames)
+        if n_batch > self.max_size:
+            raise ValueError(
+                f'Batch of {n_batch} frames, at most {self.max_size} expected')
+
+        for b, (generator, i_view, trs, depth, y, cbcr) in enumerate(frames):
+            generator.select_view(i_view)
+
+            self.arg_in_offset[b] = int(generator.arg_in_const[2])
+            self.arg_in_cam_mat[b, :4] = generator.arg_in_cam_mat[:4]
+            self.arg_in_cam_mat[b, 4:] = trs
+            self.arg_in_depth[b] = depth
+            self.arg_in_y[b] = y
+            self.arg_in_cbcr[b] = cbcr
+
+        padding = [frames[0][0]] * (self.max_size - n_batch)
+        generators = [f[0] for f in frames] + padding
+
+        out_xyz = tuple([g.arg_out_pcd_xyz for g in generators])
+        out_rgb = tuple([g.arg_out_pcd_rgb for g in generators])
+
+        if self.backend != BACKEND_CUDA:
+            with cpu_launch():
+                cpu_gen_pcd_batch(
+                    out_xyz, out_rgb, self.arg_in_const, self.arg_in_offset,
+                    self.arg_in_cam_mat, self.arg_in_depth,
+                    self.arg_in_y, self.arg_in_cbcr, n_batch)
+            return
+
+        n_thread = 1024
+        n_block = (n_batch * self.__n_points + (n_thread - 1)) // n_thread
+
+        cuda_gen_pcd_batch[n_block, n_thread](
+            out_xyz, out_rgb, self.arg_in_const, self.arg_in_offset,
+            self.arg_in_cam_mat, self.arg_in_depth,
+            self.arg_in_y, self.arg_in_cbcr, n_batch)
+
+        cuda.current_context().synchronize()
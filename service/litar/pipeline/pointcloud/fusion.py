@@ -0,0 +1,218 @@
+import numpy as np
+from typing import NamedTuple, Tuple
+from numba.cuda.cudadrv.devicearray import ManagedNDArray
+
+from configs import NEAR_FIELD_INITIAL_POINTS
+from configs import NEAR_FIELD_SIZE_HALF
+
+from litar.pipeline.backend import alloc_array
+from litar.pipeline.backend import resolve_backend
+from litar.pipeline.pointcloud.kernels import voxel_hash_lookup
+from litar.pipeline.pointcloud.kernels import voxel_hash_insert
+from litar.pipeline.pointcloud.kernels import voxel_hash_remove
+
+
+def hash_table_size(max_points: int) -> int:
+    """Entries of a voxel hash for `max_points`, a power of two at least twice as many."""
+    return 1 << int(max(2 * max_points - 1, 1)).bit_length()
+
+
+def initial_capacity(max_points: int, capacity: int) -> int:
+    return int(max(min(capacity, max_points), 1))
+
+
+class FusedInsertion(NamedTuple):
+    i_begin: int  # range of appended points
+    i_end: int
+    recycled: bool  # existing points were replaced
+    keys: np.ndarray  # voxels observed by the insertion
+
+
+class FusedPointStore:
+    """Near field points deduplicated in a voxel hash.
+
+    Every occupied voxel holds a single point, so the memory is bounded by
+    the scene size instead of the number of views. A voxel keeps the first
+    point observed in it, while its color follows the latest observation.
+    New points are appended, which keeps an incremental projection valid.
+    Once `max_points` is reached, the least recently observed voxels are
+    recycled. Insertions are stamped with increasing values, which
+    identify the latest observation of each voxel.
+
+    The buffers start out with room for `capacity` points, and double
+    whenever appended points don't fit, up to `max_points`. Points keep
+    their slots when the buffers grow.
+
+    The hash is an open addressing table at most half full, so inserting
+    or expiring a view costs the size of the view, not of the store.
+    """
+    backend: str
+    voxel_size: float
+    max_points: int
+    capacity: int  # points the buffers have room for
+    n_points: int
+
+    arg_out_pcd_xyz: ManagedNDArray
+    arg_out_pcd_rgb: ManagedNDArray
+
+    __n_voxels: int  # voxels per axis
+    __slot_key: np.ndarray  # voxel key of each slot
+    __slot_stamp: np.ndarray  # last insertion observing each slot
+    __table_key: np.ndarray  # voxel hash, key and slot of each entry
+    __table_slot: np.ndarray
+
+    def __init__(self, voxel_size: float, max_points: int, backend: str = None,
+                 capacity: int = NEAR_FIELD_INITIAL_POINTS) -> None:
+        self.backend = resolve_backend(backend)
+        self.voxel_size = voxel_size
+        self.max_points = max_points
+        self.capacity = 0
+        self.n_points = 0
+
+        self.__n_voxels = int(np.ceil(NEAR_FIELD_SIZE_HALF * 2 / voxel_size))
+        self.__allocate(initial_capacity(max_points, capacity))
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the store, growing with its capacity."""
+        buffers = [
+            self.arg_out_pcd_xyz, self.arg_out_pcd_rgb,
+            self.__slot_key, self.__slot_stamp,
+            self.__table_key, self.__table_slot]
+
+        return sum([b.nbytes for b in buffers])
+
+    @staticmethod
+    def estimate_nbytes(max_points: int, capacity: int = NEAR_FIELD_INITIAL_POINTS) -> int:
+        """Bytes a new store allocates, before it grows."""
+        capacity = initial_capacity(max_points, capacity)
+        return capacity * (3 * 4 + 3 + 8 + 4) + hash_table_size(capacity) * (8 + 4)
+
+    def __allocate(self, capacity: int) -> None:
+        """Move the points into buffers with room for `capacity` points, and rehash them."""
+        n = self.n_points
+
+        xyz = alloc_array(self.backend, (capacity, 3), np.float32)
+        rgb = alloc_array(self.backend, (capacity, 3), np.uint8)
+        slot_key = np.full(capacity, -1, dtype=np.int64)
+        slot_stamp = np.zeros(capacity, dtype=np.int32)
+
+        if n > 0:
+            xyz[:n] = self.arg_out_pcd_xyz[:n]
+            rgb[:n] = self.arg_out_pcd_rgb[:n]
+            slot_key[:n] = self.__slot_key[:n]
+            slot_stamp[:n] = self.__slot_stamp[:n]
+
+        self.arg_out_pcd_xyz, self.arg_out_pcd_rgb = xyz, rgb
+        self.__slot_key, self.__slot_stamp = slot_key, slot_stamp
+
+        n_entries = hash_table_size(capacity)
+        self.__table_key = np.full(n_entries, -1, dtype=np.int64)
+        self.__table_slot = np.zeros(n_entries, dtype=np.int32)
+        voxel_hash_insert(self.__table_key, self.__table_slot,
+                          slot_key[:n], np.arange(n, dtype=np.int32))
+
+        self.capacity = capacity
+
+    def __reserve(self, n_points: int) -> None:
+        """Double the capacity until `n_points` points fit."""
+        capacity = self.capacity
+        while capacity < n_points:
+            capacity *= 2
+
+        if capacity > self.capacity:
+            self.__allocate(min(capacity, self.max_points))
+
+    def voxel_keys(self, xyz: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Hash points into voxel keys, returns the keys and the valid points mask."""
+        ijk = np.floor((xyz + NEAR_FIELD_SIZE_HALF) / self.voxel_size)
+        m = np.all((ijk >= 0) & (ijk < self.__n_voxels), axis=-1)
+        m &= np.any(xyz != 0, axis=-1)  # unfilled points sit at the origin
+
+        ijk = ijk[m].astype(np.int64)
+        n = self.__n_voxels
+        return (ijk[:, 0] * n + ijk[:, 1]) * n + ijk[:, 2], m
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the slots of voxels, returns the found mask and their slots."""
+        slots = np.empty(len(keys), dtype=np.int64)
+        voxel_hash_lookup(self.__table_key, self.__table_slot,
+                          np.ascontiguousarray(keys, dtype=np.int64), slots)
+
+        found = slots >= 0
+        return found, slots[found]
+
+    def insert(self, xyz: np.ndarray, rgb: np.ndarray, stamp: int) -> FusedInsertion:
+        """Fuse the points of a view into the store.
+
+        Existing points are recycled when the store is full, in which case
+        the whole store has to be projected again.
+        """
+        keys, m = self.voxel_keys(np.asarray(xyz))
+        xyz, rgb = np.asarray(xyz)[m], np.asarray(rgb)[m]
+
+        # Deduplicate within the view, keeping the last point of a voxel
+        keys, i_last = np.unique(keys[::-1], return_index=True)
+        i_last = len(xyz) - 1 - i_last
+        xyz, rgb = xyz[i_last], rgb[i_last]
+
+        # Refresh the colors of known voxels
+        found, slots = self.lookup(keys)
+        self.arg_out_pcd_rgb[slots] = rgb[found]
+        self.__slot_stamp[slots] = stamp
+
+        # Append new voxels, recycling the stalest slots once full
+        new_keys, new_xyz, new_rgb = keys[~found], xyz[~found], rgb[~found]
+        n_new = min(len(new_keys), self.max_points)
+        n_append = min(n_new, self.max_points - self.n_points)
+
+        i_begin = self.n_points
+        self.__reserve(i_begin + n_append)
+        slots = np.arange(i_begin, i_begin + n_append)
+        self.n_points += n_append
+
+        recycled = n_new > n_append
+        if recycled:
+            stamps = self.__slot_stamp[:i_begin]
+            stale = np.argpartition(stamps, n_new - n_append - 1)
+            stale = stale[:n_new - n_append]
+            voxel_hash_remove(self.__table_key, self.__table_slot, self.__slot_key[stale])
+            slots = np.concatenate((slots, stale))
+
+        voxel_hash_insert(self.__table_key, self.__table_slot, new_keys[:n_new], slots)
+        self.__slot_key[slots] = new_keys[:n_new]
+        self.__slot_stamp[slots] = stamp
+        self.arg_out_pcd_xyz[slots] = new_xyz[:n_new]
+        self.arg_out_pcd_rgb[slots] = new_rgb[:n_new]
+
+        return FusedInsertion(i_begin, self.n_points, recycled, keys)
+
+    def expire(self, keys: np.ndarray, stamp: int) -> int:
+        """Remove the voxels last observed by the insertion `stamp`.
+
+        The store is kept compact by moving its last points into the freed
+        slots, so the whole store has to be projected again afterwards.
+        Returns the number of removed points.
+        """
+        found, slots = self.lookup(keys)
+        slots = np.unique(slots[self.__slot_stamp[slots] == stamp])
+        if len(slots) == 0:
+            return 0
+
+        n_keep = self.n_points - len(slots)
+        holes = slots[slots < n_keep]
+        tail = np.arange(n_keep, self.n_points)
+        tail = tail[~np.isin(tail, slots, assume_unique=True)]
+
+        voxel_hash_remove(self.__table_key, self.__table_slot, self.__slot_key[slots])
+        voxel_hash_insert(self.__table_key, self.__table_slot, self.__slot_key[tail], holes)
+
+        self.__slot_key[holes] = self.__slot_key[tail]
+        self.__slot_stamp[holes] = self.__slot_stamp[tail]
+        self.arg_out_pcd_xyz[holes] = self.arg_out_pcd_xyz[tail]
+        self.arg_out_pcd_rgb[holes] = self.arg_out_pcd_rgb[tail]
+
+        self.__slot_key[n_keep:self.n_points] = -1
+        self.n_points = n_keep
+
+        return len(slots)
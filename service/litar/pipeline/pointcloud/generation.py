@@ -6,10 +6,16 @@ from numba import cuda
 from numba.cuda.cudadrv.devicearray import ManagedNDArray
 
 from litar.types import Vector2Int
-from litar.pipeline.pointcloud.kernels import cuda_gen_pcd_xyz
-from litar.pipeline.pointcloud.kernels import cuda_gen_pcd_rgb
-
-from profilehooks import profile, timecall
+from litar.pipeline.backend import BACKEND_CUDA
+from litar.pipeline.backend import alloc_array
+from litar.pipeline.backend import as_kernel_input
+from litar.pipeline.backend import resolve_backend
+from litar.pipeline.backend import cpu_launch
+from litar.pipeline.pointcloud.kernels import cuda_gen_pcd
+from litar.pipeline.pointcloud.kernels import cpu_gen_pcd
+from litar.pipeline.pointcloud.kernels import cuda_bin_to_anchors
+from litar.pipeline.pointcloud.kernels import cpu_bin_to_anchors
+from litar.pipeline.pointcloud.kernels import ANCHOR_KEY_EMPTY
 
 
 class ManagedPointCloudGenerator:
@@ -23,106 +29,176 @@ class ManagedPointCloudGenerator:
     arg_out_pcd_xyz: ManagedNDArray
     arg_out_pcd_rgb: ManagedNDArray
 
+    backend: str
+
     __n_points: int
     __c_size: Vector2Int
     __dn_size: Vector2Int
 
+    __anchor_key: np.ndarray  # nearest point key of each anchor
+    __tmp_anchor: np.ndarray  # CPU binning scratch buffers
+    __tmp_key: np.ndarray
+
+    def __init__(self, k: np.ndarray, dn_size: Vector2Int, c_size: Vector2Int, n_views: int,
+                 backend: str = None) -> None:
+        self.backend = resolve_backend(backend)
 
-    def __init__(self, k: np.ndarray, dn_size: Vector2Int, c_size: Vector2Int, n_views: int) -> None:
         self.__c_size = c_size
         self.__dn_size = dn_size
 
-        self.arg_in_const = self.arg_in_const = cuda.managed_array(
-            (10), dtype=np.float32)
+        self.arg_in_const = alloc_array(self.backend, (10), np.float32)
         self.arg_in_const[0] = c_size.x
         self.arg_in_const[1] = c_size.y
         self.arg_in_const[2] = 0  # Offset
         self.arg_in_const[3] = c_size.x / dn_size.x
 
-        self.arg_in_cam_mat = cuda.managed_array(4 + 12, dtype=np.float32)
+        self.arg_in_cam_mat = alloc_array(self.backend, 4 + 12, np.float32)
         self.arg_in_cam_mat[:4] = k
 
-        self.arg_in_depth = cuda.managed_array((dn_size.x * dn_size.y),
-                                               dtype=np.float32)
+        self.arg_in_depth = alloc_array(
+            self.backend, (dn_size.x * dn_size.y), np.float32)
 
-        self.arg_in_y = cuda.managed_array(
-            (c_size.y, c_size.x), dtype=np.uint8)
-        self.arg_in_cbcr = cuda.managed_array(
-            (c_size.y // 2, c_size.x // 2, 2), dtype=np.uint8)
+        self.arg_in_y = alloc_array(
+            self.backend, (c_size.y, c_size.x), np.uint8)
+        self.arg_in_cbcr = alloc_array(
+            self.backend, (c_size.y // 2, c_size.x // 2, 2), np.uint8)
 
         self.__n_points = c_size.x * c_size.y
-        self.arg_out_pcd_xyz = cuda.managed_array(
-            (n_views * self.__n_points, 3), dtype=np.float32)
-        self.arg_out_pcd_rgb = cuda.managed_array(
-            (n_views * self.__n_points, 3), dtype=np.uint8)
+        self.arg_out_pcd_xyz = alloc_array(
+            self.backend, (n_views * self.__n_points, 3), np.float32)
+        self.arg_out_pcd_rgb = alloc_array(
+            self.backend, (n_views * self.__n_points, 3), np.uint8)
+
+        self.__anchor_key = None
+        self.__tmp_anchor = np.empty(0, dtype=np.int64)
+        self.__tmp_key = np.empty(0, dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the buffers of this generator."""
+        buffers = [
+            self.arg_in_const, self.arg_in_cam_mat, self.arg_in_depth,
+            self.arg_in_y, self.arg_in_cbcr,
+            self.arg_out_pcd_xyz, self.arg_out_pcd_rgb,
+            self.__tmp_anchor, self.__tmp_key]
+
+        if self.__anchor_key is not None:
+            buffers.append(self.__anchor_key)
+
+        return sum([b.nbytes for b in buffers])
+
+    @staticmethod
+    def estimate_nbytes(dn_size: Vector2Int, c_size: Vector2Int, n_views: int) -> int:
+        """Bytes a new generator allocates, before its scratch buffers grow."""
+        c_w, c_h = int(c_size.x), int(c_size.y)
+        return 4 * (10 + 16) + 4 * int(dn_size.x) * int(dn_size.y) + \
+            c_w * c_h + (c_h // 2) * (c_w // 2) * 2 + \
+            int(n_views) * c_w * c_h * 3 * (4 + 1)
+
+    @property
+    def c_size(self) -> Vector2Int:
+        return self.__c_size
+
+    @property
+    def dn_size(self) -> Vector2Int:
+        return self.__dn_size
+
+    def select_view(self, i_view: int):
+        """Point the generation and the sampling at the slot of a view."""
+        self.arg_in_const[2] = float(i_view * self.__n_points)
 
     def exec(self, i_view: int, trs: np.ndarray, depth: np.ndarray,
              y: np.ndarray, cbcr: np.ndarray):
         """
         Generate point cloud based on a client uploaded
         near field data package
+
+        The inputs are read in place when the backend allows it, e.g. the
+        CPU kernels read views into the package, and are otherwise copied
+        into the input buffers once.
         """
 
-        self.arg_in_const[2] = float(i_view * self.__n_points)
+        self.select_view(i_view)
+
+        if self.backend != BACKEND_CUDA:
+            self.exec_cpu(trs, depth, y, cbcr)
+            return
 
-        # Generate Point Cloud XYZ
+        # Generate Point Cloud XYZ and RGB in one pass over the frame
         n_thread = min(1024, self.__n_points)
         n_block = (self.__n_points + (n_thread - 1)) // n_thread
 
         self.arg_in_cam_mat[4:] = trs
-        self.arg_in_depth[:] = depth
 
-        cuda_gen_pcd_xyz[n_block, n_thread](
+        cuda_gen_pcd[n_block, n_thread](
             self.arg_out_pcd_xyz,
+            self.arg_out_pcd_rgb,
             self.arg_in_const,
             self.arg_in_cam_mat,
-            self.arg_in_depth)
+            as_kernel_input(self.backend, depth, self.arg_in_depth),
+            as_kernel_input(self.backend, y, self.arg_in_y),
+            as_kernel_input(self.backend, cbcr, self.arg_in_cbcr))
 
         cuda.current_context().synchronize()
 
-        # Generate Point Cloud RGB
-        n_thread = (min(32, self.__dn_size.x), min(32, self.__dn_size.y))
-        n_block = (self.__c_size.x // n_thread[0],
-                   self.__c_size.y // n_thread[1])
-
-        self.arg_in_y[::] = y
-        self.arg_in_cbcr[::] = cbcr
-
-        cuda_gen_pcd_rgb[n_block, n_thread](
-            self.arg_out_pcd_rgb,
-            self.arg_in_const,
-            self.arg_in_y,
-            self.arg_in_cbcr)
-
-        cuda.current_context().synchronize()
+    def exec_cpu(self, trs: np.ndarray, depth: np.ndarray,
+                 y: np.ndarray, cbcr: np.ndarray):
+        """Multi-threaded CPU counterpart of the CUDA kernel in `exec`."""
+        self.arg_in_cam_mat[4:] = trs
 
-    def sample_to_anchor(self, anchor_xyz, downsample_rate=200, filter_surroundings=False):
+        with cpu_launch():
+            cpu_gen_pcd(
+                self.arg_out_pcd_xyz,
+                self.arg_out_pcd_rgb,
+                self.arg_in_const,
+                self.arg_in_cam_mat,
+                as_kernel_input(self.backend, depth, self.arg_in_depth),
+                as_kernel_input(self.backend, y, self.arg_in_y),
+                as_kernel_input(self.backend, cbcr, self.arg_in_cbcr))
+
+    def sample_to_anchor(self, anchor_xyz, acc_grid, downsample_rate=200, filter_surroundings=False):
         """Sparsely sample a point cloud to paint anchor colors.
 
-        Note: This is a CPU-based implementation, the performance might be slow.
+        Each sampled point is binned to its anchor through the direction to
+        anchor acceleration grid, and the nearest point of each anchor wins.
+        Returns the mask of painted anchors and their colors.
         """
         c_offset = int(self.arg_in_const[2])
-        l, r = c_offset, c_offset + self.__n_points
+        n_anchors = anchor_xyz.shape[0]
+        n_samples = (self.__n_points + downsample_rate - 1) // downsample_rate
+
+        # Anchors to skip, surroundings are the last quarter of the anchors
+        i_min_anchor = int(n_anchors * 3 / 4) + 1 if filter_surroundings else 0
 
-        spc_xyz = np.asarray(self.arg_out_pcd_xyz[l:r:downsample_rate, :])
-        spc_xyz_mag = np.linalg.norm(spc_xyz, axis=-1, keepdims=True)
-        spc_xyz = spc_xyz / spc_xyz_mag
+        if self.__anchor_key is None or self.__anchor_key.shape[0] != n_anchors:
+            self.__anchor_key = alloc_array(self.backend, (n_anchors), np.uint64)
+        self.__anchor_key.fill(ANCHOR_KEY_EMPTY)
 
-        spc_rgb = np.asarray(self.arg_out_pcd_rgb[l:r:downsample_rate, :])
+        if self.backend != BACKEND_CUDA:
+            if self.__tmp_anchor.shape[0] < n_samples:
+                self.__tmp_anchor = np.empty(n_samples, dtype=np.int64)
+                self.__tmp_key = np.empty(n_samples, dtype=np.uint64)
 
-        t = anchor_xyz @ spc_xyz.T
+            with cpu_launch():
+                cpu_bin_to_anchors(
+                    self.__anchor_key, acc_grid, anchor_xyz, self.arg_out_pcd_xyz,
+                    c_offset, n_samples, downsample_rate, i_min_anchor,
+                    self.__tmp_anchor, self.__tmp_key)
+        else:
+            n_thread = 1024
+            n_block = (n_samples + (n_thread - 1)) // n_thread
 
-        # find the distance relationship between anchor sparse points
-        i_rgb_to_anchor = np.argmax(t, axis=-1)
+            cuda_bin_to_anchors[n_block, n_thread](
+                self.__anchor_key, acc_grid, anchor_xyz, self.arg_out_pcd_xyz,
+                c_offset, n_samples, downsample_rate, i_min_anchor)
 
-        # Select the nearest anchor, and paint
-        # this is NOT accurate, but should be good enough
-        m = np.max(t, axis=-1) > 0.99
+            cuda.current_context().synchronize()
 
-        if filter_surroundings:
-            m = m & (np.arange(len(m)) > (len(m) * 3 / 4))
+        key = np.asarray(self.__anchor_key)
+        m = key != ANCHOR_KEY_EMPTY
+        i_pcd = c_offset + (key[m] & 0xFFFFFFFF).astype(np.int64) * downsample_rate
 
-        return m, spc_rgb[i_rgb_to_anchor[m]]
+        return m, np.asarray(self.arg_out_pcd_rgb)[i_pcd]
 
     def sparse_sample(self, downsample_rate=100):
         """Sparsely sample a point cloud to paint anchor colors
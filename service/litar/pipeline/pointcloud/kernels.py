@@ -5,27 +5,19 @@ from numba import cuda
 from configs import NEAR_FIELD_CLIP_DST
 
 
-@cuda.jit()
-def cuda_gen_pcd_xyz(out_xyz, in_const, in_cam_matrix, in_depth):
-    i = cuda.grid(1)
-
-    c_frame_width = int(in_const[0])
-    c_frame_height = int(in_const[1])
-    c_offset = int(in_const[2])
-    c_upsample_rate = in_const[3]
-
+def point_xyz(out_xyz, i_out, i, c_frame_width, c_frame_height, c_upsample_rate,
+              in_cam_matrix, in_depth):
+    """Unproject pixel `i` of a color frame into row `i_out` of the point cloud."""
     depth_width = int(c_frame_width / c_upsample_rate)
     depth_height = int(c_frame_height / c_upsample_rate)
 
-    if i >= out_xyz.shape[0]:
-        return
+    fx, fy, cx, cy = in_cam_matrix[0], in_cam_matrix[1], \
+        in_cam_matrix[2], in_cam_matrix[3]
+    ctw = in_cam_matrix[4:]
 
     u = nb.float32(i % c_frame_width)
     v = c_frame_height - nb.float32(i // c_frame_width)
 
-    fx, fy, cx, cy = in_cam_matrix[:4]
-    ctw = in_cam_matrix[4:]
-
     # Upsample depth bi-linear
     dx = (i % c_frame_width) / c_upsample_rate
     dy = (i // c_frame_width) / c_upsample_rate
@@ -65,31 +57,253 @@ def cuda_gen_pcd_xyz(out_xyz, in_const, in_cam_matrix, in_depth):
 
     # OMG, Numba doesn't support vectorized type
     # And it doesn't support matmul either???
-    out_xyz[c_offset + i, 0] = ctw[0] * x + \
+    out_xyz[i_out, 0] = ctw[0] * x + \
         ctw[1] * y + ctw[2] * z + ctw[3] * 1
-    out_xyz[c_offset + i, 1] = ctw[4] * x + \
+    out_xyz[i_out, 1] = ctw[4] * x + \
         ctw[5] * y + ctw[6] * z + ctw[7] * 1
-    out_xyz[c_offset + i, 2] = ctw[8] * x + \
+    out_xyz[i_out, 2] = ctw[8] * x + \
         ctw[9] * y + ctw[10] * z + ctw[11] * 1
 
 
+def point_rgb(out_rgb, i_out, y, cb, cr):
+    """Convert a YCbCr pixel into row `i_out` of the point colors."""
+    out_rgb[i_out, 0] = nb.uint8(
+        min(max(y + 1.40200 * (cr - 0x80), 0), 255))
+    out_rgb[i_out, 1] = nb.uint8(
+        min(max(y - 0.34414 * (cb - 0x80) - 0.71414 * (cr - 0x80), 0), 255))
+    out_rgb[i_out, 2] = nb.uint8(
+        min(max(y + 1.77200 * (cb - 0x80), 0), 255))
+
+
+# The per-point helpers are shared by the CUDA and the CPU kernels
+gen_point_xyz = cuda.jit(device=True)(point_xyz)
+gen_point_rgb = cuda.jit(device=True)(point_rgb)
+cpu_gen_point_xyz = nb.njit(inline='always')(point_xyz)
+cpu_gen_point_rgb = nb.njit(inline='always')(point_rgb)
+
+
 @cuda.jit()
-def cuda_gen_pcd_rgb(out_rgb, in_const, in_y, in_cbcr):
-    u, v = cuda.grid(2)
+def cuda_gen_pcd(out_xyz, out_rgb, in_const, in_cam_matrix, in_depth, in_y, in_cbcr):
+    """Unproject, transform and color a frame in one pass, a thread per pixel."""
+    i = cuda.grid(1)
 
     c_frame_width = int(in_const[0])
+    c_frame_height = int(in_const[1])
     c_offset = int(in_const[2])
+    c_upsample_rate = in_const[3]
+
+    if i >= c_frame_width * c_frame_height:
+        return
+
+    u = i % c_frame_width
+    v = i // c_frame_width
+    gen_point_xyz(out_xyz, c_offset + i, i, c_frame_width, c_frame_height,
+                  c_upsample_rate, in_cam_matrix, in_depth)
+    gen_point_rgb(out_rgb, c_offset + i, in_y[v, u],
+                  in_cbcr[v // 2, u // 2, 0], in_cbcr[v // 2, u // 2, 1])
+
+
+@cuda.jit()
+def cuda_gen_pcd_batch(out_xyz, out_rgb, in_const, in_offset, in_cam_matrix,
+                       in_depth, in_y, in_cbcr, n_batch):
+    """Batched `cuda_gen_pcd`, frame `b` is written to `out_*[b]` at `in_offset[b]`.
+
+    `out_xyz` and `out_rgb` are tuples of point clouds, padded beyond `n_batch`.
+    """
+    i = cuda.grid(1)
+
+    c_frame_width = int(in_const[0])
+    c_frame_height = int(in_const[1])
+    c_upsample_rate = in_const[3]
+    n_points = c_frame_width * c_frame_height
+
+    if i >= n_batch * n_points:
+        return
+
+    b = i // n_points
+    i = i % n_points
+    u = i % c_frame_width
+    v = i // c_frame_width
+    gen_point_xyz(out_xyz[b], in_offset[b] + i, i, c_frame_width, c_frame_height,
+                  c_upsample_rate, in_cam_matrix[b], in_depth[b])
+    gen_point_rgb(out_rgb[b], in_offset[b] + i, in_y[b, v, u],
+                  in_cbcr[b, v // 2, u // 2, 0], in_cbcr[b, v // 2, u // 2, 1])
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_gen_pcd(out_xyz, out_rgb, in_const, in_cam_matrix, in_depth, in_y, in_cbcr):
+    """CPU counterpart of `cuda_gen_pcd`, a thread per row."""
+    c_frame_width = int(in_const[0])
+    c_frame_height = int(in_const[1])
+    c_offset = int(in_const[2])
+    c_upsample_rate = in_const[3]
+
+    for v in nb.prange(c_frame_height):
+        for u in range(c_frame_width):
+            i = v * c_frame_width + u
+            cpu_gen_point_xyz(out_xyz, c_offset + i, i, c_frame_width, c_frame_height,
+                              c_upsample_rate, in_cam_matrix, in_depth)
+            cpu_gen_point_rgb(out_rgb, c_offset + i, in_y[v, u],
+                              in_cbcr[v // 2, u // 2, 0], in_cbcr[v // 2, u // 2, 1])
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_gen_pcd_batch(out_xyz, out_rgb, in_const, in_offset, in_cam_matrix,
+                      in_depth, in_y, in_cbcr, n_batch):
+    """CPU counterpart of `cuda_gen_pcd_batch`."""
+    c_frame_width = int(in_const[0])
+    c_frame_height = int(in_const[1])
+    c_upsample_rate = in_const[3]
+
+    for k in nb.prange(n_batch * c_frame_height):
+        b = k // c_frame_height
+        v = k % c_frame_height
+        for u in range(c_frame_width):
+            i = v * c_frame_width + u
+            cpu_gen_point_xyz(out_xyz[b], in_offset[b] + i, i, c_frame_width, c_frame_height,
+                              c_upsample_rate, in_cam_matrix[b], in_depth[b])
+            cpu_gen_point_rgb(out_rgb[b], in_offset[b] + i, in_y[b, v, u],
+                              in_cbcr[b, v // 2, u // 2, 0], in_cbcr[b, v // 2, u // 2, 1])
+
+
+# Anchors are painted by the nearest point, compared through packed
+# (quantized depth << 32 | sample index) keys
+ANCHOR_KEY_EMPTY = 0xFFFFFFFFFFFFFFFF
+ANCHOR_DEPTH_SCALE = 1e5  # depth quantization, 10 micrometers
+ANCHOR_MIN_COS = 0.99  # only paint anchors close enough to the point direction
+
+
+def point_anchor_key(in_acc_grid, in_anchor_xyz, in_pcd_xyz, i, j, i_min_anchor):
+    """Find the anchor of a point through the acceleration grid, -1 if none."""
+    x = in_pcd_xyz[i, 0]
+    y = in_pcd_xyz[i, 1]
+    z = in_pcd_xyz[i, 2]
+
+    r = math.hypot(math.hypot(x, y), z)
+    if r <= 0:
+        return -1, nb.uint64(0)
+
+    grid_h = in_acc_grid.shape[0]
+    grid_w = in_acc_grid.shape[1]
+
+    phi = math.atan2(y, x)
+    theta = math.acos(min(max(z / r, -1.0), 1.0))
+
+    cu = round(math.degrees(phi) % 360 / 360.0 * (grid_w - 1))
+    cv = round(math.degrees(theta) / 180.0 * (grid_h - 1))
+    a = int(in_acc_grid[cv, cu])
+
+    if a < i_min_anchor:
+        return -1, nb.uint64(0)
+
+    c = (x * in_anchor_xyz[a, 0] +
+         y * in_anchor_xyz[a, 1] +
+         z * in_anchor_xyz[a, 2]) / r
+    if c <= ANCHOR_MIN_COS:
+        return -1, nb.uint64(0)
+
+    d = nb.uint64(min(r * ANCHOR_DEPTH_SCALE, 4294967295.0))
+    return a, (d << nb.uint64(32)) | nb.uint64(j)
+
+
+anchor_sample_key = cuda.jit(device=True)(point_anchor_key)
+cpu_anchor_sample_key = nb.njit(
+    inline='always', nogil=True, cache=True, error_model='numpy')(point_anchor_key)
+
+
+@cuda.jit()
+def cuda_bin_to_anchors(out_anchor_key, in_acc_grid, in_anchor_xyz, in_pcd_xyz,
+                        i_begin, n_samples, step, i_min_anchor):
+    j = cuda.grid(1)
+
+    if j >= n_samples:
+        return
+
+    a, key = anchor_sample_key(in_acc_grid, in_anchor_xyz, in_pcd_xyz,
+                               i_begin + j * step, j, i_min_anchor)
+    if a >= 0:
+        cuda.atomic.min(out_anchor_key, a, key)
+
+
+@nb.njit(parallel=True, nogil=True, cache=True, error_model='numpy')
+def cpu_bin_to_anchors(out_anchor_key, in_acc_grid, in_anchor_xyz, in_pcd_xyz,
+                       i_begin, n_samples, step, i_min_anchor, tmp_anchor, tmp_key):
+    """CPU counterpart of `cuda_bin_to_anchors`.
+
+    The anchors are found in parallel, the per-anchor minimum is then taken
+    serially instead of with atomics.
+    """
+    for j in nb.prange(n_samples):
+        a, key = cpu_anchor_sample_key(in_acc_grid, in_anchor_xyz, in_pcd_xyz,
+                                       i_begin + j * step, j, i_min_anchor)
+        tmp_anchor[j] = a
+        tmp_key[j] = key
+
+    for j in range(n_samples):
+        a = tmp_anchor[j]
+        if a >= 0 and tmp_key[j] < out_anchor_key[a]:
+            out_anchor_key[a] = tmp_key[j]
+
+
+# Voxel hash of the fused point store, open addressing with linear probing.
+# Tables are a power of two long, empty entries have a negative key.
+
+@nb.njit(inline='always')
+def voxel_hash_home(key, mask):
+    h = nb.uint64(key) * nb.uint64(0x9E3779B97F4A7C15)
+    return nb.int64((h ^ (h >> nb.uint64(32))) & nb.uint64(mask))
+
+
+@nb.njit(inline='always')
+def voxel_hash_find(table_key, key):
+    """Entry of a key, or the empty entry ending its probe sequence."""
+    mask = table_key.shape[0] - 1
+    i = voxel_hash_home(key, mask)
+    while table_key[i] >= 0 and table_key[i] != key:
+        i = (i + 1) & mask
+    return i
+
+
+@nb.njit(nogil=True, cache=True)
+def voxel_hash_lookup(table_key, table_slot, keys, out_slots):
+    """Find the slots of keys, -1 for unknown keys."""
+    for j in range(keys.shape[0]):
+        i = voxel_hash_find(table_key, keys[j])
+        out_slots[j] = table_slot[i] if table_key[i] >= 0 else -1
+
+
+@nb.njit(nogil=True, cache=True)
+def voxel_hash_insert(table_key, table_slot, keys, slots):
+    """Insert keys, or move known keys to new slots."""
+    for j in range(keys.shape[0]):
+        i = voxel_hash_find(table_key, keys[j])
+        table_key[i] = keys[j]
+        table_slot[i] = slots[j]
+
+
+@nb.njit(nogil=True, cache=True)
+def voxel_hash_remove(table_key, table_slot, keys):
+    """Remove keys, shifting back the entries probed past them."""
+    mask = table_key.shape[0] - 1
+
+    for j in range(keys.shape[0]):
+        i = voxel_hash_find(table_key, keys[j])
+        if table_key[i] < 0:
+            continue
 
-    if v < in_y.shape[0] and u < in_y.shape[1]:
-        y = in_y[v, u]
-        cb = in_cbcr[v // 2, u // 2, 0]
-        cr = in_cbcr[v // 2, u // 2, 1]
+        table_key[i] = -1
+        k = i
+        while True:
+            k = (k + 1) & mask
+            if table_key[k] < 0:
+                break
 
-        i = c_offset + v * c_frame_width + u
+            # Entries whose home lies cyclically in (i, k] stay reachable
+            home = voxel_hash_home(table_key[k], mask)
+            if (i < k and i < home <= k) or (i > k and (home > i or home <= k)):
+                continue
 
-        out_rgb[i, 0] = nb.uint8(
-            min(max(y + 1.40200 * (cr - 0x80), 0), 255))
-        out_rgb[i, 1] = nb.uint8(
-            min(max(y - 0.34414 * (cb - 0x80) - 0.71414 * (cr - 0x80), 0), 255))
-        out_rgb[i, 2] = nb.uint8(
-            min(max(y + 1.77200 * (cb - 0x80), 0), 255))
+            table_key[i] = table_key[k]
+            table_slot[i] = table_slot[k]
+            table_key[k] = -1
+            i = k
@@ -1,2 +1,5 @@
 from .configs import SessionConfigs
 from .core import LightingReconstructionSession
+from .timing import StageTimer, Histogram, StageHistograms
+from .snapshot import save_snapshot, read_snapshot, load_snapshot
+from .manager import SessionManager, SessionBudgetExceeded, session_manager
@@ -1,19 +1,27 @@
 from __future__ import annotations
 
 import numpy as np
+from typing import List
 from uuid import uuid4, UUID
 from numba import cuda
 from numba.cuda.cudadrv.devicearray import ManagedNDArray
 
+from configs import QUALITY_TIERS
+from configs import DEFAULT_QUALITY_TIER
+
 from litar.types import Vector2Int
+from litar.pipeline.backend import resolve_backend
 from service.schema import SessionInitPackage
+from service.schema.response import COMPACT_RESPONSE_MODES
 
 
 class SessionConfigs:
     s_id: UUID
+    init_package: SessionInitPackage
+    backend: str  # cuda or cpu
 
     num_of_views: int
-    exp_time_window: int
+    exp_time_window: int  # seconds, 0 disables expiry
 
     depth_native_size: Vector2Int
     depth_upsample_rate: int
@@ -23,11 +31,20 @@ class SessionConfigs:
 
     n_points: int
 
+    quality_tier: int
+    response_mode: int
+    render_env_map: bool  # False if the response is computed from anchors only
+    mlp_sequence: List[int]
+    panorama_size: Vector2Int
+
     k: np.ndarray
     ambient_color: np.ndarray  # uint8, (3)
 
-    def __init__(self, configs: SessionInitPackage) -> None:
-        self.s_id = uuid4()
+    def __init__(self, configs: SessionInitPackage, backend: str = None,
+                 s_id: UUID = None) -> None:
+        self.s_id = uuid4() if s_id is None else s_id
+        self.init_package = configs
+        self.backend = resolve_backend(backend)
 
         self.num_of_views = configs.num_of_views
         self.exp_time_window = configs.exp_time_window
@@ -44,6 +61,20 @@ class SessionConfigs:
         self.k = configs.k
         self.ambient_color = configs.ambient_color
 
+        self.quality_tier = configs.quality_tier
+        if self.quality_tier not in QUALITY_TIERS:
+            print(f'! Unknown quality tier {self.quality_tier}, '
+                  f'using {DEFAULT_QUALITY_TIER} instead')
+            self.quality_tier = DEFAULT_QUALITY_TIER
+
+        self.response_mode = configs.response_mode
+        self.render_env_map = self.response_mode not in COMPACT_RESPONSE_MODES
+
+        tier = QUALITY_TIERS[self.quality_tier]
+        self.mlp_sequence = tier['mlp_sequence']
+        self.panorama_size = Vector2Int(
+            tier['panorama_width'], tier['panorama_height'])
+
         # self.cuda_const = cuda.managed_array((10), dtype=np.float32)
         # self.cuda_const[0] = self.color_dense_sample_size.x
         # self.cuda_const[1] = self.color_dense_sample_size.y
@@ -1,17 +1,48 @@
 from __future__ import annotations
 
+import time
+from typing import Dict, List, Set, Tuple
+from uuid import UUID
+
 import imageio
 import numpy as np
-from numba import cuda
+
+from configs import N_ANCHORS
+from configs import NEAR_FIELD_MAX_POINTS
+from configs import NEAR_FIELD_VOXEL_SIZE
 
 from litar.session.configs import SessionConfigs
+from litar.session.expiry import ExpiryQueue
+from litar.session.timing import StageTimer
+from litar.session.timing import StageHistograms
+from litar.pipeline.backend import alloc_array
 from litar.pipeline.dpcp import ManagedPanoramaRenderer
 from litar.pipeline.pointcloud import ManagedPointCloudGenerator
+from litar.pipeline.pointcloud import FusedPointStore
 
+from service.schema import SessionInitPackage
 from service.schema.keyframe import FarFieldKeyFramePackage
 from service.schema.keyframe import NearFieldKeyFramePackage
 
-from profilehooks import profile, timecall
+
+# Inputs kept for each view slot, snapshots regenerate the points from them
+VIEW_INPUTS = ('view_trs', 'view_depth', 'view_y', 'view_cbcr')
+
+
+def view_input_layout(configs: SessionConfigs) -> Dict[str, Tuple[tuple, type]]:
+    n = configs.num_of_views
+    dn, c = configs.depth_native_size, configs.color_dense_sample_size
+    return {
+        'view_trs': ((n, 12), np.float32),
+        'view_depth': ((n, dn.x * dn.y), np.float32),
+        'view_y': ((n, c.y, c.x), np.uint8),
+        'view_cbcr': ((n, c.y // 2, c.x // 2, 2), np.uint8)
+    }
+
+
+def alloc_view_inputs(configs: SessionConfigs) -> Dict[str, np.ndarray]:
+    return {name: np.zeros(shape, dtype=dtype)
+            for name, (shape, dtype) in view_input_layout(configs).items()}
 
 
 class LightingReconstructionSession:
@@ -20,16 +51,38 @@ class LightingReconstructionSession:
     renderer: ManagedPanoramaRenderer
     far_field_pc_generator: ManagedPointCloudGenerator
     near_filed_pc_generator: ManagedPointCloudGenerator
+    fused_store: FusedPointStore  # None unless near field fusion is enabled
+    expiry: ExpiryQueue  # captures expire after exp_time_window seconds
+    timer: StageTimer  # stage timings of the frame being processed
+    latency: StageHistograms  # stage latencies of every processed frame
+
+    __populated_views: Set[int]  # view slots holding a captured view
+    __pending_ranges: List[Tuple[int, int]]  # points to project on the next projection
+    __rebuild_projection: bool
+    __view_stamp: Dict[int, int]  # latest capture of each view slot
+    __view_inputs: Dict[str, np.ndarray]  # inputs of each view slot, to snapshot them
+    __anchor_stamp: np.ndarray  # latest capture painting each anchor
 
     def __init__(self, configs: SessionConfigs) -> None:
         self.configs = configs
+        self.timer = StageTimer()
+        self.latency = StageHistograms()
+
+        # Fused views only need the generator to hold the latest view
+        self.fused_store = None
+        if NEAR_FIELD_VOXEL_SIZE > 0 and configs.render_env_map:
+            self.fused_store = FusedPointStore(
+                NEAR_FIELD_VOXEL_SIZE,
+                NEAR_FIELD_MAX_POINTS,
+                backend=configs.backend)
 
         # Near field point cloud generator
         self.near_filed_pc_generator = ManagedPointCloudGenerator(
             configs.k,
             configs.depth_native_size,
             configs.color_dense_sample_size,
-            configs.num_of_views)
+            1 if self.fused_store else configs.num_of_views,
+            backend=configs.backend)
 
         # Far field point cloud generator
         sparse_to_dense_ratio = configs.color_sparse_sample_size.x / \
@@ -38,64 +91,332 @@ class LightingReconstructionSession:
             configs.k * sparse_to_dense_ratio,
             configs.color_sparse_sample_size,
             configs.color_sparse_sample_size,
-            1)
+            1,
+            backend=configs.backend)
 
-        self.far_field_static_depth = cuda.managed_array(
-            (configs.color_sparse_sample_size.y *
-             configs.color_sparse_sample_size.x), dtype=np.float32)
-        self.far_field_static_depth = np.ones(
+        self.far_field_static_depth = alloc_array(
+            configs.backend,
             (configs.color_sparse_sample_size.y *
-             configs.color_sparse_sample_size.x), dtype=np.float32)
+             configs.color_sparse_sample_size.x), np.float32)
+        self.far_field_static_depth.fill(1)
 
         # Environment map renderer, using panorama for now
-        self.renderer = ManagedPanoramaRenderer(configs.ambient_color)
-        self.renderer.clean_up()
+        self.renderer = ManagedPanoramaRenderer(
+            configs.ambient_color,
+            configs.panorama_size,
+            configs.mlp_sequence,
+            backend=configs.backend)
+
+        self.__populated_views = set()
+        self.__pending_ranges = []
+        self.__rebuild_projection = False
+
+        self.expiry = ExpiryQueue(configs.exp_time_window)
+        self.__view_stamp = {}
+        self.__view_inputs = {}
+        if not self.fused_store:
+            self.__view_inputs = alloc_view_inputs(configs)
+        self.__anchor_stamp = np.zeros(N_ANCHORS, dtype=np.int64)
+
+        if configs.render_env_map:
+            self.renderer.clean_up()
+
+    def near_field_slot(self, pkg: NearFieldKeyFramePackage) -> int:
+        """Generator slot receiving the points of a near field keyframe."""
+        return 0 if self.fused_store else pkg.view_index
 
-    # @timecall(immediate=True)
-    def reconstruct_near_field_pcd(self, pkg: NearFieldKeyFramePackage):
-        self.near_filed_pc_generator.exec(
-            pkg.view_index, pkg.buf_trs,
-            pkg.buf_depth, pkg.buf_y, pkg.buf_cbcr)
+    def reconstruct_near_field_pcd(self, pkg: NearFieldKeyFramePackage,
+                                   points_generated: bool = False):
+        """Reconstruct a near field keyframe.
+
+        `points_generated` skips the point generation, when the points of
+        the keyframe were already generated in its slot, e.g. by a
+        `PointCloudBatch`.
+        """
+        now = time.monotonic()
+        self.expire_captures(now)
+        stamp = self.expiry.new_stamp()
+
+        if not points_generated:
+            with self.timer.stage('points'):
+                self.near_filed_pc_generator.exec(
+                    self.near_field_slot(pkg), pkg.buf_trs,
+                    pkg.buf_depth, pkg.buf_y, pkg.buf_cbcr)
 
         ds = self.configs.color_dense_sample_size.x // self.configs.color_sparse_sample_size.x
-        m, spc_rgb = self.near_filed_pc_generator.sample_to_anchor(
-            self.renderer.arg_in_anchor_xyz,
-            downsample_rate=ds * ds,
-            filter_surroundings=True)
-        self.renderer.arg_inout_anchor_rgb[m, :] = spc_rgb
+        with self.timer.stage('anchors'):
+            m, spc_rgb = self.near_filed_pc_generator.sample_to_anchor(
+                self.renderer.arg_in_anchor_xyz,
+                self.renderer.arg_in_anchor_acc_grid,
+                downsample_rate=ds * ds,
+                filter_surroundings=True)
+            self.renderer.paint_anchors(m, spc_rgb)
+            self.stamp_anchors(now, stamp, m)
 
         # sp_xyz, sp_rgb = self.near_filed_pc_generator.sparse_sample(
         #     downsample_rate=ds * ds)
         # self.renderer.update_anchors(sp_xyz, sp_rgb)
-        self.renderer.clean_up()
 
-    # @timecall(immediate=True)
+        # Overwritten points may have been the farthest of their texels,
+        # so the projection is rebuilt from all points in that case
+        n = self.configs.n_points
+        if self.fused_store:
+            with self.timer.stage('fusion'):
+                ins = self.fused_store.insert(
+                    self.near_filed_pc_generator.arg_out_pcd_xyz[:n],
+                    self.near_filed_pc_generator.arg_out_pcd_rgb[:n],
+                    stamp)
+            self.__rebuild_projection |= ins.recycled
+            self.__pending_ranges.append((ins.i_begin, ins.i_end))
+            self.expiry.push(now, stamp, ('voxels', ins.keys))
+        else:
+            if pkg.view_index in self.__populated_views:
+                self.__rebuild_projection = True
+            self.__populated_views.add(pkg.view_index)
+            self.keep_view_inputs(pkg.view_index, pkg.buf_trs,
+                                  pkg.buf_depth, pkg.buf_y, pkg.buf_cbcr)
+            self.__pending_ranges.append(
+                (pkg.view_index * n, (pkg.view_index + 1) * n))
+            self.__view_stamp[pkg.view_index] = stamp
+            self.expiry.push(now, stamp, ('view', pkg.view_index))
+
+        if self.configs.render_env_map:
+            with self.timer.stage('far_field'):
+                self.renderer.redraw_far_field()
+
     def reconstruct_far_field_pcd(self, pkg: FarFieldKeyFramePackage):
+        now = time.monotonic()
+        self.expire_captures(now)
+        stamp = self.expiry.new_stamp()
+
         m_r = pkg.buf_r.reshape((3, 3))
         m_t = np.zeros((3, 1), dtype=np.float32)
         m_trs = np.concatenate((m_r, m_t), axis=1)
         m_trs = m_trs.reshape(-1)
 
-        self.far_field_pc_generator.exec(
-            0, m_trs,
-            self.far_field_static_depth,
-            pkg.buf_y, pkg.buf_cbcr)
+        with self.timer.stage('points'):
+            self.far_field_pc_generator.exec(
+                0, m_trs,
+                self.far_field_static_depth,
+                pkg.buf_y, pkg.buf_cbcr)
 
-        m, spc_rgb = self.far_field_pc_generator.sample_to_anchor(
-            self.renderer.arg_in_anchor_xyz, downsample_rate=1)
-        self.renderer.arg_inout_anchor_rgb[m, :] = spc_rgb
+        with self.timer.stage('anchors'):
+            m, spc_rgb = self.far_field_pc_generator.sample_to_anchor(
+                self.renderer.arg_in_anchor_xyz,
+                self.renderer.arg_in_anchor_acc_grid,
+                downsample_rate=1)
+            self.renderer.paint_anchors(m, spc_rgb)
+            self.stamp_anchors(now, stamp, m)
 
         # sp_xyz, sp_rgb = self.near_filed_pc_generator.sparse_sample()
         # self.renderer.update_anchors(sp_xyz, sp_rgb)
-        self.renderer.clean_up()
 
-    # @timecall(immediate=True)
+        # The near field is unchanged, only the far field is redrawn
+        if self.configs.render_env_map:
+            with self.timer.stage('far_field'):
+                self.renderer.redraw_far_field()
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the buffers of this session."""
+        n = self.near_filed_pc_generator.nbytes + \
+            self.far_field_pc_generator.nbytes + \
+            self.renderer.nbytes + \
+            self.far_field_static_depth.nbytes
+
+        if self.fused_store:
+            n += self.fused_store.nbytes
+
+        return n + sum([b.nbytes for b in self.__view_inputs.values()])
+
+    @staticmethod
+    def estimate_nbytes(configs: SessionConfigs) -> int:
+        """Bytes a new session allocates, to budget it before allocating it."""
+        fused = NEAR_FIELD_VOXEL_SIZE > 0 and configs.render_env_map
+        sparse = configs.color_sparse_sample_size
+
+        n = ManagedPointCloudGenerator.estimate_nbytes(
+            configs.depth_native_size, configs.color_dense_sample_size,
+            1 if fused else configs.num_of_views)
+        n += ManagedPointCloudGenerator.estimate_nbytes(sparse, sparse, 1)
+        n += ManagedPanoramaRenderer.estimate_nbytes(
+            configs.panorama_size, configs.mlp_sequence)
+        n += int(sparse.x) * int(sparse.y) * 4
+
+        if fused:
+            n += FusedPointStore.estimate_nbytes(NEAR_FIELD_MAX_POINTS)
+        else:
+            n += sum([np.prod(shape) * np.dtype(dtype).itemsize
+                      for shape, dtype in view_input_layout(configs).values()])
+
+        return int(n)
+
+    def keep_view_inputs(self, i_view: int, trs: np.ndarray, depth: np.ndarray,
+                         y: np.ndarray, cbcr: np.ndarray):
+        """Keep the inputs of a view slot, its points are regenerated from them on restore."""
+        for name, buf in zip(VIEW_INPUTS, (trs, depth, y, cbcr)):
+            self.__view_inputs[name][i_view] = buf
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """Capture the reconstructed state of the session, see `restore`.
+
+        The inputs of the populated view slots are kept rather than their
+        points, along with the anchors and the package the session was
+        initialized with. Fused views can't be regenerated from the last
+        inputs, the fused points are kept instead.
+        """
+        state = {
+            's_id': np.array(str(self.configs.s_id)),
+            'init_bytes': np.frombuffer(
+                self.configs.init_package.raw_bytes, dtype=np.uint8),
+            'anchor_rgb': np.array(self.renderer.arg_inout_anchor_rgb),
+            'anchor_depth': np.array(self.renderer.arg_inout_anchor_depth)
+        }
+
+        if self.fused_store:
+            n = self.fused_store.n_points
+            state['pcd_xyz'] = np.array(self.fused_store.arg_out_pcd_xyz[:n])
+            state['pcd_rgb'] = np.array(self.fused_store.arg_out_pcd_rgb[:n])
+        else:
+            views = np.array(sorted(self.__populated_views), dtype=np.int32)
+            state['views'] = views
+            for name, buf in self.__view_inputs.items():
+                state[name] = buf[views]
+
+        return state
+
+    @staticmethod
+    def snapshot_configs(state: Dict[str, np.ndarray], backend: str = None) -> SessionConfigs:
+        """Configs of the session captured by a `snapshot`."""
+        return SessionConfigs(
+            SessionInitPackage(state['init_bytes'].tobytes()),
+            backend=backend,
+            s_id=UUID(str(state['s_id'])))
+
+    @classmethod
+    def restore(cls, state: Dict[str, np.ndarray], backend: str = None,
+                configs: SessionConfigs = None) -> LightingReconstructionSession:
+        """Recreate a session from a `snapshot`, keeping its s_id."""
+        if configs is None:
+            configs = cls.snapshot_configs(state, backend)
+
+        session = cls(configs)
+        session.load_state(state)
+
+        return session
+
+    def load_state(self, state: Dict[str, np.ndarray]):
+        """Load a `snapshot` into this session, restored data counts as just captured."""
+        now = time.monotonic()
+        stamp = self.expiry.new_stamp()
+
+        if self.fused_store and 'pcd_xyz' in state:
+            ins = self.fused_store.insert(state['pcd_xyz'], state['pcd_rgb'], stamp)
+            self.expiry.push(now, stamp, ('voxels', ins.keys))
+        elif not self.fused_store and self.__matches_view_inputs(state):
+            gen = self.near_filed_pc_generator
+            for i, v in enumerate(state['views']):
+                v = int(v)
+                inputs = [state[name][i] for name in VIEW_INPUTS]
+                gen.exec(v, *inputs)
+                self.keep_view_inputs(v, *inputs)
+
+                self.__populated_views.add(v)
+                self.__view_stamp[v] = stamp
+                self.expiry.push(now, stamp, ('view', v))
+        else:
+            print('! Snapshot views don\'t match the session, they are not restored')
+
+        mask = np.ones(N_ANCHORS, dtype=bool)
+        self.renderer.paint_anchors(mask, state['anchor_rgb'])
+        self.renderer.arg_inout_anchor_depth[::] = state['anchor_depth']
+        self.stamp_anchors(now, stamp, mask)
+
+        self.__pending_ranges = []
+        self.__rebuild_projection = True
+
+        if self.configs.render_env_map:
+            self.renderer.redraw_far_field()
+
+    def __matches_view_inputs(self, state: Dict[str, np.ndarray]) -> bool:
+        if 'views' not in state:
+            return False
+
+        views = state['views']
+        if len(views) > 0 and not (0 <= views.min() and views.max() < self.configs.num_of_views):
+            return False
+
+        return all([name in state and state[name].shape == (len(views),) + buf.shape[1:]
+                    for name, buf in self.__view_inputs.items()])
+
+    def stamp_anchors(self, now: float, stamp: int, mask: np.ndarray):
+        anchors = np.flatnonzero(mask)
+        if len(anchors) > 0:
+            self.__anchor_stamp[anchors] = stamp
+            self.expiry.push(now, stamp, ('anchors', anchors))
+
+    def expire_captures(self, now: float):
+        """Drop the views, fused points and anchor colors older than the window.
+
+        Only the expired captures are visited. Data overwritten by a more
+        recent capture is kept, and expired anchors go back to the ambient
+        color.
+        """
+        with self.timer.stage('expiry'):
+            self.__expire_captures(now)
+
+    def __expire_captures(self, now: float):
+        expired_anchors = []
+
+        for stamp, (kind, item) in self.expiry.pop_expired(now):
+            if kind == 'view':
+                if self.__view_stamp.get(item) == stamp:
+                    del self.__view_stamp[item]
+                    self.__populated_views.discard(item)
+                    self.__rebuild_projection = True
+            elif kind == 'voxels':
+                if self.fused_store.expire(item, stamp) > 0:
+                    self.__rebuild_projection = True
+            elif kind == 'anchors':
+                expired_anchors.append(
+                    item[self.__anchor_stamp[item] == stamp])
+
+        if expired_anchors:
+            self.renderer.reset_anchors(np.concatenate(expired_anchors))
+
     def run_direct_point_cloud_projection(self):
-        self.renderer.update(self.near_filed_pc_generator.arg_out_pcd_xyz,
-                             self.near_filed_pc_generator.arg_out_pcd_rgb)
+        """Project the points captured since the last projection and merge."""
+        if not self.configs.render_env_map:
+            # Nothing is projected, captured ranges must not pile up
+            self.__pending_ranges = []
+            self.__rebuild_projection = False
+            return
+
+        pcd = self.fused_store or self.near_filed_pc_generator
+
+        if self.__rebuild_projection:
+            self.renderer.invalidate_projection()
+            if self.fused_store:
+                ranges = [(0, self.fused_store.n_points)]
+            else:
+                n = self.configs.n_points
+                ranges = [(v * n, (v + 1) * n)
+                          for v in sorted(self.__populated_views)]
+        else:
+            ranges = self.__pending_ranges
+
+        with self.timer.stage('dpcp'):
+            self.renderer.update(pcd.arg_out_pcd_xyz,
+                                 pcd.arg_out_pcd_rgb,
+                                 ranges=ranges)
+
+        self.__pending_ranges = []
+        self.__rebuild_projection = False
 
     def clean_up_renderer(self):
         self.renderer.clean_up()
+        self.__pending_ranges = []
+        self.__rebuild_projection = True
 
     def dump_point_cloud(self):
         c_offset = int(self.near_filed_pc_generator.arg_in_const[2])
@@ -0,0 +1,49 @@
+import heapq
+import itertools
+from typing import Any, List, Tuple
+
+
+class ExpiryQueue:
+    """Expire captured data once it falls out of a time window.
+
+    Each capture is pushed with its stamp, and popped once it is older than
+    the window. Popping costs O(log n) per expired capture, so nothing is
+    scanned while data is still fresh. Captures overwritten before they
+    expire are still popped, owners compare the stamp with the latest one
+    of the item to tell them apart.
+    """
+    window: float  # seconds, 0 disables expiry
+
+    __heap: List[Tuple[float, int, Any]]
+    __counter: itertools.count
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.__heap = []
+        self.__counter = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def new_stamp(self) -> int:
+        """Get a stamp for a new capture, stamps are increasing."""
+        return next(self.__counter)
+
+    def push(self, now: float, stamp: int, item: Any) -> None:
+        """Register the capture `stamp` of an item, made at `now`."""
+        if self.enabled:
+            heapq.heappush(self.__heap, (now + self.window, stamp, item))
+
+    def pop_expired(self, now: float) -> List[Tuple[int, Any]]:
+        """Pop the `(stamp, item)` captures expired at `now`."""
+        expired = []
+
+        while self.__heap and self.__heap[0][0] <= now:
+            _, stamp, item = heapq.heappop(self.__heap)
+            expired.append((stamp, item))
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.__heap)
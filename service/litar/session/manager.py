@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from uuid import UUID
+
+from configs import SESSION_IDLE_TIMEOUT
+from configs import SESSION_MEMORY_BUDGET
+
+from litar.session.configs import SessionConfigs
+from litar.session.core import LightingReconstructionSession
+from litar.session.snapshot import prune_snapshots
+from litar.session.snapshot import touch_snapshot
+from litar.session.snapshot import claim_session
+from litar.session.snapshot import session_claim
+
+
+class SessionBudgetExceeded(MemoryError):
+    """Raised when a session doesn't fit in the memory budget."""
+
+
+class SessionManager:
+    """Process-wide registry of reconstruction sessions.
+
+    Sessions are attached to the one connection using them, and kept idle
+    after it closes, e.g. for the client to reconnect. A connection
+    attaching a session takes it over from the previous one, which has
+    to stop using it, see `owner`. Idle sessions are
+    evicted in least recently used order, either to keep the session
+    buffers, and the ones `reserve`d for sessions being created, within
+    `memory_budget` bytes or once they have been idle for
+    `idle_timeout` seconds. Attached sessions are never evicted.
+
+    With several worker processes, each worker claims the sessions it
+    holds under its own `worker_port`, so resumes landing on another
+    worker can be sent to it, see `locate`.
+
+    Not thread-safe, the manager is used from the IOLoop thread only.
+    """
+    memory_budget: int  # 0 means unlimited
+    idle_timeout: float
+    worker_port: Optional[int]  # port of this worker only, None with a single process
+
+    n_evicted: int
+
+    __sessions: OrderedDict  # s_id -> session, least recently used first
+    __nbytes: Dict[UUID, int]
+    __reserved: Dict[UUID, int]  # s_id -> bytes of a session being created
+    __attached: Dict[UUID, object]  # s_id -> attached connection
+    __t_idle: Dict[UUID, float]  # s_id -> time the session became idle
+
+    def __init__(self, memory_budget: int = SESSION_MEMORY_BUDGET,
+                 idle_timeout: float = SESSION_IDLE_TIMEOUT) -> None:
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.worker_port = None
+        self.n_evicted = 0
+
+        self.__sessions = OrderedDict()
+        self.__nbytes = {}
+        self.__reserved = {}
+        self.__attached = {}
+        self.__t_idle = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.__nbytes.values()) + sum(self.__reserved.values())
+
+    def reserve(self, configs: SessionConfigs) -> None:
+        """Make room for a session before allocating it, see `add`.
+
+        Its bytes are estimated from its configs and count against the
+        budget until it is added or `release`d. Raises
+        `SessionBudgetExceeded` if it doesn't fit.
+        """
+        nbytes = LightingReconstructionSession.estimate_nbytes(configs)
+        self.__make_room(configs.s_id, nbytes)
+        self.__reserved[configs.s_id] = nbytes
+
+    def release(self, s_id: UUID) -> None:
+        """Drop the reservation of a session, e.g. when its creation failed."""
+        self.__reserved.pop(s_id, None)
+
+    def add(self, session: LightingReconstructionSession, owner: object = None) -> None:
+        """Register a new session, attached to the `owner` connection.
+
+        Sessions are expected to be `reserve`d before they are allocated.
+        Otherwise, idle sessions are evicted to make room for it. Raises
+        `SessionBudgetExceeded` if it still doesn't fit, the session is
+        then not registered.
+        """
+        s_id = session.configs.s_id
+        nbytes = session.nbytes
+
+        if self.__reserved.pop(s_id, None) is None:
+            self.__make_room(s_id, nbytes)
+
+        self.__sessions[s_id] = session
+        self.__nbytes[s_id] = nbytes
+        self.__attached[s_id] = owner
+        self.__claim(s_id)
+
+    def __make_room(self, s_id: UUID, nbytes: int) -> None:
+        self.evict_expired()
+
+        if self.memory_budget > 0:
+            # Don't evict anything if the attached sessions alone leave no room
+            idle_ids = self.idle_sessions()
+            n_attached = self.nbytes - sum([self.__nbytes[i] for i in idle_ids])
+
+            if n_attached + nbytes > self.memory_budget:
+                raise SessionBudgetExceeded(
+                    f'Session {s_id} needs {nbytes} bytes, '
+                    f'{n_attached} of {self.memory_budget} are attached')
+
+            for idle_id in idle_ids:
+                if self.nbytes + nbytes <= self.memory_budget:
+                    break
+                self.evict(idle_id)
+
+    def get(self, s_id: UUID) -> Optional[LightingReconstructionSession]:
+        return self.__sessions.get(s_id)
+
+    def owner(self, s_id: UUID) -> Optional[object]:
+        """Connection a session is attached to, None for idle sessions."""
+        return self.__attached.get(s_id)
+
+    def attach(self, s_id: UUID, owner: object = None) -> Optional[LightingReconstructionSession]:
+        """Attach a connection to a registered session, e.g. when resuming it.
+
+        The session is taken over from the connection it was attached to.
+        """
+        session = self.__sessions.get(s_id)
+        if session is None:
+            return None
+
+        self.__attached[s_id] = owner
+        self.__t_idle.pop(s_id, None)
+        self.touch(s_id)
+        self.__claim(s_id)
+
+        return session
+
+    def locate(self, s_id: UUID) -> Optional[int]:
+        """Port of another live worker holding a session, None if it isn't held elsewhere."""
+        if self.worker_port is None or s_id in self.__sessions:
+            return None
+
+        claim = session_claim(s_id)
+        if claim is None:
+            return None
+
+        port, pid = claim
+        if port == self.worker_port or not process_alive(pid):
+            return None
+
+        return port
+
+    def detach(self, s_id: UUID, owner: object = None) -> None:
+        """Detach a connection, the session becomes idle.
+
+        Connections the session was taken over from are ignored.
+        """
+        if s_id not in self.__attached or self.__attached[s_id] is not owner:
+            return
+
+        del self.__attached[s_id]
+        self.__t_idle[s_id] = time.monotonic()
+
+    def touch(self, s_id: UUID) -> None:
+        """Mark a session as the most recently used one.
+
+        Its bytes are accounted again, as fused sessions grow with the
+        scene, and idle sessions are evicted while the budget is exceeded.
+        """
+        if s_id not in self.__sessions:
+            return
+
+        self.__sessions.move_to_end(s_id)
+        self.__nbytes[s_id] = self.__sessions[s_id].nbytes
+
+        if self.memory_budget > 0:
+            for idle_id in self.idle_sessions():
+                if self.nbytes <= self.memory_budget:
+                    break
+                if idle_id != s_id:
+                    self.evict(idle_id)
+
+    def sessions(self):
+        """All registered sessions, least recently used first."""
+        return list(self.__sessions.values())
+
+    def idle_sessions(self):
+        """Ids of the idle sessions, least recently used first."""
+        return [s_id for s_id in self.__sessions if s_id not in self.__attached]
+
+    def evict(self, s_id: UUID) -> None:
+        """Drop a session, its buffers are released with the last reference.
+
+        The snapshot of the session is kept, so it can still be resumed.
+        """
+        if self.__sessions.pop(s_id, None) is None:
+            return
+
+        del self.__nbytes[s_id]
+        self.__attached.pop(s_id, None)
+        self.__t_idle.pop(s_id, None)
+        self.n_evicted += 1
+
+        print(f'! Session evicted: {s_id}')
+
+    def evict_expired(self) -> None:
+        """Evict the sessions idle for longer than `idle_timeout`.
+
+        Snapshots not updated for `idle_timeout` seconds are removed as
+        well. The snapshot directory is shared by the worker processes, so
+        snapshots are never removed by session, e.g. the session may have
+        been resumed by another worker since. Each worker keeps the
+        snapshots of its attached sessions fresh instead, and the snapshots
+        of sessions no worker uses age out.
+        """
+        t_now = time.monotonic()
+
+        for s_id, t_idle in list(self.__t_idle.items()):
+            if t_now - t_idle >= self.idle_timeout:
+                self.evict(s_id)
+
+        for s_id in self.__attached:
+            touch_snapshot(s_id)
+
+        prune_snapshots(self.idle_timeout)
+
+    def to_dict(self) -> dict:
+        return {
+            'n_sessions': len(self.__sessions),
+            'n_sessions_attached': len(self.__attached),
+            'n_sessions_evicted': self.n_evicted,
+            'nbytes': self.nbytes,
+            'n_sessions_reserved': len(self.__reserved),
+            'memory_budget': self.memory_budget
+        }
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    def __claim(self, s_id: UUID) -> None:
+        if self.worker_port is not None:
+            claim_session(s_id, self.worker_port)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+session_manager = SessionManager()
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import os
+import time
+import numpy as np
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from litar.session.core import LightingReconstructionSession
+
+SNAPSHOT_DIR = './tmp/sessions'
+
+
+def snapshot_path(s_id: UUID) -> str:
+    return os.path.join(SNAPSHOT_DIR, f'{s_id}.npz')
+
+
+def claim_path(s_id: UUID) -> str:
+    return os.path.join(SNAPSHOT_DIR, f'{s_id}.worker')
+
+
+def save_snapshot(session: LightingReconstructionSession) -> str:
+    """Write a session snapshot to disk, replacing the previous one.
+
+    The snapshot is written to a temporary file and moved in place, so a
+    crash never leaves a partially written snapshot behind.
+    """
+    path = snapshot_path(session.configs.s_id)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **session.snapshot())
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def read_snapshot(s_id: UUID) -> Optional[Dict[str, np.ndarray]]:
+    """Read the state of a session snapshot, None if there is no snapshot.
+
+    The snapshot is touched, so it isn't pruned while the session is used.
+    """
+    try:
+        with np.load(snapshot_path(s_id)) as state:
+            state = dict(state)
+    except FileNotFoundError:
+        return None
+
+    touch_snapshot(s_id)
+    return state
+
+
+def load_snapshot(s_id: UUID, backend: str = None) -> Optional[LightingReconstructionSession]:
+    """Restore a session from its snapshot, None if there is no snapshot."""
+    state = read_snapshot(s_id)
+    if state is None:
+        return None
+
+    return LightingReconstructionSession.restore(state, backend=backend)
+
+
+def touch_snapshot(s_id: UUID) -> None:
+    """Mark the snapshot and the claim of a session in use as updated, if any."""
+    for path in (snapshot_path(s_id), claim_path(s_id)):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+
+def claim_session(s_id: UUID, port: int) -> None:
+    """Record that the worker listening on `port` holds a session."""
+    path = claim_path(s_id)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(f'{port} {os.getpid()}')
+    os.replace(tmp_path, path)
+
+
+def session_claim(s_id: UUID) -> Optional[Tuple[int, int]]:
+    """Port and pid of the worker holding a session, None if unclaimed."""
+    try:
+        with open(claim_path(s_id)) as f:
+            port, pid = f.read().split()
+        return int(port), int(pid)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def prune_snapshots(max_age: float) -> int:
+    """Remove snapshots and claims not updated for `max_age` seconds, returns how many.
+
+    Files removed meanwhile by another worker are skipped.
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return 0
+
+    n = 0
+    t_now = time.time()
+    for name in os.listdir(SNAPSHOT_DIR):
+        path = os.path.join(SNAPSHOT_DIR, name)
+        try:
+            if name.endswith(('.npz', '.worker')) and t_now - os.path.getmtime(path) >= max_age:
+                os.remove(path)
+                n += 1
+        except FileNotFoundError:
+            pass
+
+    return n
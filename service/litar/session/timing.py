@@ -0,0 +1,97 @@
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class StageTimer:
+    """Time the pipeline stages of the frame being processed.
+
+    Stages entered several times within a frame add up. `pop` returns the
+    seconds spent in each stage of the frame and starts the next one, so
+    nothing accumulates over a long session.
+    """
+    __frame: Dict[str, float]
+
+    def __init__(self) -> None:
+        self.__frame = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t_start)
+
+    def add(self, name: str, t: float) -> None:
+        """Add seconds spent in a stage outside of `stage`, e.g. in a batch."""
+        self.__frame[name] = self.__frame.get(name, 0.0) + t
+
+    def pop(self) -> Dict[str, float]:
+        frame, self.__frame = self.__frame, {}
+        return frame
+
+
+class Histogram:
+    """Counts of observations in fixed buckets, in the Prometheus way.
+
+    Observing a value is a binary search over the buckets, so histograms
+    stay on in production. The last count is for values above every bucket.
+    """
+    buckets: Tuple[float, ...]
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile, interpolating linearly within its bucket."""
+        if self.count == 0:
+            return float('nan')
+
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            if n + c >= rank and c > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                return lo + (self.buckets[i] - lo) * (rank - n) / c
+            n += c
+
+        return self.buckets[-1]
+
+
+class StageHistograms:
+    """Latency histograms of the pipeline stages, created on first use."""
+    histograms: Dict[str, Histogram]
+
+    def __init__(self) -> None:
+        self.histograms = {}
+
+    def observe(self, frame: Dict[str, float]) -> None:
+        """Observe the stage timings of a frame, e.g. from `StageTimer.pop`."""
+        for name, t in frame.items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(t)
+
+    def items(self):
+        return sorted(self.histograms.items())
@@ -1,22 +1,39 @@
 import os
 import tornado
 import tornado.web
+import tornado.process
+import tornado.netutil
+import tornado.httpserver
 from tornado.log import enable_pretty_logging
 
 from configs import PORT
+from configs import QUALITY_TIERS
+from litar.types import Vector2Int
+from litar.pipeline.dpcp.panorama.static_data import get_static_data
 from service.api import api_v1_http_routes
+from service.api import metrics_http_routes
 from service.archer import archer_websocket_routes
+from service.stats import worker_stats
+from service.metrics import worker_metrics
+from litar.session import session_manager
 
 
 enable_pretty_logging()
 
 
-def start_service(port=PORT, debug=True):
+def start_service(port=PORT, debug=True, workers=1, stats_interval=60, evict_interval=60):
     """ Holds all the registered HTTP endpoints
+
+    With `workers` > 1 the listening socket is shared by forked worker
+    processes. Each WebSocket connection, and so each session, stays on
+    the worker that accepted it. Worker `i` also listens on its own port,
+    `port + 1 + i`, where resumes of its sessions are sent and where its
+    metrics can be scraped.
     """
 
     routes = [
         *api_v1_http_routes, # API HTTP routes, marked as version v1.
+        *metrics_http_routes, # Prometheus metrics of the worker.
         *archer_websocket_routes # WebSockets routes for debugging.
     ]
 
@@ -25,12 +42,46 @@ def start_service(port=PORT, debug=True):
     print('💡 Serving the following routes')
     print('\n'.join(['-> ' + v[0] for v in routes]) + '\n')
 
+    if workers > 1 and debug:
+        print('! Debug mode is disabled when running multiple workers')
+        debug = False
+
+    if workers > 1:
+        # Load static data before forking, so workers share the mappings
+        for tier in QUALITY_TIERS.values():
+            get_static_data(Vector2Int(
+                tier['panorama_width'], tier['panorama_height']))
+
+        sockets = tornado.netutil.bind_sockets(port)
+        task_id = tornado.process.fork_processes(workers)
+        worker_stats.reset(task_id)
+
     app = tornado.web.Application(
         routes,
         debug=debug,
         autoreload=debug)
 
-    app.listen(port)
+    if workers > 1:
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+
+        worker_port = port + 1 + task_id
+        server.add_sockets(tornado.netutil.bind_sockets(worker_port))
+        session_manager.worker_port = worker_port
+        worker_stats.port = worker_port
+
+        tornado.ioloop.PeriodicCallback(
+            lambda: print(f'! Worker stats: {worker_stats}, '
+                          f'sessions: {session_manager.to_dict()}'),
+            stats_interval * 1000).start()
+    else:
+        app.listen(port)
+
+    worker_metrics.watch_ioloop()
+
+    # Release sessions left idle by closed connections
+    tornado.ioloop.PeriodicCallback(
+        session_manager.evict_expired, evict_interval * 1000).start()
 
-    print('Tornado Server Started...')
+    print(f'Tornado Server Started... (worker {worker_stats.worker_id}, pid {worker_stats.pid})')
     tornado.ioloop.IOLoop.current().start()
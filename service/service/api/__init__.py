@@ -1,8 +1,11 @@
 from .reconstruction import reconstruction_http_routes
+from .worker import worker_http_routes
+from .metrics import metrics_http_routes
 
 r = [
-    *reconstruction_http_routes
+    *reconstruction_http_routes,
+    *worker_http_routes
 ]
 api_v1_http_routes = [(f'/api/{v[0]}', v[1]) for v in r]
 
-__all__ = ['api_v1_http_routes']
+__all__ = ['api_v1_http_routes', 'metrics_http_routes']
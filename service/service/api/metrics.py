@@ -0,0 +1,20 @@
+"""Prometheus scrape handler for the worker latency metrics."""
+from service.utils import BaseHttpRouter
+from service.metrics import worker_metrics
+from litar.session import session_manager
+
+
+class MetricsHandler(BaseHttpRouter):
+    def set_default_headers(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+
+    def get(self):
+        """Latency histograms of the worker process serving this request."""
+        self.write(worker_metrics.to_prometheus(session_manager.sessions()))
+
+
+metrics_http_routes = [
+    (r"/metrics", MetricsHandler)
+]
+
+__all__ = ['metrics_http_routes']
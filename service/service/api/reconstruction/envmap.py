@@ -0,0 +1,84 @@
+"""Environment map encoders for reconstruction responses."""
+import io
+import numpy as np
+from PIL import Image
+
+
+def encode_jpg(img: np.ndarray) -> bytes:
+    """Convert an uint8 RGB array to JPEG encoded bytes."""
+    img = Image.fromarray(img)
+
+    with io.BytesIO() as f_output:
+        img.save(f_output, format='JPEG')
+        contents = f_output.getvalue()
+
+    return contents
+
+
+class EnvMapTileEncoder:
+    """Encode environment map updates as the tiles changed since the last send.
+
+    Message layout (little endian):
+        u8 0x11 | u16 tile size | u16 number of tiles |
+        per tile: u16 tile column, u16 tile row, u32 JPEG length, JPEG bytes
+
+    A full environment map (u8 0x10 | JPEG bytes) is sent instead for the
+    first update, every `full_interval` updates, and whenever most tiles
+    changed, so clients can resynchronize.
+    """
+    tile_size: int
+    full_interval: int
+    full_ratio: float
+
+    __last: np.ndarray = None
+    __n_sent: int = 0
+
+    def __init__(self, tile_size=64, full_interval=30, full_ratio=0.5) -> None:
+        self.tile_size = tile_size
+        self.full_interval = full_interval
+        self.full_ratio = full_ratio
+
+    def dirty_tiles(self, env_map: np.ndarray):
+        """List (column, row) of the tiles that differ from the last sent map."""
+        t = self.tile_size
+        h, w = env_map.shape[:2]
+        rows, cols = (h + t - 1) // t, (w + t - 1) // t
+
+        changed = env_map.reshape((h, w * 3)) != self.__last.reshape((h, w * 3))
+
+        # Pad the changed bytes to whole tiles, then reduce each tile at once
+        if (rows * t, cols * t) != (h, w):
+            padded = np.zeros((rows * t, cols * t * 3), dtype=bool)
+            padded[:h, :w * 3] = changed
+            changed = padded
+        dirty = changed.reshape((rows, t, cols, t * 3)).any(axis=(1, 3))
+
+        return [(int(tx), int(ty)) for ty, tx in np.argwhere(dirty)]
+
+    def encode(self, env_map: np.ndarray) -> bytes:
+        """Encode an update, `env_map` is kept as the last sent map and must not be modified."""
+        t = self.tile_size
+        h, w = env_map.shape[:2]
+        n_tiles = ((h + t - 1) // t) * ((w + t - 1) // t)
+
+        full = self.__last is None \
+            or self.__last.shape != env_map.shape \
+            or self.__n_sent % self.full_interval == 0
+
+        tiles = [] if full else self.dirty_tiles(env_map)
+        full = full or len(tiles) > n_tiles * self.full_ratio
+
+        self.__last = env_map
+        self.__n_sent += 1
+
+        if full:
+            return b'\x10' + encode_jpg(env_map)
+
+        chunks = [b'\x11', np.array([t, len(tiles)], dtype='<u2').tobytes()]
+        for tx, ty in tiles:
+            jpg = encode_jpg(env_map[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t])
+            chunks.append(np.array([tx, ty], dtype='<u2').tobytes())
+            chunks.append(np.array([len(jpg)], dtype='<u4').tobytes())
+            chunks.append(jpg)
+
+        return b''.join(chunks)
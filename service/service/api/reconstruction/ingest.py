@@ -0,0 +1,89 @@
+"""Bounded per-session ingest queue for reconstruction packages."""
+from __future__ import annotations
+
+import time
+from typing import Hashable, List, Optional, Tuple
+from collections import OrderedDict
+
+import tornado.locks
+
+
+class IngestQueueOverflow(OverflowError):
+    """The queue is full of messages that can't be dropped."""
+    pass
+
+
+class KeyframeIngestQueue:
+    """Latest-wins queue of messages waiting for the pipeline.
+
+    Every message is put under a slot key. A message replaces the pending
+    message of the same slot, e.g. an older near field keyframe of the same
+    view, and the oldest droppable message is evicted when the queue is
+    full. Messages put with `droppable=False` are never replaced or evicted,
+    so the queue never holds more than `max_size` messages: a droppable
+    message finding only those is dropped itself, and other messages raise
+    `IngestQueueOverflow`.
+    """
+    max_size: int
+
+    __pending: OrderedDict
+    __event: tornado.locks.Event
+    __closed: bool = False
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.__pending = OrderedDict()
+        self.__event = tornado.locks.Event()
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def put(self, key: Hashable, message: bytes, droppable=True) -> List[Tuple[Hashable, bytes]]:
+        """Queue a message, returning the messages dropped to make room for it."""
+        dropped = []
+
+        if droppable and key in self.__pending:
+            dropped.append((key, self.__pending.pop(key)[0]))
+
+        elif len(self.__pending) >= self.max_size:
+            for k, (m, d, _) in self.__pending.items():
+                if d:
+                    dropped.append((k, m))
+                    del self.__pending[k]
+                    break
+            else:
+                if droppable:
+                    return [(key, message)]
+                raise IngestQueueOverflow(
+                    f'{len(self.__pending)} pending messages can\'t be dropped')
+
+        if not droppable:
+            key = (key, object())  # unique, never coalesced
+
+        self.__pending[key] = (message, droppable, time.perf_counter())
+        self.__event.set()
+
+        return dropped
+
+    async def get(self) -> Optional[Tuple[Hashable, bytes, float]]:
+        """Wait for the oldest pending message, None once the queue is closed.
+
+        Returns the key and the message, with the seconds it was pending.
+        """
+        while not self.__pending:
+            if self.__closed:
+                return None
+
+            self.__event.clear()
+            await self.__event.wait()
+
+        key, (message, _, t_put) = self.__pending.popitem(last=False)
+        return key, message, time.perf_counter() - t_put
+
+    def clear(self) -> None:
+        self.__pending.clear()
+
+    def close(self) -> None:
+        self.__closed = True
+        self.__pending.clear()
+        self.__event.set()
@@ -1,24 +1,47 @@
 """Service API handler for reconstruction keyframes."""
-import io
 import os
 import time
 import shutil
 import datetime
+import functools
+import traceback
 import imageio
 import numpy as np
 import open3d as o3d
+import tornado.locks
+import tornado.ioloop
 import tornado.websocket
 from uuid import UUID
-from PIL import Image
-from profilehooks import profile, timecall
 
-from configs import PANORAMA_WIDTH
+from configs import KEYFRAME_QUEUE_SIZE
+from configs import BATCH_KEYFRAMES
+from configs import ENV_MAP_TILE_SIZE
+from configs import ENV_MAP_FULL_INTERVAL
+from configs import SESSION_SNAPSHOT_INTERVAL
 from litar.session import SessionConfigs
 from litar.session import LightingReconstructionSession
+from litar.session import SessionBudgetExceeded
+from litar.session import session_manager
+from litar.session import save_snapshot
+from litar.session import read_snapshot
 
 from service.schema import SessionInitPackage
+from service.schema import SessionResumePackage
 from service.schema import NearFieldKeyFramePackage
 from service.schema.keyframe import FarFieldKeyFramePackage
+from service.schema.keyframe import CompressedNearFieldKeyFramePackage
+from service.schema.keyframe import CompressedFarFieldKeyFramePackage
+from service.schema.response import RESPONSE_MODES
+from service.stats import worker_stats
+from service.metrics import worker_metrics
+from service.executor import pipeline_executor
+from service.scheduler import keyframe_scheduler
+from service.api.reconstruction.ingest import KeyframeIngestQueue
+from service.api.reconstruction.ingest import IngestQueueOverflow
+from service.api.reconstruction.envmap import EnvMapTileEncoder
+from service.api.reconstruction.envmap import encode_jpg
+from service.api.reconstruction.response import encode_response
+from service.api.reconstruction.response import env_map_for_unity
 
 
 class ReconKeyframeWSHandler(tornado.websocket.WebSocketHandler):
@@ -26,24 +49,41 @@ class ReconKeyframeWSHandler(tornado.websocket.WebSocketHandler):
     __debug: bool = False
     __n_frame: int = 0
 
-    session: LightingReconstructionSession
+    session: LightingReconstructionSession = None
+    ingest_queue: KeyframeIngestQueue
+    tile_encoder: EnvMapTileEncoder
+    consumer_done: tornado.locks.Event  # set once consume_messages returned
 
     def open(self):
         """Handling socket opening."""
         print('! WebSocket Opened')
 
+        self.ingest_queue = KeyframeIngestQueue(KEYFRAME_QUEUE_SIZE)
+        self.consumer_done = tornado.locks.Event()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.consume_messages)
+
+        worker_stats.n_sessions_opened += 1
+        worker_stats.n_sessions_active += 1
+
         self._t_start = time.time()
         self._t_stamp = datetime.datetime.now().strftime('%m-%d-%Y_%H-%M-%S')
-        os.makedirs(f'./tmp/session_recording/{self._t_stamp}')
+        os.makedirs(f'./tmp/session_recording/{self._t_stamp}', exist_ok=True)
 
         # shutil.rmtree('./tmp/session')
         # os.mkdir('./tmp/session')
 
-    # @profile(immediate=True)
     def on_message(self, message):
         """Called when new message received
         message: bytes | str
+
+        Binary packages are queued for `consume_messages`, so the socket
+        keeps being read while the pipeline is busy and stale keyframes can
+        be coalesced.
         """
+        # Messages already read when the server closed the connection
+        if self.ws_connection is None:
+            return
+
         if type(message) is str:
             self.on_string_received(message)
             return
@@ -52,81 +92,327 @@ class ReconKeyframeWSHandler(tornado.websocket.WebSocketHandler):
         if self.__debug:
             self.dump_message(message)
 
+        self.__n_frame += 1
+
+        # Near field keyframes are coalesced per view
+        if message[0] in (0b0001_0000, 0b0001_0010):
+            key = (message[0], int.from_bytes(message[1:5], 'little', signed=True))
+            dropped = self.ingest_queue.put(key, message)
+
+        # Far field keyframes are coalesced into the newest one
+        elif message[0] in (0b0001_0001, 0b0001_0011):
+            key = (message[0], -1)
+            dropped = self.ingest_queue.put(key, message)
+
+        else:
+            try:
+                dropped = self.ingest_queue.put(message[0], message, droppable=False)
+            except IngestQueueOverflow as e:
+                print(f'! Closing a flooding connection: {e}')
+                self.close(1008, 'Too many pending messages')
+                return
+
+        worker_stats.n_keyframes_dropped += len(dropped)
+        for (identifier, view_index), _ in dropped:
+            print(f'! Dropped a stale keyframe {identifier} of view {view_index}')
+            self.send_message(b'\x21' + bytes([identifier]) +
+                              view_index.to_bytes(4, 'little', signed=True))
+
+        # Ask the client to slow down when the queue is full
+        if len(self.ingest_queue) >= KEYFRAME_QUEUE_SIZE:
+            self.send_message(b'\x20' + bytes([min(len(self.ingest_queue), 255)]))
+
+    async def consume_messages(self):
+        """Process queued packages of this connection one at a time.
+
+        The session is snapshotted every `SESSION_SNAPSHOT_INTERVAL`
+        keyframes and once the connection closes, between keyframes. The
+        stage latencies of keyframes are observed into `worker_metrics`.
+        """
+        n_keyframes = 0
+
+        while True:
+            item = await self.ingest_queue.get()
+            if item is None:
+                break
+
+            is_keyframe = item[1][0] in (
+                0b0001_0000, 0b0001_0001, 0b0001_0010, 0b0001_0011)
+            if is_keyframe:
+                worker_stats.n_keyframes += 1
+                n_keyframes += 1
+
+            t_start = time.perf_counter()
+
+            try:
+                await self.dispatch_message(item[1])
+
+                # Timings of other packages, e.g. resumes, are discarded
+                if self.session is not None:
+                    frame = self.session.timer.pop()
+                    if is_keyframe:
+                        frame['queue_wait'] = item[2]
+                        frame['handler'] = time.perf_counter() - t_start
+                        worker_metrics.observe(self.session, frame)
+
+                if is_keyframe and SESSION_SNAPSHOT_INTERVAL > 0 and \
+                        n_keyframes % SESSION_SNAPSHOT_INTERVAL == 0:
+                    await self.run_in_pipeline(save_snapshot, self.session)
+            except Exception:
+                traceback.print_exc()
+
+        if self.session is not None:
+            try:
+                await self.run_in_pipeline(save_snapshot, self.session)
+            except Exception:
+                traceback.print_exc()
+
+        self.consumer_done.set()
+
+    async def dispatch_message(self, message: bytes):
         # Dispatch message
         if message[0] == 0b0000_0000:  # Session Init
             pkg = SessionInitPackage(message)
-            self.on_session_init(pkg)
+            await self.on_session_init(pkg)
+
+        elif message[0] == 0b0000_0010:  # Session Resume
+            pkg = SessionResumePackage(message)
+            await self.on_session_resume(pkg)
 
         # Near field keyframe
         elif message[0] == 0b0001_0000:
-            pkg = NearFieldKeyFramePackage(
-                message,
-                self.session.configs.color_dense_sample_size,
-                self.session.configs.depth_native_size)
+            with self.session.timer.stage('parse'):
+                pkg = NearFieldKeyFramePackage(
+                    message,
+                    self.session.configs.color_dense_sample_size,
+                    self.session.configs.depth_native_size)
 
-            self.on_near_field_keyframe_received(pkg)
+            await self.on_near_field_keyframe_received(pkg)
 
         # Far field keyframe
         elif message[0] == 0b0001_0001:
-            pkg = FarFieldKeyFramePackage(
-                message,
-                self.session.configs.color_sparse_sample_size)
+            with self.session.timer.stage('parse'):
+                pkg = FarFieldKeyFramePackage(
+                    message,
+                    self.session.configs.color_sparse_sample_size)
+
+            await self.on_far_field_keyframe_received(pkg)
 
-            self.on_far_field_keyframe_received(pkg)
+        # Compressed keyframes, decoded on the pipeline executor
+        elif message[0] == 0b0001_0010:
+            with self.session.timer.stage('parse'):
+                pkg = await self.run_in_pipeline(
+                    CompressedNearFieldKeyFramePackage,
+                    message,
+                    self.session.configs.color_dense_sample_size,
+                    self.session.configs.depth_native_size)
+
+            await self.on_near_field_keyframe_received(pkg)
+
+        elif message[0] == 0b0001_0011:
+            with self.session.timer.stage('parse'):
+                pkg = await self.run_in_pipeline(
+                    CompressedFarFieldKeyFramePackage,
+                    message,
+                    self.session.configs.color_sparse_sample_size)
+
+            await self.on_far_field_keyframe_received(pkg)
 
         else:
             print(f'! Unrecognized package with header {message[0]}')
-            return
-
-        self.__n_frame += 1
 
     def on_close(self):
         """Handling socket closes."""
         print('! WebSocket Closed')
 
+        self.ingest_queue.close()
+        worker_stats.n_sessions_active -= 1
+
+        # The session stays registered while idle, until evicted
+        if self.session is not None:
+            session_manager.detach(self.session.configs.s_id, self)
+
+    async def create_session(self, s_configs: SessionConfigs, create):
+        """Create and register a session within the memory budget.
+
+        Room is made for the session before `create()` allocates it
+        on the pipeline executor. Returns None, closing the connection, if
+        the session doesn't fit in the budget.
+        """
+        try:
+            session_manager.reserve(s_configs)
+        except SessionBudgetExceeded as e:
+            print(f'! Session rejected: {e}')
+            self.close(1013, 'Session memory budget exceeded')
+            return None
+
+        try:
+            session = await self.run_in_pipeline(create)
+        except Exception:
+            session_manager.release(s_configs.s_id)
+            raise
+
+        session_manager.add(session, self)
+        return session
+
+    async def hand_over_session(self):
+        """Stop using the session for another connection resuming it.
+
+        The connection is closed and the session detached, then returns
+        once the package being processed, if any, is done with it.
+        """
+        print(f'! Session {self.session.configs.s_id} resumed by another connection')
+
+        session_manager.detach(self.session.configs.s_id, self)
+        self.ingest_queue.close()
+        self.close(1000, 'Session resumed by another connection')
+
+        await self.consumer_done.wait()
+
     def on_string_received(self, message: str):
         print(f'< {message}')
 
-    def on_session_init(self, pkg: SessionInitPackage):
+    async def on_session_init(self, pkg: SessionInitPackage):
+        if pkg.response_mode not in RESPONSE_MODES:
+            print(f'! Unknown response mode {pkg.response_mode}, '
+                  f'sending full environment maps instead')
+
         s_configs = SessionConfigs(pkg)
-        self.session = LightingReconstructionSession(s_configs)
+        session = await self.create_session(
+            s_configs, functools.partial(LightingReconstructionSession, s_configs))
+        if session is None:
+            return
+
+        if self.session is not None:
+            session_manager.detach(self.session.configs.s_id, self)
+
+        self.session = session
+        self.tile_encoder = EnvMapTileEncoder(
+            ENV_MAP_TILE_SIZE, ENV_MAP_FULL_INTERVAL)
 
         print(f'! New session initialized: {s_configs.s_id}\n\n{pkg}\n')
-        self.write_message(b'\x01' + str(s_configs.s_id).encode(), binary=True)
+        self.send_message(b'\x01' + str(s_configs.s_id).encode())
+
+    async def on_session_resume(self, pkg: SessionResumePackage):
+        """Resume a session kept in memory or snapshotted to disk.
 
-    # @profile(immediate=True)
-    def on_near_field_keyframe_received(self, pkg: NearFieldKeyFramePackage):
+        Replies with the init reply and the current lighting, or with 0x02
+        when the session is unknown, the client then starts a new session.
+        A session still attached to another connection, e.g. one the client
+        lost without the server noticing yet, is taken over from it. A
+        session held by another worker is answered with 0x03 and the port
+        of that worker, for the client to resume it there.
+        """
+        port = session_manager.locate(pkg.s_id)
+        if port is not None:
+            print(f'! Session {pkg.s_id} is held by the worker on port {port}')
+            self.send_message(b'\x03' + port.to_bytes(4, 'little', signed=True))
+            return
+
+        previous = session_manager.owner(pkg.s_id)
+        while previous is not None and previous is not self:
+            await previous.hand_over_session()
+            previous = session_manager.owner(pkg.s_id)
+
+        session = session_manager.attach(pkg.s_id, self)
+
+        if session is None:
+            state = await self.run_in_pipeline(read_snapshot, pkg.s_id)
+
+            if state is not None:
+                s_configs = LightingReconstructionSession.snapshot_configs(state)
+                session = await self.create_session(s_configs, functools.partial(
+                    LightingReconstructionSession.restore, state, configs=s_configs))
+                if session is None:
+                    return
+
+        if session is None:
+            print(f'! Unknown session {pkg.s_id}, cannot resume')
+            self.send_message(b'\x02')
+            return
+
+        if self.session is not None and self.session is not session:
+            session_manager.detach(self.session.configs.s_id, self)
+
+        self.session = session
+        self.tile_encoder = EnvMapTileEncoder(
+            ENV_MAP_TILE_SIZE, ENV_MAP_FULL_INTERVAL)
+
+        print(f'! Session resumed: {pkg.s_id}')
+        self.send_message(b'\x01' + str(pkg.s_id).encode())
+
+        response = await self.run_in_pipeline(self.process_resume)
+        self.send_message(response)
+
+    async def on_near_field_keyframe_received(self, pkg: NearFieldKeyFramePackage):
         print(f'! New near field keyframe: {pkg}')
+        session_manager.touch(self.session.configs.s_id)
 
-        self.session.reconstruct_near_field_pcd(pkg)
-        self.session.run_direct_point_cloud_projection()
+        if BATCH_KEYFRAMES:
+            response = await keyframe_scheduler.submit(
+                self.session, pkg,
+                functools.partial(self.process_near_field_keyframe, pkg, True))
+        else:
+            response = await self.run_in_pipeline(self.process_near_field_keyframe, pkg)
+        self.send_message(response)
 
-        env_map = self.convert_env_map_for_unity()
-        self.write_message(b'\x10' + env_map, binary=True)
+    async def on_far_field_keyframe_received(self, pkg: FarFieldKeyFramePackage):
+        print(f'! New far field keyframe: {pkg}')
+        session_manager.touch(self.session.configs.s_id)
+
+        response = await self.run_in_pipeline(self.process_far_field_keyframe, pkg)
+        self.send_message(response)
+
+    def process_near_field_keyframe(self, pkg: NearFieldKeyFramePackage,
+                                    points_generated: bool = False) -> bytes:
+        """Run on the pipeline executor."""
+        self.session.reconstruct_near_field_pcd(pkg, points_generated)
+        self.session.run_direct_point_cloud_projection()
 
         if self.__debug:
             self.session.dump_point_cloud()
 
-    def on_far_field_keyframe_received(self, pkg: FarFieldKeyFramePackage):
-        print(f'! New far field keyframe: {pkg}')
+        return self.make_response()
 
+    def process_far_field_keyframe(self, pkg: FarFieldKeyFramePackage) -> bytes:
+        """Run on the pipeline executor."""
         self.session.reconstruct_far_field_pcd(pkg)
         self.session.run_direct_point_cloud_projection()
 
-        env_map = self.convert_env_map_for_unity()
-        self.write_message(b'\x10' + env_map, binary=True)
-
         if self.__debug:
             self.session.dump_anchors()
 
-    def convert_env_map_for_unity(self, encode_jpg=True):
-        env_map = np.copy(self.session.renderer.arg_out_canvas)
-        env_map = env_map.astype(np.uint8)
-        # env_map = np.flipud(env_map)
+        return self.make_response()
+
+    def process_resume(self) -> bytes:
+        """Run on the pipeline executor."""
+        self.session.run_direct_point_cloud_projection()
+
+        return self.make_response()
+
+    def make_response(self) -> bytes:
+        """Encode the lighting in the response mode requested by the client."""
+        # Save the envmap updates for comparisons
+        if self.__debug:
+            self.convert_env_map_for_unity(encode_jpg=False)
+
+        with self.session.timer.stage('encode'):
+            return encode_response(self.session, self.tile_encoder)
+
+    @staticmethod
+    def run_in_pipeline(func, *args):
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            pipeline_executor, func, *args)
 
-        shift = PANORAMA_WIDTH // 4
-        env_map = np.concatenate(
-            (env_map[:, shift:, :], env_map[:, :shift, :]), axis=1)
+    def send_message(self, message: bytes):
+        """Send a binary message, ignoring sockets closed while processing."""
+        try:
+            self.write_message(message, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            print('! WebSocket closed before the response was sent')
+
+    def convert_env_map_for_unity(self, encode_jpg=True):
+        env_map = env_map_for_unity(self.session)
 
         t_now = time.time()
         t_elapsed = t_now - self._t_start
@@ -143,18 +429,12 @@ class ReconKeyframeWSHandler(tornado.websocket.WebSocketHandler):
         if encode_jpg:
             return self.encode_env_map_jpg(env_map)
         else:
-            return env_map.tobytes()
+            return env_map
 
     @staticmethod
     def encode_env_map_jpg(env_map: np.ndarray):
         """Convert input environment map array to JPEG encoded bytes."""
-        img = Image.fromarray(env_map)
-
-        with io.BytesIO() as f_output:
-            img.save(f_output, format='JPEG')
-            contents = f_output.getvalue()
-
-        return contents
+        return encode_jpg(env_map)
 
     def dump_message(self, message: bytes):
         t = np.frombuffer(message, dtype=np.uint8)
@@ -0,0 +1,52 @@
+"""Encoders of the lighting sent back to clients."""
+import numpy as np
+
+from litar.pipeline.lighting import anchor_dominant_light
+from litar.pipeline.lighting import anchor_spherical_harmonics
+from litar.session import LightingReconstructionSession
+from service.schema.response import RESPONSE_MODE_ENV_MAP_TILES
+from service.schema.response import RESPONSE_MODE_SH9
+from service.schema.response import RESPONSE_MODE_DOMINANT_LIGHT
+from service.schema.response import RESPONSE_MODE_ANCHOR_PALETTE
+from service.api.reconstruction.envmap import EnvMapTileEncoder
+from service.api.reconstruction.envmap import encode_jpg
+
+
+def env_map_for_unity(session: LightingReconstructionSession) -> np.ndarray:
+    """The environment map of a session as uint8 RGB, rotated for Unity."""
+    env_map = np.asarray(session.renderer.arg_out_canvas).astype(np.uint8)
+
+    shift = session.configs.panorama_size.x // 4
+    return np.concatenate(
+        (env_map[:, shift:, :], env_map[:, :shift, :]), axis=1)
+
+
+def encode_response(session: LightingReconstructionSession,
+                    tile_encoder: EnvMapTileEncoder) -> bytes:
+    """Encode the lighting in the response mode requested by the client.
+
+    Compact modes are computed from the anchors in the anchor frame:
+    0x12: float32 (3, 9) SH coefficients, one row per RGB channel
+    0x13: float32 direction (3), light color (3) and ambient color (3)
+    0x14: uint16 number of anchors, then uint8 RGB per anchor
+    """
+    mode = session.configs.response_mode
+    anchor_xyz = session.renderer.arg_in_anchor_xyz
+    anchor_rgb = session.renderer.arg_inout_anchor_rgb
+
+    if mode == RESPONSE_MODE_ENV_MAP_TILES:
+        return tile_encoder.encode(env_map_for_unity(session))
+
+    if mode == RESPONSE_MODE_SH9:
+        sh = anchor_spherical_harmonics(anchor_xyz, anchor_rgb)
+        return b'\x12' + sh.astype('<f4').tobytes()
+
+    if mode == RESPONSE_MODE_DOMINANT_LIGHT:
+        light = anchor_dominant_light(anchor_xyz, anchor_rgb)
+        return b'\x13' + np.concatenate(light).astype('<f4').tobytes()
+
+    if mode == RESPONSE_MODE_ANCHOR_PALETTE:
+        n_anchors = np.array([anchor_rgb.shape[0]], dtype='<u2')
+        return b'\x14' + n_anchors.tobytes() + np.asarray(anchor_rgb).tobytes()
+
+    return b'\x10' + encode_jpg(env_map_for_unity(session))
@@ -0,0 +1,7 @@
+from .stats import stats_http_routes
+
+r = [
+    *stats_http_routes
+]
+
+worker_http_routes = [(f'worker/{v[0]}', v[1]) for v in r]
@@ -0,0 +1,22 @@
+"""Service API handler for worker process statistics."""
+from service.utils import BaseHttpRouter
+from service.stats import worker_stats
+from service.metrics import worker_metrics
+from litar.session import session_manager
+
+
+class WorkerStatsHandler(BaseHttpRouter):
+    def get(self):
+        """Statistics of the worker process serving this request."""
+        self.json({
+            **worker_stats.to_dict(),
+            'sessions': session_manager.to_dict(),
+            'latency': worker_metrics.to_dict()
+        })
+
+
+stats_http_routes = [
+    (r"stats/", WorkerStatsHandler)
+]
+
+__all__ = ['stats_http_routes']
@@ -0,0 +1,10 @@
+"""Thread pool running the reconstruction pipeline off the Tornado IOLoop."""
+from concurrent.futures import ThreadPoolExecutor
+
+from configs import PIPELINE_WORKERS
+
+pipeline_executor = ThreadPoolExecutor(
+    max_workers=PIPELINE_WORKERS,
+    thread_name_prefix='pipeline')
+
+__all__ = ['pipeline_executor']
@@ -0,0 +1,237 @@
+"""Synthetic multi-client load generator for the keyframe WebSocket."""
+import json
+import time
+import asyncio
+import numpy as np
+from collections import deque
+from typing import List, Optional
+
+from tornado.websocket import websocket_connect
+
+from configs import PORT
+from service.replay import load_recording
+
+# Server messages answering a keyframe
+LIGHTING_RESPONSES = (0x10, 0x11, 0x12, 0x13, 0x14)
+
+
+def session_init_bytes(views: int, native: tuple, dense: tuple, sparse: tuple,
+                       tier: int = None, exp_time_window: int = 0) -> bytes:
+    """Encode a session initialization package, as the Unity client does."""
+    k = np.array([0.75 * dense[0], 0.75 * dense[0], dense[0] / 2, dense[1] / 2])
+
+    pkg = bytes([0b0000_0000])
+    pkg += np.array([views, exp_time_window, 2 * 100], dtype='<i4').tobytes()
+    pkg += np.array([6500, 1.0], dtype='<f4').tobytes()  # ambient temperature, brightness
+    pkg += k.astype('<f4').tobytes()
+    pkg += np.array([*native, *dense, *sparse], dtype='<i4').tobytes()
+
+    if tier is not None:
+        pkg += np.array([tier], dtype='<i4').tobytes()
+
+    return pkg
+
+
+def yaw_trs(angle: float) -> np.ndarray:
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s, 0], [0, 1, 0, 0], [-s, 0, c, 0]], dtype='<f4')
+
+
+def near_field_bytes(view: int, native: tuple, dense: tuple, rng: np.random.Generator) -> bytes:
+    """Encode a near field keyframe of random colors and depths, facing the view."""
+    n_color = dense[0] * dense[1]
+
+    pkg = bytes([0b0001_0000])
+    pkg += np.array([view], dtype='<i4').tobytes()
+    pkg += yaw_trs(view * 2 * np.pi / 8).tobytes()
+    pkg += rng.integers(0, 256, n_color + n_color // 2, dtype=np.uint8).tobytes()
+    pkg += rng.uniform(0.5, 3.0, native[0] * native[1]).astype('<f4').tobytes()
+
+    return pkg
+
+
+def far_field_bytes(sparse: tuple, rng: np.random.Generator) -> bytes:
+    """Encode a far field keyframe of random colors."""
+    n_color = sparse[0] * sparse[1]
+
+    pkg = bytes([0b0001_0001])
+    pkg += yaw_trs(rng.uniform(0, 2 * np.pi))[:, :3].tobytes()
+    pkg += rng.integers(0, 256, n_color + n_color // 2, dtype=np.uint8).tobytes()
+
+    return pkg
+
+
+class LoadClient:
+    """One simulated AR client, sending keyframes at a fixed rate.
+
+    Keyframes are sent regardless of the responses, like the auto capture
+    of the Unity client, so an overloaded server drops them. Responses come
+    back in the order the server processed the keyframes, so each response
+    is matched with the oldest keyframe that is neither answered nor
+    dropped.
+    """
+    n_sent: int
+    n_dropped: int
+    n_busy: int
+    latencies: List[float]
+    error: Optional[str]
+
+    __in_flight: deque  # (key, send time) of keyframes waiting for a response
+
+    def __init__(self, url: str, init: bytes, keyframes: List[bytes],
+                 rate: float, duration: float) -> None:
+        self.url = url
+        self.init = init
+        self.keyframes = keyframes
+        self.rate = rate
+        self.duration = duration
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_busy = 0
+        self.latencies = []
+        self.error = None
+
+        self.__in_flight = deque()
+
+    async def run(self) -> None:
+        try:
+            ws = await websocket_connect(self.url, max_message_size=64 * 1024 ** 2)
+        except Exception as e:
+            self.error = repr(e)
+            return
+
+        await ws.write_message(self.init, binary=True)
+        reply = await ws.read_message()
+        if reply is None or reply[0] != 0x01:
+            self.error = 'Session init failed'
+            ws.close()
+            return
+
+        reader = asyncio.ensure_future(self.read(ws))
+
+        t_end = time.perf_counter() + self.duration
+        while time.perf_counter() < t_end and not reader.done():
+            t_next = time.perf_counter() + 1 / self.rate
+            await self.send(ws, self.keyframes[self.n_sent % len(self.keyframes)])
+            await asyncio.sleep(max(0.0, t_next - time.perf_counter()))
+
+        # Give the pending keyframes a chance to be answered
+        t_drain = time.perf_counter() + 10
+        while self.__in_flight and not reader.done() and time.perf_counter() < t_drain:
+            await asyncio.sleep(0.05)
+
+        ws.close()
+        await asyncio.gather(reader, return_exceptions=True)
+
+    async def send(self, ws, keyframe: bytes) -> None:
+        # Same keys as the server, near field keyframes are coalesced per view
+        view = -1
+        if keyframe[0] in (0x10, 0x12):
+            view = int.from_bytes(keyframe[1:5], 'little', signed=True)
+
+        key = (keyframe[0], view)
+
+        self.__in_flight.append((key, time.perf_counter()))
+        self.n_sent += 1
+        await ws.write_message(keyframe, binary=True)
+
+    async def read(self, ws) -> None:
+        while True:
+            message = await ws.read_message()
+            if message is None:
+                return
+
+            if message[0] in LIGHTING_RESPONSES and self.__in_flight:
+                _, t_send = self.__in_flight.popleft()
+                self.latencies.append(time.perf_counter() - t_send)
+
+            elif message[0] == 0x20:
+                self.n_busy += 1
+
+            elif message[0] == 0x21:
+                view = int.from_bytes(message[2:6], 'little', signed=True)
+                self.__drop((message[1], view))
+
+    def __drop(self, key) -> None:
+        for i, (k, _) in enumerate(self.__in_flight):
+            if k == key:
+                del self.__in_flight[i]
+                self.n_dropped += 1
+                return
+
+
+def loadtest(clients: int = 4, duration: float = 30, rate: float = 3, far_field_every: int = 10,
+             views: int = 5, native=(256, 192), dense=(1024, 768), sparse=(32, 24),
+             tier: int = None, recording: str = None, url: str = None,
+             ramp_up: float = 1.0, seed: int = 0, output: str = None):
+    """Load the keyframe WebSocket with simulated clients and report as JSON.
+
+    Each of the `clients` sessions sends `rate` keyframes per second for
+    `duration` seconds, a far field keyframe every `far_field_every` ones,
+    and starts `ramp_up` seconds after the previous client. Keyframes are
+    synthetic, with the given image sizes, or the ones of a `recording`.
+    The report is printed, and written to `output` if given.
+    """
+    url = f'ws://localhost:{PORT}/api/reconstruction/keyframe/' if url is None else url
+
+    if recording is not None:
+        messages = load_recording(recording)
+        init = next(m for m in messages if m[0] == 0b0000_0000)
+        keyframes = [m for m in messages if m[0] in (0x10, 0x11, 0x12, 0x13)]
+    else:
+        rng = np.random.default_rng(seed)
+        init = session_init_bytes(views, native, dense, sparse, tier)
+        keyframes = []
+        for i in range(max(views, far_field_every)):
+            if far_field_every > 0 and (i + 1) % far_field_every == 0:
+                keyframes.append(far_field_bytes(sparse, rng))
+            else:
+                keyframes.append(near_field_bytes(i % views, native, dense, rng))
+
+    load_clients = [LoadClient(url, init, keyframes, rate, duration)
+                    for _ in range(clients)]
+
+    async def run_clients():
+        async def start(i: int, client: LoadClient):
+            await asyncio.sleep(i * ramp_up)
+            await client.run()
+
+        await asyncio.gather(*[start(i, c) for i, c in enumerate(load_clients)])
+
+    t_start = time.perf_counter()
+    asyncio.run(run_clients())
+    t_elapsed = time.perf_counter() - t_start
+
+    latencies = np.array([t for c in load_clients for t in c.latencies]) * 1e3
+    n_sent = sum([c.n_sent for c in load_clients])
+
+    report = {
+        'url': url,
+        'clients': clients,
+        'rate': rate,
+        'keyframe_bytes': int(np.mean([len(k) for k in keyframes])),
+        'elapsed': t_elapsed,
+        'n_sent': n_sent,
+        'n_responses': len(latencies),
+        'n_dropped': sum([c.n_dropped for c in load_clients]),
+        'n_busy': sum([c.n_busy for c in load_clients]),
+        'n_unanswered': n_sent - len(latencies) - sum([c.n_dropped for c in load_clients]),
+        'throughput': len(latencies) / t_elapsed,
+        'errors': [c.error for c in load_clients if c.error is not None]
+    }
+
+    if len(latencies) > 0:
+        report['latency_ms'] = {
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max())
+        }
+
+    text = json.dumps(report, indent=2)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+
+    print(text)
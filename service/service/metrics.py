@@ -0,0 +1,107 @@
+"""Per-process latency metrics, exposed in the Prometheus text format."""
+import os
+from typing import Dict, Iterable, List
+
+import tornado.ioloop
+
+from litar.session import Histogram
+from litar.session import StageHistograms
+from litar.session import LightingReconstructionSession
+
+
+class WorkerMetrics:
+    """Latency histograms of the worker process.
+
+    Keyframe stage latencies are aggregated per quality tier here, and per
+    session on the sessions themselves, so per session series go away with
+    evicted sessions. Stages include the pipeline stages of `StageTimer`,
+    `queue_wait` in the ingest queue and the whole `handler` time.
+    """
+    tiers: Dict[int, StageHistograms]
+    ioloop_lag: Histogram
+
+    def __init__(self) -> None:
+        self.tiers = {}
+        self.ioloop_lag = Histogram()
+
+    def observe(self, session: LightingReconstructionSession, frame: Dict[str, float]) -> None:
+        """Observe the stage timings of a keyframe processed by a session."""
+        tier = session.configs.quality_tier
+        if tier not in self.tiers:
+            self.tiers[tier] = StageHistograms()
+
+        self.tiers[tier].observe(frame)
+        session.latency.observe(frame)
+
+    def watch_ioloop(self, interval: float = 0.5) -> None:
+        """Observe how late the IOLoop runs a callback scheduled every `interval` seconds."""
+        loop = tornado.ioloop.IOLoop.current()
+
+        def tick(t_expected: float):
+            t_now = loop.time()
+            self.ioloop_lag.observe(max(0.0, t_now - t_expected))
+            loop.call_at(t_now + interval, tick, t_now + interval)
+
+        loop.call_later(interval, tick, loop.time() + interval)
+
+    def to_dict(self) -> dict:
+        """p50 and p99 estimates of the stage latencies per tier, in milliseconds."""
+        return {
+            str(tier): {
+                stage: {
+                    'p50_ms': h.quantile(0.5) * 1e3,
+                    'p99_ms': h.quantile(0.99) * 1e3,
+                    'count': h.count
+                } for stage, h in histograms.items()
+            } for tier, histograms in sorted(self.tiers.items())
+        }
+
+    def to_prometheus(self, sessions: Iterable[LightingReconstructionSession]) -> str:
+        worker = {'worker': str(os.getpid())}
+        lines = []
+
+        lines += histogram_family(
+            'litar_stage_seconds',
+            'Latency of the keyframe stages, per quality tier.',
+            [({**worker, 'tier': str(tier), 'stage': stage}, h)
+             for tier, histograms in sorted(self.tiers.items())
+             for stage, h in histograms.items()])
+
+        lines += histogram_family(
+            'litar_session_stage_seconds',
+            'Latency of the keyframe stages, per registered session.',
+            [({**worker, 'session': str(s.configs.s_id), 'stage': stage}, h)
+             for s in sessions
+             for stage, h in s.latency.items()])
+
+        lines += histogram_family(
+            'litar_ioloop_lag_seconds',
+            'Delay of the IOLoop callbacks.',
+            [(worker, self.ioloop_lag)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_family(name: str, description: str, series) -> List[str]:
+    """Render histograms with their labels as a Prometheus metric family."""
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+
+    for labels, h in series:
+        n = 0
+        for bound, count in zip([*h.buckets, '+Inf'], h.counts):
+            n += count
+            lines.append(f'{name}_bucket{format_labels({**labels, "le": str(bound)})} {n}')
+
+        lines.append(f'{name}_sum{format_labels(labels)} {h.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {h.count}')
+
+    return lines
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return '{' + ','.join([f'{k}="{v}"' for k, v in labels.items()]) + '}'
+
+
+worker_metrics = WorkerMetrics()
+
+__all__ = ['worker_metrics']
@@ -0,0 +1,167 @@
+"""Replay recorded sessions through the pipeline, without the server."""
+import os
+import json
+import time
+import numpy as np
+from typing import Dict, List
+
+from configs import ENV_MAP_TILE_SIZE
+from configs import ENV_MAP_FULL_INTERVAL
+from litar.pipeline.backend import resolve_backend
+from litar.session import SessionConfigs
+from litar.session import LightingReconstructionSession
+
+from service.schema import SessionInitPackage
+from service.schema import NearFieldKeyFramePackage
+from service.schema.keyframe import FarFieldKeyFramePackage
+from service.schema.keyframe import CompressedNearFieldKeyFramePackage
+from service.schema.keyframe import CompressedFarFieldKeyFramePackage
+from service.api.reconstruction.envmap import EnvMapTileEncoder
+from service.api.reconstruction.response import encode_response
+
+
+def load_recording(recording: str) -> List[bytes]:
+    """Load the messages of a recording, in the order they were received.
+
+    Recordings are the `{n_frame}.npy` files dumped by the keyframe handler
+    in debug mode, e.g. `./tmp/session_recording/<timestamp>`.
+    """
+    names = [n for n in os.listdir(recording)
+             if n.endswith('.npy') and n[:-4].isdigit()]
+    names.sort(key=lambda n: int(n[:-4]))
+
+    return [np.load(os.path.join(recording, n)).tobytes() for n in names]
+
+
+def parse_keyframe(message: bytes, configs: SessionConfigs):
+    """Parse a keyframe package, None for other packages."""
+    c_dense = configs.color_dense_sample_size
+    c_sparse = configs.color_sparse_sample_size
+
+    if message[0] == 0b0001_0000:
+        return NearFieldKeyFramePackage(message, c_dense, configs.depth_native_size)
+    if message[0] == 0b0001_0001:
+        return FarFieldKeyFramePackage(message, c_sparse)
+    if message[0] == 0b0001_0010:
+        return CompressedNearFieldKeyFramePackage(message, c_dense, configs.depth_native_size)
+    if message[0] == 0b0001_0011:
+        return CompressedFarFieldKeyFramePackage(message, c_sparse)
+
+    return None
+
+
+def replay_messages(messages: List[bytes], backend: str = None) -> List[Dict[str, float]]:
+    """Process the messages of a recording back to back.
+
+    Returns the stage timings of each keyframe, in seconds, with `total`
+    covering the whole keyframe. Session initializations are timed as the
+    `init` stage of the next keyframe. Messages are replayed as fast as
+    possible, so captures only expire with windows shorter than the replay.
+    """
+    frames = []
+    session = None
+    tile_encoder = None
+    t_init = 0.0
+
+    for message in messages:
+        if message[0] == 0b0000_0000:
+            t_start = time.perf_counter()
+            session = LightingReconstructionSession(
+                SessionConfigs(SessionInitPackage(message), backend=backend))
+            tile_encoder = EnvMapTileEncoder(
+                ENV_MAP_TILE_SIZE, ENV_MAP_FULL_INTERVAL)
+            t_init += time.perf_counter() - t_start
+            continue
+
+        if session is None:
+            print(f'! Skipped package {message[0]} received before the session init')
+            continue
+
+        t_start = time.perf_counter()
+        timer = session.timer
+
+        with timer.stage('parse'):
+            pkg = parse_keyframe(message, session.configs)
+
+        if pkg is None:
+            timer.pop()
+            print(f'! Skipped package {message[0]}, not a keyframe')
+            continue
+
+        if isinstance(pkg, NearFieldKeyFramePackage):
+            session.reconstruct_near_field_pcd(pkg)
+        else:
+            session.reconstruct_far_field_pcd(pkg)
+        session.run_direct_point_cloud_projection()
+
+        with timer.stage('encode'):
+            encode_response(session, tile_encoder)
+
+        stages = timer.pop()
+        stages['total'] = time.perf_counter() - t_start
+        if t_init > 0:
+            stages['init'], t_init = t_init, 0.0
+
+        frames.append(stages)
+
+    return frames
+
+
+def summarize(frames: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Statistics of each stage over frames, in milliseconds."""
+    stages = sorted({name for f in frames for name in f})
+    summary = {}
+
+    for name in stages:
+        t = np.array([f[name] for f in frames if name in f]) * 1e3
+        summary[name] = {
+            'n': len(t),
+            'mean_ms': float(t.mean()),
+            'p50_ms': float(np.percentile(t, 50)),
+            'p90_ms': float(np.percentile(t, 90)),
+            'max_ms': float(t.max()),
+            'total_ms': float(t.sum())
+        }
+
+    return summary
+
+
+def replay(recording: str, warmup: int = 1, repeat: int = 5, backend: str = None,
+           output: str = None, per_frame: bool = False):
+    """Replay a recording and report per-stage latencies as JSON.
+
+    The recording is replayed `warmup` times first, e.g. to compile the
+    kernels and load the static data, then `repeat` times on new sessions.
+    The report is printed, and written to `output` if given.
+    """
+    backend = resolve_backend(backend)
+    messages = load_recording(recording)
+    print(f'! Replaying {len(messages)} messages from {recording}')
+
+    for _ in range(warmup):
+        replay_messages(messages, backend)
+
+    runs = [replay_messages(messages, backend) for _ in range(repeat)]
+    frames = [f for run in runs for f in run]
+
+    report = {
+        'recording': os.path.abspath(recording),
+        'backend': backend,
+        'n_messages': len(messages),
+        'n_keyframes': len(runs[0]) if runs else 0,
+        'warmup': warmup,
+        'repeat': repeat,
+        'runs_ms': [sum([f['total'] for f in run]) * 1e3 for run in runs],
+        'stages': summarize(frames)
+    }
+
+    if per_frame:
+        report['frames'] = [
+            {name: t * 1e3 for name, t in f.items()} for f in frames]
+
+    text = json.dumps(report, indent=2)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+
+    print(text)
@@ -0,0 +1,143 @@
+"""Batch the point generation of near field keyframes across sessions."""
+import time
+import threading
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+import tornado.ioloop
+from tornado.concurrent import Future
+from tornado.concurrent import chain_future
+
+from configs import BATCH_WINDOW
+from configs import BATCH_MAX_SIZE
+from litar.session import LightingReconstructionSession
+from litar.pipeline.pointcloud import PointCloudBatch
+from service.schema import NearFieldKeyFramePackage
+from service.executor import pipeline_executor
+
+# (session, keyframe, finish, future) of a submitted keyframe
+PendingKeyframe = Tuple[LightingReconstructionSession, NearFieldKeyFramePackage,
+                        Callable[[], bytes], Future]
+
+
+class KeyframeBatchScheduler:
+    """Gather near field keyframes of many sessions into batched point generation.
+
+    Keyframes are flushed to the pipeline executor `window` seconds after
+    the first pending one, or once `max_size` are pending. There, sessions
+    with the same image sizes have their points generated by one
+    `PointCloudBatch`, then each keyframe finishes on its own session, e.g.
+    anchors, projection and response, as `finish` does.
+
+    The projection is left per session, as its buffers, panorama sizes and
+    projected ranges are.
+    """
+    window: float
+    max_size: int
+
+    __pending: List[PendingKeyframe]
+    __timeout: object  # IOLoop handle of the next flush
+    __batches: Dict[tuple, Tuple[PointCloudBatch, threading.Lock]]
+    __batches_lock: threading.Lock
+
+    def __init__(self, window: float = BATCH_WINDOW, max_size: int = BATCH_MAX_SIZE) -> None:
+        self.window = window
+        self.max_size = max_size
+
+        self.__pending = []
+        self.__timeout = None
+        self.__batches = {}
+        self.__batches_lock = threading.Lock()
+
+    def submit(self, session: LightingReconstructionSession, pkg: NearFieldKeyFramePackage,
+               finish: Callable[[], bytes]) -> Future:
+        """Queue a keyframe, the future resolves to what `finish` returns.
+
+        `finish` runs on the pipeline executor once the points of the
+        keyframe are generated. Called on the IOLoop.
+        """
+        future = Future()
+        self.__pending.append((session, pkg, finish, future))
+
+        if len(self.__pending) >= self.max_size:
+            self.flush()
+        elif self.__timeout is None:
+            self.__timeout = tornado.ioloop.IOLoop.current().call_later(
+                self.window, self.flush)
+
+        return future
+
+    def flush(self) -> None:
+        loop = tornado.ioloop.IOLoop.current()
+        if self.__timeout is not None:
+            loop.remove_timeout(self.__timeout)
+            self.__timeout = None
+
+        pending, self.__pending = self.__pending, []
+        if pending:
+            loop.spawn_callback(self.__run, pending)
+
+    async def __run(self, pending: List[PendingKeyframe]):
+        loop = tornado.ioloop.IOLoop.current()
+        try:
+            errors = await loop.run_in_executor(
+                pipeline_executor, self.generate, pending)
+        except Exception as e:
+            errors = [e] * len(pending)
+
+        for (_, _, finish, future), error in zip(pending, errors):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                chain_future(loop.run_in_executor(pipeline_executor, finish), future)
+
+    def generate(self, pending: List[PendingKeyframe]) -> list:
+        """Run on the pipeline executor, returns the exception of each keyframe, if any."""
+        groups = {}
+        for i, (session, _, _, _) in enumerate(pending):
+            g = session.near_filed_pc_generator
+            key = (g.backend, g.dn_size.x, g.dn_size.y, g.c_size.x, g.c_size.y)
+            groups.setdefault(key, []).append(i)
+
+        errors = [None] * len(pending)
+
+        for key, indices in groups.items():
+            frames = []
+            for i in indices:
+                session, pkg, _, _ = pending[i]
+                frames.append((session.near_filed_pc_generator, session.near_field_slot(pkg),
+                               pkg.buf_trs, pkg.buf_depth, pkg.buf_y, pkg.buf_cbcr))
+
+            t_start = time.perf_counter()
+            try:
+                batch, lock = self.__batch(key, pending[indices[0]][0])
+                with lock:
+                    batch.exec(frames)
+            except Exception as e:
+                traceback.print_exc()
+                for i in indices:
+                    errors[i] = e
+                continue
+
+            t = time.perf_counter() - t_start
+            for i in indices:
+                pending[i][0].timer.add('points', t)
+
+        return errors
+
+    def __batch(self, key: tuple, session: LightingReconstructionSession):
+        with self.__batches_lock:
+            if key not in self.__batches:
+                g = session.near_filed_pc_generator
+                self.__batches[key] = (
+                    PointCloudBatch(g.dn_size, g.c_size, self.max_size, backend=g.backend),
+                    threading.Lock())
+
+            return self.__batches[key]
+
+
+keyframe_scheduler = KeyframeBatchScheduler()
+
+__all__ = ['keyframe_scheduler']
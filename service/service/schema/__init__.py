@@ -1,2 +1,3 @@
 from .session_init import SessionInitPackage
+from .session_resume import SessionResumePackage
 from .keyframe import *
@@ -0,0 +1,110 @@
+import io
+import numpy as np
+from litar.types import Vector2Int
+
+# Depth formats of compressed keyframes
+DEPTH_FORMAT_FLOAT32 = 0
+DEPTH_FORMAT_FLOAT16 = 1
+DEPTH_FORMAT_UINT16_MM = 2  # millimeters
+
+# Codecs of compressed planes
+CODEC_RAW = 0
+CODEC_ZSTD = 1
+CODEC_LZ4 = 2  # lz4 frame format
+CODEC_JPEG = 3  # color only
+
+DEPTH_FORMAT_DTYPES = {
+    DEPTH_FORMAT_FLOAT32: np.float32,
+    DEPTH_FORMAT_FLOAT16: np.float16,
+    DEPTH_FORMAT_UINT16_MM: np.uint16
+}
+
+
+def decompress(codec: int, payload: memoryview, nbytes: int) -> memoryview:
+    """Decompress a zstd or lz4 plane of `nbytes` bytes, raw planes are kept as is.
+
+    The compression packages are optional, they are only imported once a
+    client sends planes compressed with them. At most `nbytes` + 1 bytes
+    are decompressed, whatever size the frame declares.
+    """
+    if codec == CODEC_RAW:
+        data = payload
+
+    elif codec == CODEC_ZSTD:
+        import zstandard
+
+        # The declared content size takes precedence over max_output_size
+        content_size = zstandard.frame_content_size(payload)
+        if content_size > nbytes:
+            raise ValueError(
+                f'Incorrect plane length: {content_size} bytes, expected {nbytes}')
+
+        data = zstandard.ZstdDecompressor().decompress(
+            payload, max_output_size=nbytes)
+
+    elif codec == CODEC_LZ4:
+        import lz4.frame
+        data = lz4.frame.LZ4FrameDecompressor().decompress(
+            payload, max_length=nbytes + 1)
+
+    else:
+        raise ValueError(f'Unknown plane codec {codec}')
+
+    if len(data) != nbytes:
+        raise ValueError(
+            f'Incorrect plane length: {len(data)} bytes, expected {nbytes}')
+
+    return memoryview(data)
+
+
+def decode_depth(depth_format: int, codec: int, payload: memoryview, n_pixels: int) -> np.ndarray:
+    """Decode a depth plane into float32 meters."""
+    if depth_format not in DEPTH_FORMAT_DTYPES:
+        raise ValueError(f'Unknown depth format {depth_format}')
+
+    dtype = np.dtype(DEPTH_FORMAT_DTYPES[depth_format]).newbyteorder('<')
+    data = decompress(codec, payload, n_pixels * dtype.itemsize)
+    depth = np.frombuffer(data, dtype=dtype)
+
+    if depth_format == DEPTH_FORMAT_UINT16_MM:
+        return depth * np.float32(0.001)
+
+    return depth.astype(np.float32, copy=False)
+
+
+def decode_color(codec: int, payload: memoryview, c_size: Vector2Int):
+    """Decode a color image into its Y plane and its subsampled CbCr plane."""
+    n_y = c_size.x * c_size.y
+
+    if codec == CODEC_JPEG:
+        return decode_jpeg_ycbcr(payload, c_size)
+
+    data = np.frombuffer(
+        decompress(codec, payload, n_y + n_y // 2), dtype=np.uint8)
+
+    y = data[:n_y].reshape((c_size.y, c_size.x))
+    cbcr = data[n_y:].reshape((c_size.y // 2, c_size.x // 2, 2))
+
+    return y, cbcr
+
+
+def decode_jpeg_ycbcr(payload: memoryview, c_size: Vector2Int):
+    """Decode a JPEG straight into YCbCr, without an RGB round trip."""
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(payload))
+    if img.format != 'JPEG':
+        raise ValueError(f'Incorrect color image format {img.format}')
+    if img.size != (c_size.x, c_size.y):
+        raise ValueError(
+            f'Incorrect color image size {img.size}, expected {c_size}')
+
+    img.draft('YCbCr', img.size)
+    ycbcr = np.asarray(img.convert('YCbCr'))
+
+    # Subsample the chroma with a 2x2 box filter
+    cbcr = ycbcr[:, :, 1:].reshape(
+        (c_size.y // 2, 2, c_size.x // 2, 2, 2)).mean(axis=(1, 3))
+
+    return np.ascontiguousarray(ycbcr[:, :, 0]), \
+        np.round(cbcr).astype(np.uint8)
@@ -2,6 +2,39 @@ import numpy as np
 from dataclasses import dataclass
 from litar.types import Vector2Int
 from service.schema.utils import BasePackage
+from service.schema.utils import PackageLayout
+from service.schema.codecs import decode_color
+from service.schema.codecs import decode_depth
+
+
+def near_field_layout(c_size: Vector2Int, d_size: Vector2Int) -> PackageLayout:
+    return PackageLayout(
+        ('view_index', np.int32, (1,)),
+        ('trs', np.float32, (12,)),
+        ('y', np.uint8, (c_size.y, c_size.x)),
+        ('cbcr', np.uint8, (c_size.y // 2, c_size.x // 2, 2)),
+        ('depth', np.float32, (d_size.x * d_size.y,)))
+
+
+def far_field_layout(c_size: Vector2Int) -> PackageLayout:
+    return PackageLayout(
+        ('r', np.float32, (9,)),
+        ('y', np.uint8, (c_size.y, c_size.x)),
+        ('cbcr', np.uint8, (c_size.y // 2, c_size.x // 2, 2)))
+
+
+def compressed_near_field_layout() -> PackageLayout:
+    return PackageLayout(
+        ('view_index', np.int32, (1,)),
+        ('trs', np.float32, (12,)),
+        ('formats', np.uint8, (4,)),  # depth format, depth codec, color codec, reserved
+        ('color_len', np.uint32, (1,)))
+
+
+def compressed_far_field_layout() -> PackageLayout:
+    return PackageLayout(
+        ('r', np.float32, (9,)),
+        ('formats', np.uint8, (4,)))  # color codec, reserved
 
 
 @dataclass
@@ -18,37 +51,13 @@ class NearFieldKeyFramePackage(BasePackage):
     def __init__(self, raw_bytes: bytes, c_size: Vector2Int, d_size: Vector2Int) -> None:
         super(NearFieldKeyFramePackage, self).__init__(raw_bytes)
 
-        header_len = 1
-        view_index_len = 4
-        buf_trs_len = 3 * 4 * 4
-        buf_y_len = c_size.x * c_size.y
-        buf_cbcr_len = int(c_size.x * c_size.y * 0.5)
-        buf_depth_len = d_size.x * d_size.y * 4
-        offset = header_len
-
-        self.view_index = np.frombuffer(
-            raw_bytes[offset:offset + view_index_len],
-            dtype=np.int32)[0]
-        offset += view_index_len
-
-        self.buf_trs = np.frombuffer(
-            raw_bytes[offset:offset + buf_trs_len],
-            dtype=np.float32)
-        offset += buf_trs_len
-
-        self.buf_y = np.frombuffer(
-            raw_bytes[offset:offset + buf_y_len],
-            dtype=np.uint8).reshape((c_size.y, c_size.x))
-        offset += buf_y_len
-
-        self.buf_cbcr = np.frombuffer(
-            raw_bytes[offset:offset + buf_cbcr_len],
-            dtype=np.uint8).reshape((c_size.y // 2, c_size.x // 2, 2))
-        offset += buf_cbcr_len
-
-        self.buf_depth = np.frombuffer(
-            raw_bytes[offset:offset + buf_depth_len],
-            dtype=np.float32)
+        sections = near_field_layout(c_size, d_size).decode(raw_bytes)
+
+        self.view_index = int(sections['view_index'][0])
+        self.buf_trs = sections['trs']
+        self.buf_y = sections['y']
+        self.buf_cbcr = sections['cbcr']
+        self.buf_depth = sections['depth']
 
     def __str__(self) -> str:
         return '\n'.join([
@@ -62,7 +71,7 @@ class NearFieldKeyFramePackage(BasePackage):
 
 @dataclass
 class FarFieldKeyFramePackage(BasePackage):
-    buf_r: np.ndarray  # float32, 3x4
+    buf_r: np.ndarray  # float32, 3x3
 
     buf_y: np.ndarray  # uint8, n_pixels
     buf_cbcr: np.ndarray  # uint8, n_pixels * 0.5
@@ -72,25 +81,11 @@ class FarFieldKeyFramePackage(BasePackage):
     def __init__(self, raw_bytes: bytes, c_size: Vector2Int) -> None:
         super(FarFieldKeyFramePackage, self).__init__(raw_bytes)
 
-        header_len = 1
-        buf_r_len = 3 * 3 * 4
-        buf_y_len = c_size.x * c_size.y
-        buf_cbcr_len = int(c_size.x * c_size.y * 0.5)
-        offset = header_len
+        sections = far_field_layout(c_size).decode(raw_bytes)
 
-        self.buf_r = np.frombuffer(
-            raw_bytes[offset:offset + buf_r_len],
-            dtype=np.float32)
-        offset += buf_r_len
-
-        self.buf_y = np.frombuffer(
-            raw_bytes[offset:offset + buf_y_len],
-            dtype=np.uint8).reshape((c_size.y, c_size.x))
-        offset += buf_y_len
-
-        self.buf_cbcr = np.frombuffer(
-            raw_bytes[offset:offset + buf_cbcr_len],
-            dtype=np.uint8).reshape((c_size.y // 2, c_size.x // 2, 2))
+        self.buf_r = sections['r']
+        self.buf_y = sections['y']
+        self.buf_cbcr = sections['cbcr']
 
     def __str__(self) -> str:
         return '\n'.join([
@@ -98,3 +93,70 @@ class FarFieldKeyFramePackage(BasePackage):
             f'buf_y: {self.buf_y.shape}',
             f'buf_cbcr: {self.buf_cbcr.shape}'
         ])
+
+
+@dataclass(init=False)
+class CompressedNearFieldKeyFramePackage(NearFieldKeyFramePackage):
+    """Near field keyframe with compressed planes, see `service.schema.codecs`.
+
+    The color payload of `color_len` bytes follows the sections, and the
+    depth payload takes the rest of the package. Decoding is CPU heavy, so
+    it runs on the pipeline executor.
+    """
+    depth_format: int
+    depth_codec: int
+    color_codec: int
+
+    identifier: int = 0b0001_0010
+
+    def __init__(self, raw_bytes: bytes, c_size: Vector2Int, d_size: Vector2Int) -> None:
+        BasePackage.__init__(self, raw_bytes)
+
+        layout = compressed_near_field_layout()
+        sections = layout.decode(raw_bytes, payload=True)
+
+        self.view_index = int(sections['view_index'][0])
+        self.buf_trs = sections['trs']
+        self.depth_format, self.depth_codec, self.color_codec = \
+            [int(f) for f in sections['formats'][:3]]
+
+        offset = 1 + layout.nbytes
+        color_len = int(sections['color_len'][0])
+        payload = memoryview(raw_bytes)
+        if offset + color_len > len(raw_bytes):
+            raise ValueError('Incorrect color payload length')
+
+        self.buf_y, self.buf_cbcr = decode_color(
+            self.color_codec, payload[offset:offset + color_len], c_size)
+        self.buf_depth = decode_depth(
+            self.depth_format, self.depth_codec,
+            payload[offset + color_len:], d_size.x * d_size.y)
+
+    def __str__(self) -> str:
+        return super(CompressedNearFieldKeyFramePackage, self).__str__() + '\n' + \
+            f'formats: depth {self.depth_format}, depth codec {self.depth_codec}, ' \
+            f'color codec {self.color_codec}'
+
+
+@dataclass(init=False)
+class CompressedFarFieldKeyFramePackage(FarFieldKeyFramePackage):
+    """Far field keyframe with a compressed color payload taking the rest of the package."""
+    color_codec: int
+
+    identifier: int = 0b0001_0011
+
+    def __init__(self, raw_bytes: bytes, c_size: Vector2Int) -> None:
+        BasePackage.__init__(self, raw_bytes)
+
+        layout = compressed_far_field_layout()
+        sections = layout.decode(raw_bytes, payload=True)
+
+        self.buf_r = sections['r']
+        self.color_codec = int(sections['formats'][0])
+
+        self.buf_y, self.buf_cbcr = decode_color(
+            self.color_codec, memoryview(raw_bytes)[1 + layout.nbytes:], c_size)
+
+    def __str__(self) -> str:
+        return super(CompressedFarFieldKeyFramePackage, self).__str__() + '\n' + \
+            f'color codec: {self.color_codec}'
@@ -0,0 +1,22 @@
+"""Response modes negotiated in the session initialization package."""
+
+RESPONSE_MODE_ENV_MAP = 0  # a full JPEG environment map for every update
+RESPONSE_MODE_ENV_MAP_TILES = 1  # changed JPEG tiles, with periodic full maps
+RESPONSE_MODE_SH9 = 2  # second order spherical harmonics of the anchors
+RESPONSE_MODE_DOMINANT_LIGHT = 3  # dominant directional light and ambient color
+RESPONSE_MODE_ANCHOR_PALETTE = 4  # raw anchor colors
+
+RESPONSE_MODES = (
+    RESPONSE_MODE_ENV_MAP,
+    RESPONSE_MODE_ENV_MAP_TILES,
+    RESPONSE_MODE_SH9,
+    RESPONSE_MODE_DOMINANT_LIGHT,
+    RESPONSE_MODE_ANCHOR_PALETTE
+)
+
+# Modes computed from the anchors alone, without rendering an environment map
+COMPACT_RESPONSE_MODES = (
+    RESPONSE_MODE_SH9,
+    RESPONSE_MODE_DOMINANT_LIGHT,
+    RESPONSE_MODE_ANCHOR_PALETTE
+)
@@ -1,5 +1,7 @@
 import numpy as np
 from dataclasses import dataclass
+from configs import DEFAULT_QUALITY_TIER
+from service.schema.response import RESPONSE_MODE_ENV_MAP
 from litar.types import Vector2Int
 from service.schema.utils import BasePackage
 
@@ -7,7 +9,7 @@ from service.schema.utils import BasePackage
 @dataclass
 class SessionInitPackage(BasePackage):
     num_of_views: int
-    exp_time_window: int
+    exp_time_window: int  # seconds, 0 disables expiry
     near_field_size: int
 
     depth_native_size: Vector2Int
@@ -17,16 +19,25 @@ class SessionInitPackage(BasePackage):
     k: np.ndarray
     ambient_color: np.ndarray  # uint8, 3
 
+    quality_tier: int  # optional, appended after the image sizes
+    response_mode: int  # optional, appended after the quality tier
+
+    raw_bytes: bytes  # kept for session snapshots
+
     identifier: int = 0b0000_0000
 
     def __init__(self, raw_bytes: bytes):
         super(SessionInitPackage, self).__init__(raw_bytes)
 
+        self.raw_bytes = bytes(raw_bytes)
+
         header_len = 1
         config_len = 3 * 4
         ambient_info_len = 2 * 4
         matrix_k_len = 4 * 4
         img_sizes_len = 6 * 4
+        quality_tier_len = 4
+        response_mode_len = 4
         offset = header_len
 
         # Start decoding package
@@ -56,6 +67,23 @@ class SessionInitPackage(BasePackage):
         self.depth_native_size = Vector2Int(int(sizes[0]), int(sizes[1]))
         self.color_dense_size = Vector2Int(int(sizes[2]), int(sizes[3]))
         self.color_sparse_size = Vector2Int(int(sizes[4]), int(sizes[5]))
+        offset += img_sizes_len
+
+        # Older clients don't send a quality tier
+        if len(raw_bytes) >= offset + quality_tier_len:
+            self.quality_tier = int(np.frombuffer(
+                raw_bytes[offset:offset + quality_tier_len],
+                dtype=np.int32)[0])
+        else:
+            self.quality_tier = DEFAULT_QUALITY_TIER
+        offset += quality_tier_len
+
+        if len(raw_bytes) >= offset + response_mode_len:
+            self.response_mode = int(np.frombuffer(
+                raw_bytes[offset:offset + response_mode_len],
+                dtype=np.int32)[0])
+        else:
+            self.response_mode = RESPONSE_MODE_ENV_MAP
 
     def ambient_info_to_rgb(self, info):
         temperature = info[0]
@@ -100,5 +128,7 @@ class SessionInitPackage(BasePackage):
                 f'k: {self.k}',
                 f'depth_native_size: {self.depth_native_size}',
                 f'color_dense_size: {self.color_dense_size}',
-                f'color_sparse_size: {self.color_sparse_size}'
+                f'color_sparse_size: {self.color_sparse_size}',
+                f'quality_tier: {self.quality_tier}',
+                f'response_mode: {self.response_mode}'
             ])
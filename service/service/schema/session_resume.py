@@ -0,0 +1,18 @@
+from uuid import UUID
+from dataclasses import dataclass
+from service.schema.utils import BasePackage
+
+
+@dataclass
+class SessionResumePackage(BasePackage):
+    s_id: UUID  # id of the session to resume, as sent in the init reply
+
+    identifier: int = 0b0000_0010
+
+    def __init__(self, raw_bytes: bytes):
+        super(SessionResumePackage, self).__init__(raw_bytes)
+
+        self.s_id = UUID(bytes(raw_bytes[1:]).decode())
+
+    def __str__(self) -> str:
+        return f'<SessionResumePackage> s_id: {self.s_id}'
@@ -1,3 +1,7 @@
+import numpy as np
+from typing import Dict, Tuple
+
+
 class BasePackage:
     identifier: int
 
@@ -7,3 +11,46 @@ class BasePackage:
         if identifier != self.identifier:
             raise ValueError(
                 'Incorrect reconstruction keyframe package header')
+
+
+class PackageLayout:
+    """Fixed layout of the sections following a package header.
+
+    Sections are decoded as views into the received bytes, so no section is
+    copied. Views are read-only and may be unaligned, the CPU kernels read
+    them in place, e.g. see `ManagedPointCloudGenerator.exec`.
+    """
+    nbytes: int  # bytes after the header
+
+    __sections: Tuple[Tuple[str, np.dtype, tuple, int], ...]
+
+    def __init__(self, *sections: Tuple[str, type, tuple]) -> None:
+        decoded = []
+        offset = 0
+
+        for name, dtype, shape in sections:
+            dtype = np.dtype(dtype).newbyteorder('<')
+            decoded.append((name, dtype, shape, offset))
+            offset += int(np.prod(shape)) * dtype.itemsize
+
+        self.__sections = tuple(decoded)
+        self.nbytes = offset
+
+    def decode(self, raw_bytes: bytes, header_len: int = 1,
+               payload: bool = False) -> Dict[str, np.ndarray]:
+        """Map the sections of a package, its length is validated once.
+
+        With `payload`, the package may carry variable length data after
+        the sections, e.g. compressed planes.
+        """
+        n = header_len + self.nbytes
+        if len(raw_bytes) < n or (not payload and len(raw_bytes) != n):
+            raise ValueError(
+                f'Incorrect package length: {len(raw_bytes)} bytes, '
+                f'expected {"at least " if payload else ""}{n}')
+
+        return {
+            name: np.frombuffer(
+                raw_bytes, dtype=dtype, count=int(np.prod(shape)),
+                offset=header_len + offset).reshape(shape)
+            for name, dtype, shape, offset in self.__sections}
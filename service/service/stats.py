@@ -0,0 +1,50 @@
+"""Per-process service statistics."""
+import os
+import time
+from typing import Optional
+
+
+class WorkerStats:
+    worker_id: int = 0
+    pid: int
+    port: Optional[int] = None  # own port of a forked worker
+
+    t_start: float
+    n_sessions_opened: int = 0
+    n_sessions_active: int = 0
+    n_keyframes: int = 0
+    n_keyframes_dropped: int = 0
+
+    def __init__(self) -> None:
+        self.reset(0)
+
+    def reset(self, worker_id: int) -> None:
+        """Start over after forking into a worker process."""
+        self.worker_id = worker_id
+        self.pid = os.getpid()
+        self.t_start = time.time()
+
+        self.n_sessions_opened = 0
+        self.n_sessions_active = 0
+        self.n_keyframes = 0
+        self.n_keyframes_dropped = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'worker_id': self.worker_id,
+            'pid': self.pid,
+            'port': self.port,
+            'uptime': time.time() - self.t_start,
+            'n_sessions_opened': self.n_sessions_opened,
+            'n_sessions_active': self.n_sessions_active,
+            'n_keyframes': self.n_keyframes,
+            'n_keyframes_dropped': self.n_keyframes_dropped
+        }
+
+    def __str__(self) -> str:
+        return ', '.join([f'{k}: {v}' for k, v in self.to_dict().items()])
+
+
+worker_stats = WorkerStats()
+
+__all__ = ['worker_stats']
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from litar.types import Vector2Int
+from litar.pipeline.dpcp.panorama import core
+
+
+class RecordingKernel:
+    """Stands in for a CUDA kernel, failing on the launches CUDA rejects."""
+
+    def __init__(self) -> None:
+        self.launches = []
+        self.calls = []
+
+    def __getitem__(self, config):
+        n_block, n_thread = config
+        assert np.prod(n_block) > 0, f'Invalid launch of {n_block} blocks'
+        self.launches.append(config)
+        return lambda *args: self.calls.append(args)
+
+
+class FakeContext:
+    def synchronize(self):
+        pass
+
+
+@pytest.fixture
+def make_renderer():
+    def make():
+        return core.ManagedPanoramaRenderer(
+            np.array([128, 128, 128], dtype=np.uint8),
+            Vector2Int(512, 256), [256, 128, 32], backend='cpu')
+
+    return make
+
+
+@pytest.fixture
+def cuda_kernels(monkeypatch):
+    dpcp, merge = RecordingKernel(), RecordingKernel()
+    monkeypatch.setattr(core, 'dpcp_cuda', dpcp)
+    monkeypatch.setattr(core, 'merge_dpcp_cuda', merge)
+    monkeypatch.setattr(core, 'draw_far_field', RecordingKernel())
+    monkeypatch.setattr(core, 'draw_far_field_pixels', RecordingKernel())
+    monkeypatch.setattr(core.cuda, 'current_context', lambda: FakeContext())
+    return dpcp, merge
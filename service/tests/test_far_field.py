@@ -0,0 +1,40 @@
+import numpy as np
+
+from litar.pipeline.backend import BACKEND_CUDA
+from litar.pipeline.dpcp.panorama import core
+
+
+def paint_some_anchors(renderer, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(core.N_ANCHORS, dtype=bool)
+    mask[rng.choice(core.N_ANCHORS, 4, replace=False)] = True
+    renderer.paint_anchors(mask, rng.integers(0, 256, (4, 3), dtype=np.uint8))
+
+
+def test_partial_far_field_redraw_matches_full_redraw(make_renderer):
+    renderer, full = make_renderer(), make_renderer()
+    renderer.redraw_far_field()
+
+    for seed in range(3):
+        paint_some_anchors(renderer, seed)
+        paint_some_anchors(full, seed)
+        renderer.redraw_far_field()
+
+    full.redraw_far_field()
+    assert np.allclose(renderer.arg_inout_far_field, full.arg_inout_far_field)
+
+
+def test_far_field_redraws_reuse_the_pixel_buffer(cuda_kernels, make_renderer):
+    renderer = make_renderer()
+    renderer.redraw_far_field()
+    renderer.backend = BACKEND_CUDA
+
+    for seed in range(3):
+        paint_some_anchors(renderer, seed)
+        renderer.redraw_far_field()
+
+    calls = core.draw_far_field_pixels.calls
+    assert len(calls) == 3
+    for args in calls:
+        assert args[2] is renderer.arg_in_far_field_pixels
+        assert 0 < args[3] <= renderer.arg_in_far_field_pixels.shape[0]
@@ -0,0 +1,125 @@
+import numpy as np
+
+from litar.pipeline.backend import BACKEND_CUDA
+from litar.pipeline.pointcloud.fusion import FusedPointStore
+
+
+def make_view(n: int = 4096, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    xyz = rng.uniform(-2, 2, (n, 3)).astype(np.float32)
+    rgb = rng.integers(0, 256, (n, 3), dtype=np.uint8)
+    return xyz, rgb
+
+
+def test_duplicate_view_appends_nothing():
+    store = FusedPointStore(0.05, 100000, backend='cpu')
+    xyz, rgb = make_view()
+
+    first = store.insert(xyz, rgb, 1)
+    again = store.insert(xyz, rgb, 2)
+
+    assert first.i_end > first.i_begin
+    assert again.i_begin == again.i_end == first.i_end
+    assert not again.recycled
+
+
+def test_duplicate_view_projects_on_cpu(make_renderer):
+    store = FusedPointStore(0.05, 100000, backend='cpu')
+    renderer = make_renderer()
+    xyz, rgb = make_view()
+
+    for stamp in (1, 2):
+        ins = store.insert(xyz, rgb, stamp)
+        renderer.update(store.arg_out_pcd_xyz, store.arg_out_pcd_rgb,
+                        ranges=[(ins.i_begin, ins.i_end)])
+
+
+def test_duplicate_view_skips_empty_cuda_launches(cuda_kernels, make_renderer):
+    dpcp, merge = cuda_kernels
+    store = FusedPointStore(0.05, 100000, backend='cpu')
+    renderer = make_renderer()
+    renderer.backend = BACKEND_CUDA
+    xyz, rgb = make_view()
+
+    store.insert(xyz, rgb, 1)
+    ins = store.insert(xyz, rgb, 2)
+    renderer.update(store.arg_out_pcd_xyz, store.arg_out_pcd_rgb,
+                    ranges=[(ins.i_begin, ins.i_end)])
+
+    assert dpcp.launches == []
+    assert len(merge.launches) == 1
+
+
+def test_empty_store_rebuild_skips_cuda_launches(cuda_kernels, make_renderer):
+    dpcp, merge = cuda_kernels
+    store = FusedPointStore(0.05, 100000, backend='cpu')
+    renderer = make_renderer()
+    renderer.backend = BACKEND_CUDA
+
+    renderer.update(store.arg_out_pcd_xyz, store.arg_out_pcd_rgb,
+                    ranges=[(0, store.n_points)])
+
+    assert dpcp.launches == []
+    assert len(merge.launches) == 1
+
+
+def test_voxel_hash_follows_inserts_recycling_and_expiry():
+    store = FusedPointStore(0.25, 3000, backend='cpu')
+    rng = np.random.default_rng(1)
+    inserted = {}
+    recycled = False
+
+    for stamp in range(1, 40):
+        xyz, rgb = make_view(1000, seed=stamp % 7)
+        xyz += rng.uniform(-0.5, 0.5, 3).astype(np.float32)
+        ins = store.insert(xyz, rgb, stamp)
+        inserted[stamp] = ins.keys
+        recycled |= ins.recycled
+
+        if stamp % 3 == 0:
+            old = stamp - 2
+            store.expire(inserted.pop(old), old)
+
+        n = store.n_points
+        xyz = np.asarray(store.arg_out_pcd_xyz[:n])
+        keys, m = store.voxel_keys(xyz)
+        assert m.all()
+
+        found, slots = store.lookup(keys)
+        assert found.all()
+        assert np.array_equal(slots, np.arange(n))
+
+    assert recycled
+
+    # Voxels without a slot are unknown
+    unknown = np.setdiff1d(np.arange(keys.min(), keys.max()), keys)
+    assert not store.lookup(unknown)[0].any()
+
+
+def test_store_grows_on_demand():
+    store = FusedPointStore(0.05, 100000, backend='cpu', capacity=1000)
+    nbytes = store.nbytes
+    assert nbytes == FusedPointStore.estimate_nbytes(100000, capacity=1000)
+
+    for stamp in range(1, 4):
+        store.insert(*make_view(4096, seed=stamp), stamp)
+
+    assert store.capacity == 16000
+    assert store.n_points <= store.capacity
+    assert store.nbytes > nbytes
+
+    # Points keep their slots, and are still found after rehashing
+    n = store.n_points
+    keys, m = store.voxel_keys(np.asarray(store.arg_out_pcd_xyz[:n]))
+    found, slots = store.lookup(keys)
+    assert m.all() and found.all()
+    assert np.array_equal(slots, np.arange(n))
+
+
+def test_store_growth_stops_at_max_points():
+    store = FusedPointStore(0.05, 5000, backend='cpu', capacity=1000)
+    for stamp in range(1, 4):
+        store.insert(*make_view(4096, seed=stamp), stamp)
+
+    assert store.capacity == 5000
+    assert store.n_points == 5000